@@ -0,0 +1,42 @@
+"""
+compare memory and attribute access of compact models with TelegramObject
+run in terminal: python -m benchmark.models
+"""
+import json
+import timeit
+import tracemalloc
+
+from telegrambotclient import models
+from telegrambotclient.base import Update
+
+from benchmark.update_parsing import build_raw_update
+
+
+def measure_memory(update_class, raw_update: dict, count: int) -> float:
+    raw_json = json.dumps(raw_update)
+    tracemalloc.start()
+    updates = [update_class(**json.loads(raw_json)) for _ in range(count)]
+    for update in updates:
+        # wrap nested objects of TelegramObject the same as handlers do
+        update.message.reply_to_message.chat.id
+        update.message.from_user.id
+        update.message.photo[-1].file_id
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / count
+
+
+def main():
+    raw_update = build_raw_update(depth=1)
+    count = 10000
+    for title, update_class in (("TelegramObject", Update),
+                                ("models.Update", models.Update)):
+        update = update_class(**raw_update)
+        cost = timeit.timeit(lambda: update.message.chat.id, number=200000)
+        print("{0:<16} {1:>8.0f} bytes/update {2:>8.3f} us/message.chat.id".
+              format(title, measure_memory(update_class, raw_update, count),
+                     cost / 200000 * 1e6))
+
+
+if __name__ == "__main__":
+    main()
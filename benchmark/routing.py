@@ -0,0 +1,64 @@
+"""
+measure the routing cost of a message against the number of registered message handlers
+run in terminal: python -m benchmark.routing
+"""
+import asyncio
+import time
+
+from telegrambotclient.base import MessageField, Update
+from telegrambotclient.bot import TelegramBot
+from telegrambotclient.router import TelegramRouter
+
+
+def on_message(bot, message):
+    return True
+
+
+def build_router(handler_count: int) -> TelegramRouter:
+    router = TelegramRouter("benchmark-{0}".format(handler_count))
+    for idx in range(handler_count - 1):
+        if idx % 2:
+            # 'or' handlers on fields which the message does not have
+            router.register_message_handler(
+                on_message, ("field_{0}".format(idx), "other_{0}".format(idx)))
+        else:
+            # 'and' handlers which the message only partly matches
+            router.register_message_handler(
+                on_message, {"text", "field_{0}".format(idx)})
+    router.register_message_handler(on_message, MessageField.TEXT.fields)
+    return router
+
+
+async def measure(router: TelegramRouter, bot: TelegramBot, update: Update,
+                  number: int) -> float:
+    start = time.perf_counter()
+    for _ in range(number):
+        await router.route(bot, update)
+    return (time.perf_counter() - start) / number
+
+
+def main():
+    logger = __import__("logging").getLogger("telegram-bot-client")
+    logger.disabled = True
+    update = Update(update_id=1,
+                    message={
+                        "message_id": 1,
+                        "from": {
+                            "id": 1
+                        },
+                        "chat": {
+                            "id": 1
+                        },
+                        "date": 1625000000,
+                        "text": "hello",
+                    })
+    for handler_count in (5, 50, 200, 1000):
+        router = build_router(handler_count)
+        bot = TelegramBot("1:benchmark", router)
+        cost = asyncio.run(measure(router, bot, update, 20000))
+        print("{0:>5} handlers {1:>8.2f} us/message".format(
+            handler_count, cost * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+compare lazy TelegramObject parsing with the former eager conversion
+run in terminal: python -m benchmark.update_parsing
+"""
+import timeit
+
+from telegrambotclient.base import Update
+
+
+class EagerTelegramObject(dict):
+    # the former TelegramObject which converted nested values in __init__
+    def __init__(self, **kwargs):
+        data = {
+            name: self.__recurse_init(value)
+            for name, value in kwargs.items()
+        }
+        if "from" in data:
+            data["from_user"] = data["from"]
+            del data["from"]
+        super().__init__(data)
+
+    @classmethod
+    def __recurse_init(cls, value):
+        if isinstance(value, EagerTelegramObject):
+            return value
+        if isinstance(value, dict):
+            return EagerTelegramObject(**value)
+        if isinstance(value, list):
+            return [cls.__recurse_init(item) for item in value]
+        return value
+
+    def __getattr__(self, name: str):
+        return self.get(name, None)
+
+
+def build_raw_update(depth: int = 3) -> dict:
+    user = {
+        "id": 1234567,
+        "is_bot": False,
+        "first_name": "Foo",
+        "last_name": "Bar",
+        "username": "foobar",
+        "language_code": "en",
+    }
+    chat = {
+        "id": -1001234567,
+        "title": "a group",
+        "type": "supergroup",
+    }
+    message = {
+        "message_id": 1,
+        "from": user,
+        "chat": chat,
+        "date": 1625000000,
+        "caption": "photos " * 20,
+        "caption_entities": [{
+            "type": "bold",
+            "offset": idx,
+            "length": 1
+        } for idx in range(20)],
+        "photo": [{
+            "file_id": "file_id_{0}".format(idx),
+            "file_unique_id": "unique_id_{0}".format(idx),
+            "width": 90 * idx,
+            "height": 90 * idx,
+            "file_size": 1024 * idx,
+        } for idx in range(4)],
+    }
+    for idx in range(depth):
+        message = dict(message,
+                       message_id=idx + 2,
+                       reply_to_message=message)
+    return {"update_id": 1, "message": message}
+
+
+def main():
+    raw_update = build_raw_update()
+    number = 20000
+    for title, stmt in (
+        ("eager parse", lambda: EagerTelegramObject(**raw_update)),
+        ("lazy parse", lambda: Update(**raw_update)),
+        ("eager parse + message.chat.id",
+         lambda: EagerTelegramObject(**raw_update).message.chat.id),
+        ("lazy parse + message.chat.id",
+         lambda: Update(**raw_update).message.chat.id),
+    ):
+        cost = timeit.timeit(stmt, number=number)
+        print("{0:<32} {1:>8.2f} us/update".format(title,
+                                                  cost / number * 1e6))
+
+
+if __name__ == "__main__":
+    main()
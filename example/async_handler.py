@@ -15,9 +15,10 @@ example_bot.delete_webhook(drop_pending_updates=True)
 
 @router.message_handler(fields=MessageField.TEXT)
 async def on_echo_text(bot: TelegramBot, message: Message):
-    bot.reply_message(message, text="I will reply in 3s.")
+    # async_xxx methods are awaitable and do not block the event loop
+    await bot.async_reply_message(message, text="I will reply in 3s.")
     await asyncio.sleep(3)
-    bot.reply_message(
+    await bot.async_reply_message(
         message,
         text="I receive: <strong>{0}</strong>".format(message.text),
         parse_mode=ParseMode.HTML,
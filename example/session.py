@@ -21,6 +21,7 @@ from example.settings import BOT_TOKEN
 # storage = SQLiteStorage()
 storage = None
 router = bot_client.router()
+# with write_back_sessions=True, session changes of an update are written in one batch after it is routed
 example_bot = bot_client.create_bot(token=BOT_TOKEN,
                                     router=router,
                                     storage=storage)
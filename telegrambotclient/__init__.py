@@ -1,13 +1,21 @@
+import asyncio
 import logging
+import signal
 import sys
-from typing import Dict, Iterable, Optional
+from concurrent.futures import Executor
+from typing import Awaitable, Callable, Dict, Iterable, Optional
 
-from telegrambotclient.api import TelegramBotAPICaller
-from telegrambotclient.base import TelegramBotException, Update
+from telegrambotclient.api import (TelegramBotAPICaller,
+                                   TelegramBotAsyncAPICaller,
+                                   TelegramRateLimiter, TelegramRetryPolicy)
+from telegrambotclient.base import TelegramBotException
 from telegrambotclient.bot import TelegramBot
 from telegrambotclient.handler import UpdateHandler
+from telegrambotclient.queue import UpdateQueue, UpdateQueueWorker
 from telegrambotclient.router import TelegramRouter
+from telegrambotclient.shard import TelegramShards
 from telegrambotclient.storage import TelegramStorage
+from telegrambotclient.webhook import TelegramWebhookServer
 
 logger = logging.getLogger("telegram-bot-client")
 formatter = logging.Formatter(
@@ -44,11 +52,19 @@ class TelegramBotClient:
         self,
         name: Optional[str] = None,
         handlers: Optional[Iterable[UpdateHandler]] = None,
+        executor: Optional[Executor] = None,
+        sync_handler_workers: Optional[int] = None,
+        max_sync_handlers_per_bot: Optional[int] = None,
     ) -> TelegramRouter:
         name = name or "default"
         router = self._router_data.get(name, None)
         if router is None:
-            self._router_data[name] = TelegramRouter(name, handlers)
+            self._router_data[name] = TelegramRouter(
+                name,
+                handlers,
+                executor=executor,
+                sync_handler_workers=sync_handler_workers,
+                max_sync_handlers_per_bot=max_sync_handlers_per_bot)
         else:
             router.register_handlers(handlers)
         return self._router_data[name]
@@ -60,6 +76,13 @@ class TelegramBotClient:
                    storage: Optional[TelegramStorage] = None,
                    i18n_source: Optional[Dict] = None,
                    api_host: Optional[str] = None,
+                   update_class: Optional[Callable] = None,
+                   write_back_sessions: bool = False,
+                   cache_file_ids: bool = False,
+                   rate_limiter: Optional[TelegramRateLimiter] = None,
+                   retry_policy: Optional[TelegramRetryPolicy] = None,
+                   max_update_retries: int = 2,
+                   api_timeout: Optional[float] = 90,
                    **urllib3_pool_kwargs):
         router = router or self.router(handlers=handlers)
         self._bot_data[token] = TelegramBot(
@@ -70,6 +93,15 @@ class TelegramBotClient:
             TelegramBotAPICaller(api_host=api_host
                                  or "https://api.telegram.org",
                                  **urllib3_pool_kwargs),
+            TelegramBotAsyncAPICaller(api_host=api_host
+                                      or "https://api.telegram.org",
+                                      timeout=api_timeout),
+            update_class,
+            write_back_sessions,
+            cache_file_ids=cache_file_ids,
+            rate_limiter=rate_limiter,
+            retry_policy=retry_policy,
+            max_update_retries=max_update_retries,
         )
         return self._bot_data[token]
 
@@ -77,11 +109,165 @@ class TelegramBotClient:
         return self._bot_data.get(token, None)
 
     async def dispatch(self, token: str, raw_update: Dict):
+        """dispatch a raw update of a webhook or a shard, last_update_id of its bot
+        advances to it once it is done"""
         simple_bot = self._bot_data.get(token, None)
         if simple_bot is None:
             raise TelegramBotException(
                 "No bot found with token: '{0}'".format(token))
-        await simple_bot.dispatch(Update(**raw_update))
+        update = simple_bot.update_class(**raw_update)
+        await simple_bot.handle_update(update)
+        if update.update_id > simple_bot.last_update_id:
+            simple_bot.last_update_id = update.update_id
+
+    async def polling_all(self,
+                          limit: Optional[int] = None,
+                          timeout: Optional[int] = None,
+                          allowed_updates: Optional[Iterable[str]] = None,
+                          concurrency: int = 1,
+                          **kwargs):
+        """long-poll every bot on the running event loop.
+        Each bot keeps its own offset and backs off on its own errors,
+        SIGINT and SIGTERM stop all bots gracefully.
+        """
+        loop = asyncio.get_event_loop()
+        stop_signals = []
+        for stop_signal in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(stop_signal, self.stop_polling_all)
+                stop_signals.append(stop_signal)
+            except (NotImplementedError, RuntimeError):
+                # not supported on this platform or not in the main thread
+                pass
+        try:
+            await asyncio.gather(*(simple_bot.polling(
+                limit=limit,
+                timeout=timeout,
+                allowed_updates=allowed_updates,
+                concurrency=concurrency,
+                **kwargs) for simple_bot in tuple(self._bot_data.values())))
+        finally:
+            for stop_signal in stop_signals:
+                loop.remove_signal_handler(stop_signal)
+
+    async def queue_worker(self, update_queue: UpdateQueue, **kwargs):
+        """consume updates of every bot from an update queue on the running event loop,
+        SIGINT and SIGTERM stop it after updates in flight are done.
+        Updates are published to the queue by dispatch=update_queue.dispatch of polling or webhook.
+
+        Args:
+            kwargs: other kwargs of UpdateQueueWorker, such as consumer, concurrency and lease_ttl
+        """
+        worker = UpdateQueueWorker(self, update_queue, **kwargs)
+        loop = asyncio.get_event_loop()
+        stop_signals = []
+        for stop_signal in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(stop_signal, worker.stop)
+                stop_signals.append(stop_signal)
+            except (NotImplementedError, RuntimeError):
+                # not supported on this platform or not in the main thread
+                pass
+        try:
+            await worker.run()
+        finally:
+            for stop_signal in stop_signals:
+                loop.remove_signal_handler(stop_signal)
+
+    def run_queue_worker(self, update_queue: UpdateQueue, **kwargs):
+        """run queue_worker on an event loop in the current process"""
+        asyncio.run(self.queue_worker(update_queue, **kwargs))
+
+    def stop_polling_all(self):
+        logger.info("stop polling bots of %s", self.name)
+        for simple_bot in self._bot_data.values():
+            simple_bot.stop_polling()
+
+    def run_polling_all(self,
+                        limit: Optional[int] = None,
+                        timeout: Optional[int] = None,
+                        allowed_updates: Optional[Iterable[str]] = None,
+                        concurrency: int = 1,
+                        shards: Optional[int] = None,
+                        **kwargs):
+        """run all bots in long loop model on one event loop in the current process.
+
+        Args:
+            concurrency (int): the max number of chats dispatched at the same time per bot
+            shards (Optional[int]): dispatch updates in this number of worker processes
+                partitioned by chat id, see TelegramShards
+            kwargs: other kwargs of telegram bot api 'getUpdates'
+        """
+        if not timeout:
+            logger.warning(
+                "You are using 0 as timeout in seconds for long polling which should be used for testing purposes only."
+            )
+        if not shards:
+            asyncio.run(
+                self.polling_all(limit=limit,
+                                 timeout=timeout,
+                                 allowed_updates=allowed_updates,
+                                 concurrency=concurrency,
+                                 **kwargs))
+            return
+        sharded = TelegramShards(self, workers=shards)
+        sharded.start()
+        asyncio.run(
+            self.__run_sharded(
+                sharded,
+                # a chat in flight holds a worker slot until it is acked
+                self.polling_all(limit=limit,
+                                 timeout=timeout,
+                                 allowed_updates=allowed_updates,
+                                 concurrency=max(concurrency,
+                                                 sharded.concurrency),
+                                 dispatch=sharded.dispatch,
+                                 **kwargs)))
+
+    @staticmethod
+    async def __run_sharded(sharded: TelegramShards, front: Awaitable):
+        try:
+            await front
+        finally:
+            await sharded.stop()
+
+    def run_webhook(self,
+                    host: str = "0.0.0.0",
+                    port: int = 8000,
+                    path_prefix: str = "/bot/",
+                    secret_token: Optional[str] = None,
+                    shards: Optional[int] = None,
+                    **kwargs):
+        """serve a built-in webhook server which dispatches updates posted to '{path_prefix}{token}'.
+
+        Args:
+            shards (Optional[int]): dispatch updates in this number of worker processes
+                partitioned by chat id, see TelegramShards
+            kwargs: other kwargs of TelegramWebhookServer, such as workers, backlog and ssl_context
+        """
+        if not shards:
+            asyncio.run(
+                TelegramWebhookServer(self,
+                                      host=host,
+                                      port=port,
+                                      path_prefix=path_prefix,
+                                      secret_token=secret_token,
+                                      **kwargs).serve_forever())
+            return
+        sharded = TelegramShards(self, workers=shards)
+        sharded.start()
+        # a webhook worker waits for the ack of its update
+        kwargs.setdefault("workers", sharded.concurrency)
+        asyncio.run(
+            self.__run_sharded(
+                sharded,
+                TelegramWebhookServer(self,
+                                      host=host,
+                                      port=port,
+                                      path_prefix=path_prefix,
+                                      secret_token=secret_token,
+                                      dispatch=sharded.dispatch,
+                                      **kwargs).serve_forever()))
 
 
 # default bot proxy
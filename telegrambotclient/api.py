@@ -3,10 +3,19 @@ try:
 except ImportError:
     import json
 
+import asyncio
+import binascii
 import logging
+import os
+import random
 import socket
+import ssl
+import threading
+import time
+from collections import deque
 from io import BytesIO
-from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+from typing import (Any, AsyncIterator, Awaitable, Callable, Dict, Iterable,
+                    Iterator, List, Optional, Tuple, Union)
 
 import urllib3
 
@@ -14,21 +23,27 @@ from telegrambotclient.base import (InputFile, InputMedia, LabeledPrice,
                                     Message, PassportElementError,
                                     TelegramBotException, TelegramObject,
                                     Update)
-from telegrambotclient.utils import exclude_none, pretty_format
+from telegrambotclient.utils import exclude_none, payload_tracer
 
 logger = logging.getLogger("telegram-bot-client")
 
 
 class TelegramBotAPIException(TelegramBotException):
-    __slots__ = ("_status_code", "_ok", "_error_code", "_description")
+    __slots__ = ("_status_code", "_ok", "_error_code", "_description",
+                 "_parameters")
 
-    def __init__(self, status_code: int, ok: bool, error_code: int,
-                 description: str) -> None:
+    def __init__(self,
+                 status_code: int,
+                 ok: bool,
+                 error_code: int,
+                 description: str,
+                 parameters: Optional[Dict] = None) -> None:
         super().__init__(description)
         self._status_code = status_code
         self._ok = ok
         self._error_code = error_code
         self._description = description
+        self._parameters = parameters or {}
 
     @property
     def status_code(self):
@@ -46,6 +61,20 @@ class TelegramBotAPIException(TelegramBotException):
     def description(self):
         return self._description
 
+    @property
+    def parameters(self) -> Dict:
+        return self._parameters
+
+    @property
+    def retry_after(self) -> Optional[int]:
+        """seconds to wait before the request can be repeated after flood control"""
+        return self._parameters.get("retry_after", None)
+
+    @property
+    def migrate_to_chat_id(self) -> Optional[int]:
+        """the new id of a group which has been migrated to a supergroup"""
+        return self._parameters.get("migrate_to_chat_id", None)
+
     def __str__(self) -> str:
         return """
 ----------------------- TelegramBotAPIException BEGIN-------------------------
@@ -53,12 +82,175 @@ status: {0}
 ok: {1}
 error_code: {2}
 description: {3}
+parameters: {4}
 ----------------------- TelegramBotAPIException END --------------------------
-""".format(self.status_code, self.ok, self.error_code, self.description)
+""".format(self.status_code, self.ok, self.error_code, self.description,
+           self.parameters)
+
+
+class TelegramRetryPolicy:
+    """
+    When and how long to wait before a failed API call is repeated.
+    A 429 is repeated after its retry_after for every method, sendXXX included, because the
+    request was not performed. Any other error, a 5xx, a connection error or a timeout, is only
+    repeated for idempotent methods whose names start with get, set, delete, edit, pin or unpin,
+    after an exponential backoff with full jitter, while the bot token has retry budget left.
+    Each retry of those costs one from the budget and each successful call earns budget_ratio back,
+    so retries can not amplify an outage.
+    Sync calls wait with time.sleep, a sync handler which runs on the event loop blocks
+    every other update while it waits, so run sync handlers in a thread pool or call the
+    async API when there is a retry policy.
+    Attributes:
+        _max_retries: the max number of retries of a call
+        _min_backoff: seconds of the first backoff
+        _max_backoff: the max seconds of a backoff
+        _max_retry_after: a longer retry_after is raised instead of waiting
+        _budget: the max retry budget of a bot token
+        _budget_ratio: budget earned by a successful call
+        _budgets: {token: the current retry budget}
+    """
+
+    __slots__ = ("_max_retries", "_min_backoff", "_max_backoff",
+                 "_max_retry_after", "_budget", "_budget_ratio", "_budgets",
+                 "_lock")
+    # real api names of methods which could be repeated safely
+    _idempotent_prefixes = ("get", "set", "delete", "edit", "pin", "unpin")
+    # ssl.SSLError and socket.gaierror are OSErrors, listed for the sake of readers
+    _transient_errors = (ConnectionError, TimeoutError, asyncio.TimeoutError,
+                         asyncio.IncompleteReadError, ssl.SSLError,
+                         socket.gaierror, OSError,
+                         urllib3.exceptions.HTTPError)
+
+    def __init__(self,
+                 max_retries: int = 3,
+                 min_backoff: float = 0.5,
+                 max_backoff: float = 10,
+                 max_retry_after: float = 60,
+                 budget: float = 10,
+                 budget_ratio: float = 0.1):
+        self._max_retries = max_retries
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+        self._max_retry_after = max_retry_after
+        self._budget = budget
+        self._budget_ratio = budget_ratio
+        self._budgets = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def is_idempotent(cls, api_name: str) -> bool:
+        return api_name.startswith(cls._idempotent_prefixes)
+
+    def record_success(self, token: str):
+        with self._lock:
+            budget = self._budgets.get(token, self._budget)
+            if budget < self._budget:
+                self._budgets[token] = min(budget + self._budget_ratio,
+                                           self._budget)
+
+    def __spend_budget(self, token: str) -> bool:
+        with self._lock:
+            budget = self._budgets.get(token, self._budget)
+            if budget < 1:
+                return False
+            self._budgets[token] = budget - 1
+            return True
+
+    def retry_delay(self, token: str, api_name: str, attempt: int,
+                    error: Exception) -> Optional[float]:
+        """seconds to wait before the attempt-th retry, None if the error should be raised"""
+        if attempt >= self._max_retries:
+            return None
+        if isinstance(error, TelegramBotAPIException):
+            if error.error_code == 429 and error.retry_after is not None:
+                if error.retry_after > self._max_retry_after:
+                    return None
+                return error.retry_after
+            if error.status_code < 500:
+                return None
+        elif not isinstance(error, self._transient_errors):
+            return None
+        if not self.is_idempotent(api_name) or not self.__spend_budget(token):
+            return None
+        return random.uniform(
+            0, min(self._max_backoff, self._min_backoff * 2**attempt))
+
+
+class _MultipartEncoder:
+    """
+    A multipart/form-data body which is generated in chunks while it is being sent,
+    files are never loaded into memory as a whole. It can be iterated again to retry.
+    Attributes:
+        content_type: the value of header Content-Type with the boundary
+        content_length: the size in bytes of the whole body, None if a file is a stream
+            of an unknown size, then the body is sent with a chunked transfer encoding
+        _parts: (header bytes, a field value in bytes or an InputFile)
+    """
+
+    __slots__ = ("content_type", "content_length", "_boundary", "_parts",
+                 "_chunk_size")
+
+    def __init__(self,
+                 fields: Dict,
+                 files: Iterable[Tuple[str, InputFile]],
+                 chunk_size: int = 65536):
+        self._boundary = binascii.hexlify(os.urandom(16)).decode("ascii")
+        self._chunk_size = chunk_size
+        self._parts = []
+        for name, value in fields.items():
+            if not isinstance(value, (bytes, str)):
+                value = str(value)
+            self._parts.append(
+                (self.__part_header(name), value.encode("utf-8") if isinstance(
+                    value, str) else value))
+        for name, input_file in files:
+            self._parts.append((self.__part_header(
+                name, input_file.file_name, input_file.mime_type
+                or "application/octet-stream"), input_file))
+        self.content_type = "multipart/form-data; boundary={0}".format(
+            self._boundary)
+        sizes = tuple(
+            value.size if isinstance(value, InputFile) else len(value)
+            for _, value in self._parts)
+        self.content_length = None if None in sizes else sum(
+            len(header) + size + 2
+            for (header, _), size in zip(self._parts, sizes)) + len(
+                self.__tail())
+
+    @property
+    def repeatable(self) -> bool:
+        """whether the body can be sent again"""
+        return all(value.repeatable for _, value in self._parts
+                   if isinstance(value, InputFile))
+
+    def __part_header(self,
+                      name: str,
+                      file_name: Optional[str] = None,
+                      mime_type: Optional[str] = None) -> bytes:
+        disposition = 'form-data; name="{0}"'.format(name.replace('"', "%22"))
+        header = "--{0}\r\nContent-Disposition: {1}".format(
+            self._boundary, disposition)
+        if file_name is not None:
+            header += '; filename="{0}"\r\nContent-Type: {1}'.format(
+                file_name.replace('"', "%22"), mime_type)
+        return "{0}\r\n\r\n".format(header).encode("utf-8")
+
+    def __tail(self) -> bytes:
+        return "--{0}--\r\n".format(self._boundary).encode("ascii")
+
+    def __iter__(self) -> Iterator[bytes]:
+        for header, value in self._parts:
+            yield header
+            if isinstance(value, InputFile):
+                yield from value.iter_chunks(self._chunk_size)
+            else:
+                yield value
+            yield b"\r\n"
+        yield self.__tail()
 
 
 class TelegramBotAPICaller:
-    __slots__ = ("_pool", )
+    __slots__ = ("_pool", "_api_host")
     _json_header = {"Content-Type": "application/json"}
 
     def __init__(self,
@@ -77,6 +269,7 @@ class TelegramBotAPICaller:
             urllib3.connection.HTTPConnection.default_socket_options + [
                 (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
             ])
+        self._api_host = api_host
         if api_host.lower().startswith("https://"):
             self._pool = urllib3.HTTPSConnectionPool(host=api_host[8:],
                                                      maxsize=maxsize,
@@ -86,6 +279,10 @@ class TelegramBotAPICaller:
             raise TelegramBotException(
                 "Telegram Bot API's URL only supports https://")
 
+    @property
+    def api_host(self) -> str:
+        return self._api_host
+
     def call(self,
              api_url: str,
              data: Optional[Dict] = None,
@@ -99,48 +296,533 @@ class TelegramBotAPICaller:
                 body=json.dumps(data).encode("utf-8"),
                 headers=self._json_header,
             )
-        for _ in files:
-            data[_[0]] = _[1]
-        return self._pool.request("POST", api_url, fields=data)
+        body = _MultipartEncoder(data, files)
+        if body.content_length is None:
+            return self._pool.urlopen(
+                "POST",
+                api_url,
+                body=body,
+                headers={"Content-Type": body.content_type},
+                chunked=True,
+                retries=False,
+            )
+        return self._pool.urlopen(
+            "POST",
+            api_url,
+            body=body,
+            headers={
+                "Content-Type": body.content_type,
+                "Content-Length": str(body.content_length),
+            },
+        )
+
+    def fetch_file_data(self, file_url: str, chunk_size: int = 65536) -> bytes:
+        return b"".join(self.stream_file(file_url, chunk_size))
 
-    def fetch_file_data(self, file_url: str, chunk_size: int = 128) -> bytes:
-        response = self._pool.request("GET", file_url, preload_content=False)
+    def stream_file(self,
+                    file_url: str,
+                    chunk_size: int = 65536,
+                    offset: int = 0) -> Iterator[bytes]:
+        """iterate a file's content in chunks, from offset with a Range request"""
+        response = self._pool.request(
+            "GET",
+            file_url,
+            headers={"Range": "bytes={0}-".format(offset)} if offset else None,
+            preload_content=False)
         try:
-            if response.status != 200:
+            if offset and response.status == 416:
+                # nothing left after offset
+                return
+            if response.status not in (200, 206):
                 raise TelegramBotException("""
 HTTP Status Code: {0}
 Reason: {1}""".format(response.status, response.reason))
-            with BytesIO() as _:
-                for chunk in response.stream(chunk_size):
-                    _.write(chunk)
-                return _.getvalue()
+            # the server might ignore Range and send the whole file
+            skip = offset if response.status == 200 else 0
+            for chunk in response.stream(chunk_size):
+                if skip:
+                    if len(chunk) <= skip:
+                        skip -= len(chunk)
+                        continue
+                    chunk, skip = chunk[skip:], 0
+                yield chunk
         finally:
             response.release_conn()
 
 
+class _AsyncHTTPResponse:
+    __slots__ = ("status", "reason", "headers", "data", "will_close")
+
+    def __init__(self, status: int, reason: str, headers: Dict, data: bytes,
+                 will_close: bool):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.data = data
+        self.will_close = will_close
+
+
+class TelegramBotAsyncAPICaller:
+    """
+    An asyncio streams based caller, calls are awaitable and share keep-alive
+    connections, so many in-flight API calls do not block the event loop.
+    Attributes:
+        _host: the Bot API host
+        _port: the Bot API port, 443 by default
+        _maxsize: the max number of idle keep-alive connections
+        _timeout: seconds to wait for a whole request or for every read of a streamed file,
+            90 by default which is longer than the timeout of a long polling getUpdates,
+            None means no limit
+        _ssl_context: the ssl context used to open connections
+        _idle_connections: idle keep-alive connections
+    """
+    __slots__ = ("_host", "_port", "_maxsize", "_timeout", "_ssl_context",
+                 "_idle_connections")
+    _idempotent_methods = ("GET", "HEAD")
+    _headers = {
+        "connection": "keep-alive",
+        "user-agent": "simple-bot: A Telegram Bot API Python Provider",
+    }
+
+    def __init__(self,
+                 api_host: str = "https://api.telegram.org",
+                 maxsize: int = 10,
+                 timeout: Optional[float] = 90,
+                 ssl_context: Optional[ssl.SSLContext] = None):
+        if not api_host.lower().startswith("https://"):
+            raise TelegramBotException(
+                "Telegram Bot API's URL only supports https://")
+        host, _, port = api_host[8:].rstrip("/").partition(":")
+        self._host = host
+        self._port = int(port) if port else 443
+        self._maxsize = maxsize
+        self._timeout = timeout
+        self._ssl_context = ssl_context or ssl.create_default_context()
+        self._idle_connections = deque()
+
+    async def __acquire(
+            self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter, bool]:
+        loop = asyncio.get_event_loop()
+        while self._idle_connections:
+            conn_loop, reader, writer = self._idle_connections.pop()
+            if (conn_loop is loop and not writer.is_closing()
+                    and not reader.at_eof()):
+                return reader, writer, True
+            self.__close(writer)
+        reader, writer = await asyncio.open_connection(
+            self._host,
+            self._port,
+            ssl=self._ssl_context,
+            server_hostname=self._host)
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        return reader, writer, False
+
+    def __release(self, reader: asyncio.StreamReader,
+                  writer: asyncio.StreamWriter):
+        if len(self._idle_connections) >= self._maxsize:
+            self.__close(writer)
+            return
+        self._idle_connections.append(
+            (asyncio.get_event_loop(), reader, writer))
+
+    @staticmethod
+    def __close(writer: asyncio.StreamWriter):
+        try:
+            writer.close()
+        except RuntimeError:
+            # the loop which opened this connection has gone
+            pass
+
+    @staticmethod
+    async def __iter_chunked(reader: asyncio.StreamReader,
+                             chunk_size: int) -> AsyncIterator[bytes]:
+        while True:
+            size_line = await reader.readline()
+            size = int(size_line.split(b";", 1)[0].strip(), 16)
+            if size == 0:
+                # skip trailers
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return
+            while size:
+                chunk = await reader.readexactly(min(size, chunk_size))
+                size -= len(chunk)
+                yield chunk
+            await reader.readexactly(2)
+
+    @staticmethod
+    async def __iter_sized(reader: asyncio.StreamReader, size: int,
+                           chunk_size: int) -> AsyncIterator[bytes]:
+        while size:
+            chunk = await reader.readexactly(min(size, chunk_size))
+            size -= len(chunk)
+            yield chunk
+
+    @staticmethod
+    async def __iter_until_eof(reader: asyncio.StreamReader,
+                               chunk_size: int) -> AsyncIterator[bytes]:
+        while True:
+            chunk = await reader.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    @staticmethod
+    async def __read_head(reader: asyncio.StreamReader) -> Tuple:
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed by the server")
+        version, status, reason = (status_line.decode("latin-1").rstrip(
+            "\r\n").split(" ", 2) + [""])[:3]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        will_close = (headers.get("connection", "").lower() == "close"
+                      or version == "HTTP/1.0")
+        return int(status), reason, headers, will_close
+
+    @classmethod
+    def __iter_body(cls, reader: asyncio.StreamReader, headers: Dict,
+                    chunk_size: int) -> Tuple[AsyncIterator[bytes], bool]:
+        """an iterator of a response body, and whether the connection closes after it"""
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            return cls.__iter_chunked(reader, chunk_size), False
+        if "content-length" in headers:
+            return cls.__iter_sized(reader, int(headers["content-length"]),
+                                    chunk_size), False
+        return cls.__iter_until_eof(reader, chunk_size), True
+
+    @classmethod
+    async def __read_response(
+            cls, reader: asyncio.StreamReader) -> _AsyncHTTPResponse:
+        status, reason, headers, will_close = await cls.__read_head(reader)
+        body, close_after_body = cls.__iter_body(reader, headers, 65536)
+        with BytesIO() as data:
+            async for chunk in body:
+                data.write(chunk)
+            return _AsyncHTTPResponse(status, reason, headers,
+                                      data.getvalue(), will_close
+                                      or close_after_body)
+
+    def __build_request(self, method: str, url: str,
+                        body: Union[bytes, _MultipartEncoder],
+                        headers: Dict) -> bytes:
+        """the request head, and the body if it is bytes"""
+        head = ["{0} {1} HTTP/1.1".format(method, url),
+                "host: {0}".format(self._host)]
+        for name, value in self._headers.items():
+            head.append("{0}: {1}".format(name, value))
+        for name, value in headers.items():
+            head.append("{0}: {1}".format(name, value))
+        if isinstance(body, _MultipartEncoder):
+            head.append("content-type: {0}".format(body.content_type))
+            if body.content_length is None:
+                head.append("transfer-encoding: chunked")
+            else:
+                head.append("content-length: {0}".format(
+                    body.content_length))
+            return "\r\n".join(head).encode("latin-1") + b"\r\n\r\n"
+        head.append("content-length: {0}".format(len(body)))
+        return "\r\n".join(head).encode("latin-1") + b"\r\n\r\n" + body
+
+    async def __write_request(self, writer: asyncio.StreamWriter,
+                              request: bytes,
+                              body: Union[bytes, _MultipartEncoder]):
+        writer.write(request)
+        if isinstance(body, _MultipartEncoder):
+            chunked = body.content_length is None
+            for chunk in body:
+                if chunked:
+                    if not chunk:
+                        continue
+                    writer.write(b"%x\r\n" % len(chunk))
+                writer.write(chunk)
+                if chunked:
+                    writer.write(b"\r\n")
+                await writer.drain()
+            if chunked:
+                writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def __send(self, method: str, url: str,
+                     body: Union[bytes, _MultipartEncoder],
+                     headers: Dict) -> _AsyncHTTPResponse:
+        request = self.__build_request(method, url, body, headers)
+        # a reused keep-alive connection might have been closed by the server meanwhile,
+        # so a request which could not be written is retried once on a fresh connection,
+        # unless its body is a stream which can not be read again.
+        # After it is written, only an idempotent request is retried, the server might
+        # have handled a POST such as sendMessage before the connection was lost.
+        repeatable = not isinstance(body,
+                                    _MultipartEncoder) or body.repeatable
+        while True:
+            reader, writer, reused = await self.__acquire()
+            try:
+                await self.__write_request(writer, request, body)
+            except ConnectionError:
+                self.__close(writer)
+                if reused and repeatable:
+                    continue
+                raise
+            except BaseException:
+                self.__close(writer)
+                raise
+            try:
+                response = await self.__read_response(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.__close(writer)
+                if reused and method in self._idempotent_methods:
+                    continue
+                raise
+            except BaseException:
+                self.__close(writer)
+                raise
+            if response.will_close:
+                self.__close(writer)
+            else:
+                self.__release(reader, writer)
+            return response
+
+    async def __wait(self, awaitable: Awaitable):
+        if self._timeout is None:
+            return await awaitable
+        return await asyncio.wait_for(awaitable, self._timeout)
+
+    async def request(self,
+                      method: str,
+                      url: str,
+                      body: Union[bytes, _MultipartEncoder] = b"",
+                      headers: Optional[Dict] = None) -> _AsyncHTTPResponse:
+        return await self.__wait(self.__send(method, url, body, headers
+                                             or {}))
+
+    async def call(self,
+                   api_url: str,
+                   data: Optional[Dict] = None,
+                   files: Optional[List] = None) -> _AsyncHTTPResponse:
+        if data is None:
+            data = {}
+        if not files:
+            return await self.request(
+                "POST",
+                api_url,
+                body=json.dumps(data).encode("utf-8"),
+                headers=TelegramBotAPICaller._json_header,
+            )
+        return await self.request("POST",
+                                  api_url,
+                                  body=_MultipartEncoder(data, files))
+
+    async def fetch_file_data(self, file_url: str) -> bytes:
+        response = await self.request("GET", file_url)
+        if response.status != 200:
+            raise TelegramBotException("""
+HTTP Status Code: {0}
+Reason: {1}""".format(response.status, response.reason))
+        return response.data
+
+    async def __open_stream(self, request: bytes) -> Tuple:
+        """send a GET request and read its response head, it is idempotent to retry"""
+        while True:
+            reader, writer, reused = await self.__acquire()
+            try:
+                writer.write(request)
+                await writer.drain()
+                status, reason, headers, will_close = await self.__read_head(
+                    reader)
+                return reader, writer, status, reason, headers, will_close
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.__close(writer)
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                self.__close(writer)
+                raise
+
+    async def stream_file(self,
+                          file_url: str,
+                          chunk_size: int = 65536,
+                          offset: int = 0) -> AsyncIterator[bytes]:
+        """iterate a file's content in chunks, from offset with a Range request"""
+        request = self.__build_request(
+            "GET", file_url, b"",
+            {"range": "bytes={0}-".format(offset)} if offset else {})
+        reader, writer, status, reason, headers, will_close = await self.__wait(
+            self.__open_stream(request))
+        finished = False
+        try:
+            body, close_after_body = self.__iter_body(reader, headers,
+                                                      chunk_size)
+            will_close = will_close or close_after_body
+            if offset and status == 416:
+                # nothing left after offset
+                async for _ in body:
+                    pass
+                finished = True
+                return
+            if status not in (200, 206):
+                raise TelegramBotException("""
+HTTP Status Code: {0}
+Reason: {1}""".format(status, reason))
+            # the server might ignore Range and send the whole file
+            skip = offset if status == 200 else 0
+            while True:
+                # the timeout is of every read, a whole file might take longer
+                try:
+                    chunk = await self.__wait(body.__anext__())
+                except StopAsyncIteration:
+                    break
+                if skip:
+                    if len(chunk) <= skip:
+                        skip -= len(chunk)
+                        continue
+                    chunk, skip = chunk[skip:], 0
+                yield chunk
+            finished = True
+        finally:
+            # a connection with an unread body can not be reused
+            if finished and not will_close:
+                self.__release(reader, writer)
+            else:
+                self.__close(writer)
+
+    async def close(self):
+        while self._idle_connections:
+            _, _, writer = self._idle_connections.pop()
+            self.__close(writer)
+
+
+class TelegramRateLimiter:
+    """
+    Token buckets of Telegram's flood limits, a global bucket per bot token and a bucket per
+    chat of a token, groups and channels (negative or '@name' chat_ids) have their own rate.
+    acquire() reserves the next free slot of the buckets and returns seconds to wait, so
+    concurrent callers are spread out instead of being rejected with 429.
+    Buckets are generic cell rate algorithm states: the time when the next call is free.
+    Attributes:
+        _global_rate: calls per second of a token
+        _chat_rate: calls per second to a private chat
+        _group_rate: calls per second to a group or a channel
+        _bursts: calls which could be made at once by (global, chat, group) buckets
+        _buckets: {token or (token, chat_id): the time when the next call is free}
+    """
+
+    __slots__ = ("_global_rate", "_chat_rate", "_group_rate", "_bursts",
+                 "_buckets", "_lock")
+    _max_buckets = 65536
+    # sending methods which count in the flood limits
+    _limited_apis = ("forwardmessage", "copymessage")
+
+    def __init__(self,
+                 global_rate: float = 30,
+                 chat_rate: float = 1,
+                 group_rate: float = 20 / 60,
+                 global_burst: int = 1,
+                 chat_burst: int = 3,
+                 group_burst: int = 3):
+        self._global_rate = global_rate
+        self._chat_rate = chat_rate
+        self._group_rate = group_rate
+        self._bursts = (global_burst, chat_burst, group_burst)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def is_limited(cls, api_name: str) -> bool:
+        return (api_name.startswith("send") and api_name != "sendchataction"
+                ) or api_name in cls._limited_apis
+
+    @staticmethod
+    def parse_chat_id(chat_id) -> Tuple:
+        """return (chat_id, is_group), a str is an @username of a channel or a supergroup
+        unless it is a number, negative ids are groups"""
+        if isinstance(chat_id, str):
+            try:
+                chat_id = int(chat_id)
+            except ValueError:
+                return chat_id, True
+        return chat_id, chat_id < 0
+
+    def acquire(self, token: str, api_name: str, data: Optional[Dict]) -> float:
+        """reserve a call and return seconds to wait before making it"""
+        if not self.is_limited(api_name):
+            return 0
+        chat_id = data.get("chat_id", None) if data else None
+        limits = [(token, self._global_rate, self._bursts[0])]
+        if chat_id is not None:
+            # "123" and 123 are the same chat
+            chat_id, is_group = self.parse_chat_id(chat_id)
+            limits.append(
+                ((token, chat_id), self._group_rate if is_group else
+                 self._chat_rate, self._bursts[2 if is_group else 1]))
+        with self._lock:
+            now = time.monotonic()
+            start = now
+            for key, rate, burst in limits:
+                free_at = self._buckets.get(key, now)
+                start = max(start, free_at - (burst - 1) / rate)
+            for key, rate, _ in limits:
+                self._buckets[key] = max(self._buckets.get(key, now),
+                                         start) + 1 / rate
+            if len(self._buckets) > self._max_buckets:
+                # a bucket which is free now is the same as a new one
+                self._buckets = {
+                    key: free_at
+                    for key, free_at in self._buckets.items() if free_at > now
+                }
+        return start - now
+
+
 class TelegramBotAPI:
 
     __version__ = "5.2.1"
     _api_url = "/bot{0}/{1}"
     _download_file_url = "/file/bot{0}/{1}"
-    __slots__ = ("_api_caller", )
+    __slots__ = ("_api_caller", "_rate_limiter", "_retry_policy")
 
-    def __init__(self, http_request: Optional[TelegramBotAPICaller] = None):
+    def __init__(self,
+                 http_request: Optional[Union[TelegramBotAPICaller,
+                                              TelegramBotAsyncAPICaller]] = None,
+                 rate_limiter: Optional[TelegramRateLimiter] = None,
+                 retry_policy: Optional[TelegramRetryPolicy] = None):
         self._api_caller = http_request or TelegramBotAPICaller()
+        # calls are shaped to Telegram's flood limits if there is a rate limiter
+        self._rate_limiter = rate_limiter
+        # failed calls are raised at once if there is no retry policy
+        self._retry_policy = retry_policy
+
+    @property
+    def rate_limiter(self) -> Optional[TelegramRateLimiter]:
+        return self._rate_limiter
+
+    @property
+    def retry_policy(self) -> Optional[TelegramRetryPolicy]:
+        return self._retry_policy
+
+    @property
+    def api_host(self) -> Optional[str]:
+        return getattr(self._api_caller, "api_host", None)
 
     @staticmethod
     def __check_response(response):
-        if response.status == 500:
-            raise TelegramBotException(response.data)
-        json_response = json.loads(response.data.decode("utf-8"))
-        logger.debug(
-            """
------------------------ JSON RESPONSE BEGIN ---------------------------
-%s
------------------------ JSON RESPONSE  END  ---------------------------
-        """,
-            pretty_format(json_response),
-        )
+        try:
+            json_response = json.loads(response.data.decode("utf-8"))
+        except ValueError:
+            # such as an html page of a proxy's 5xx
+            raise TelegramBotAPIException(
+                status_code=response.status,
+                ok=False,
+                error_code=response.status,
+                description=response.data.decode("utf-8", "replace"),
+            )
+        payload_tracer.trace("JSON RESPONSE", json_response)
         if response.status == 200:
             result = json_response["result"]
             if isinstance(result, dict):
@@ -148,11 +830,60 @@ class TelegramBotAPI:
             return result
         raise TelegramBotAPIException(
             status_code=response.status,
-            ok=json_response["ok"],
-            error_code=json_response["error_code"],
-            description=json_response["description"],
+            ok=json_response.get("ok", False),
+            error_code=json_response.get("error_code", response.status),
+            description=json_response.get("description", ""),
+            parameters=json_response.get("parameters", None),
         )
 
+    def __acquire(self, token: str, api_name: str,
+                  data: Optional[Dict]) -> float:
+        return self._rate_limiter.acquire(
+            token, api_name, data) if self._rate_limiter else 0
+
+    def __retry_delay(self, token: str, api_name: str, attempt: int,
+                      error: Exception,
+                      files: Optional[List]) -> Optional[float]:
+        if self._retry_policy is None:
+            return None
+        if files and not all(input_file.repeatable
+                             for _, input_file in files):
+            # a stream which can not seek has been read
+            return None
+        delay = self._retry_policy.retry_delay(token, api_name, attempt,
+                                               error)
+        if delay is not None:
+            logger.warning("%s failed: %r, retry in %.2fs", api_name, error,
+                           delay)
+        return delay
+
+    async def __call_async_api(self, token: str, api_name: str,
+                               data: Optional[Dict], files: Optional[List]):
+        # the slot is reserved once the call is awaited, a coroutine which is created
+        # but awaited later or never does not hold a slot of the rate limiter
+        delay = self.__acquire(token, api_name, data)
+        attempt = 0
+        while True:
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                result = self.__check_response(await self._api_caller.call(
+                    self._api_url.format(token, api_name), data, files))
+            except Exception as error:
+                delay = self.__retry_delay(token, api_name, attempt, error,
+                                           files)
+                if delay is None:
+                    raise
+                attempt += 1
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                # a retry is another call within the flood limits
+                delay = self.__acquire(token, api_name, data)
+                continue
+            if self._retry_policy is not None:
+                self._retry_policy.record_success(token)
+            return result
+
     @staticmethod
     def __prepare_request_data(api_name,
                                **kwargs) -> Tuple[str, Dict, Optional[List]]:
@@ -166,10 +897,10 @@ class TelegramBotAPI:
                 if attached_files is None:
                     attached_files = []
                 if name == "thumb":
-                    attached_files.append((value.attach_key, value.file_tuple))
+                    attached_files.append((value.attach_key, value))
                     form_data["thumb"] = value.attach_str
                 else:
-                    attached_files.append((name, value.file_tuple))
+                    attached_files.append((name, value))
                     del form_data[name]
         return api_name.replace("_", "").lower(), form_data, attached_files
 
@@ -180,9 +911,32 @@ class TelegramBotAPI:
         data: Optional[Dict] = None,
         files: Optional[List] = None,
     ):
-        return self.__check_response(
-            self._api_caller.call(self._api_url.format(token, api_name), data,
-                                  files))
+        if isinstance(self._api_caller, TelegramBotAsyncAPICaller):
+            # the request is not sent until the coroutine is awaited
+            return self.__call_async_api(token, api_name, data, files)
+        delay = self.__acquire(token, api_name, data)
+        attempt = 0
+        while True:
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                result = self.__check_response(
+                    self._api_caller.call(
+                        self._api_url.format(token, api_name), data, files))
+            except Exception as error:
+                delay = self.__retry_delay(token, api_name, attempt, error,
+                                           files)
+                if delay is None:
+                    raise
+                attempt += 1
+                if delay > 0:
+                    time.sleep(delay)
+                # a retry is another call within the flood limits
+                delay = self.__acquire(token, api_name, data)
+                continue
+            if self._retry_policy is not None:
+                self._retry_policy.record_success(token)
+            return result
 
     def __getattr__(self, api_name: str) -> Callable:
         def bot_api_method(token: str, **kwargs):
@@ -195,12 +949,22 @@ class TelegramBotAPI:
 
         return bot_api_method
 
-    def get_updates(self, token: str, **kwargs) -> Tuple[Update]:
+    def get_updates(self,
+                    token: str,
+                    update_class: Callable = Update,
+                    **kwargs) -> Tuple[Update]:
         if "allowed_updates" in kwargs:
             kwargs["allowed_updates"] = json.dumps(kwargs["allowed_updates"])
+        raw_updates = self.getupdates(token, **kwargs)
+        if asyncio.iscoroutine(raw_updates):
+            return self.__get_async_updates(raw_updates, update_class)
+        return tuple(update_class(**raw_update) for raw_update in raw_updates)
+
+    @staticmethod
+    async def __get_async_updates(raw_updates,
+                                  update_class: Callable) -> Tuple[Update]:
         return tuple(
-            Update(**raw_update)
-            for raw_update in self.getupdates(token, **kwargs))
+            update_class(**raw_update) for raw_update in await raw_updates)
 
     def set_webhook(self, token: str, **kwargs) -> bool:
         if "allowed_updates" in kwargs:
@@ -351,5 +1115,16 @@ class TelegramBotAPI:
                                files=attached_files)
 
     def get_file_bytes(self, token: str, file_path: str) -> bytes:
-        return self._http.fetch_file_data(
+        return self._api_caller.fetch_file_data(
             self._download_file_url.format(token, file_path))
+
+    def iter_file_chunks(
+            self,
+            token: str,
+            file_path: str,
+            chunk_size: int = 65536,
+            offset: int = 0) -> Union[Iterator[bytes], AsyncIterator[bytes]]:
+        """iterate a file's content in chunks, an async iterator with an async caller"""
+        return self._api_caller.stream_file(
+            self._download_file_url.format(token, file_path), chunk_size,
+            offset)
@@ -1,7 +1,10 @@
+import mmap
+import os
 import random
 import string
+from collections.abc import ItemsView, ValuesView
 from enum import Enum
-from typing import Any, Iterable, List, Optional, Union
+from typing import Any, BinaryIO, Iterable, Iterator, List, Optional, Union
 
 try:
     import ujson as json
@@ -175,29 +178,92 @@ class MIMEType(str, Enum):
 
 
 class InputFile:
-    __slots__ = ("_file_name", "_file", "_mime_type", "_attach_key")
+    """
+    A file to upload, it is read in chunks when a request is being sent.
+    A stream which can not seek, such as a pipe or a socket, has an unknown size and
+    is read once, it is uploaded with a chunked transfer encoding and not sent again.
+    Attributes:
+        _file: a file path, bytes, a mmap or a binary file object
+        _start: the position of a file object where the upload starts,
+            None if the file object can not seek
+    """
+
+    __slots__ = ("_file_name", "_file", "_mime_type", "_attach_key", "_start")
 
     def __init__(self,
                  file_name: str,
-                 file: Union[str, bytes],
+                 file: Union[str, bytes, mmap.mmap, BinaryIO],
                  mime_type: Optional[str] = None):
         self._file_name = file_name
-        if not isinstance(file, (str, bytes)):
-            raise ValueError("file must be a string or bytes")
+        if not isinstance(file, (str, bytes, bytearray, memoryview,
+                                 mmap.mmap)) and not hasattr(file, "read"):
+            raise ValueError(
+                "file must be a string, bytes, a mmap or a file object")
         self._file = file
         self._mime_type = mime_type
         self._attach_key = None
+        self._start = self.__start_of(file)
+
+    @staticmethod
+    def __start_of(file) -> Optional[int]:
+        if isinstance(file, (str, bytes, bytearray, memoryview, mmap.mmap)):
+            return 0
+        seekable = getattr(file, "seekable", None)
+        if seekable is not None and not seekable():
+            return None
+        try:
+            return file.tell()
+        except (AttributeError, OSError, ValueError):
+            return None
 
     @property
     def file_name(self) -> str:
         return self._file_name
 
+    @property
+    def file(self) -> Union[str, bytes, mmap.mmap, BinaryIO]:
+        return self._file
+
     @property
     def file_data(self) -> Optional[bytes]:
+        return b"".join(self.iter_chunks())
+
+    @property
+    def repeatable(self) -> bool:
+        """whether the content can be read again, to retry a request"""
+        return self._start is not None
+
+    @property
+    def size(self) -> Optional[int]:
+        """the size in bytes, None if it is a stream which can not seek"""
+        if self._start is None:
+            return None
+        if isinstance(self._file, str):
+            return os.path.getsize(self._file)
+        if isinstance(self._file, (bytes, bytearray, memoryview, mmap.mmap)):
+            return len(self._file)
+        try:
+            return os.fstat(self._file.fileno()).st_size - self._start
+        except (AttributeError, OSError, ValueError):
+            current = self._file.seek(0, os.SEEK_END)
+            self._file.seek(self._start)
+            return current - self._start
+
+    def iter_chunks(self, chunk_size: int = 65536) -> Iterator:
+        """iterate the file's content from its start every time it is called,
+        a stream which can not seek is only iterated from where it is"""
+        if isinstance(self._file, (bytes, bytearray, memoryview, mmap.mmap)):
+            content = memoryview(self._file)
+            for offset in range(0, len(content), chunk_size):
+                yield content[offset:offset + chunk_size]
+            return
         if isinstance(self._file, str):
             with open(self._file, "rb") as file_obj:
-                return file_obj.read()
-        return self._file
+                yield from iter(lambda: file_obj.read(chunk_size), b"")
+            return
+        if self._start is not None:
+            self._file.seek(self._start)
+        yield from iter(lambda: self._file.read(chunk_size), b"")
 
     @property
     def mime_type(self):
@@ -222,27 +288,50 @@ class InputFile:
         return "attach://{0}".format(self.attach_key)
 
 
+class _TelegramObjectList(list):
+    """a list whose dict items have been wrapped as TelegramObjects"""
+
+
+_MISSING = object()
+
+
 class TelegramObject(dict):
+    """
+    A dict with attribute access. Nested dicts and lists are kept as they are
+    and only wrapped as TelegramObjects when they are accessed at the first time.
+    """
     def __init__(self, **kwargs):
-        data = {
-            name: self.__recurse_init(value)
-            for name, value in kwargs.items()
-        }
-        if "from" in data:
-            data["from_user"] = data["from"]
-            del data["from"]
-        super().__init__(data)
+        if "from" in kwargs:
+            kwargs["from_user"] = kwargs.pop("from")
+        super().__init__(kwargs)
 
     @classmethod
-    def __recurse_init(cls, value) -> Any:
-        if isinstance(value, TelegramObject):
+    def __wrap(cls, value) -> Any:
+        if isinstance(value, (TelegramObject, _TelegramObjectList)):
             return value
         if isinstance(value, dict):
             return TelegramObject(**value)
         if isinstance(value, list):
-            return [cls.__recurse_init(item) for item in value]
+            return _TelegramObjectList(cls.__wrap(item) for item in value)
         return value
 
+    def get(self, name: str, default=None):
+        value = super().get(name, _MISSING)
+        if value is _MISSING:
+            return default
+        if isinstance(value, (dict, list)) and not isinstance(
+                value, (TelegramObject, _TelegramObjectList)):
+            value = self.__wrap(value)
+            super().__setitem__(name, value)
+        return value
+
+    def items(self) -> ItemsView:
+        # views like the ones of a dict, which read wrapped values by __getitem__
+        return ItemsView(self)
+
+    def values(self) -> ValuesView:
+        return ValuesView(self)
+
     def __hash__(self):
         return hash(tuple(self.items()))
 
@@ -276,7 +365,7 @@ Update = (Message) = (CallbackQuery) = (ChosenInlineResult) = (InlineQuery) = (
     CallbackGame
 ) = (
     GameHighScore
-) = VCard = ShippingQuery = PreCheckoutQuery = Poll = PollAnswer = TelegramObject
+) = VCard = ShippingQuery = PreCheckoutQuery = Poll = PollAnswer = ChatMemberUpdated = TelegramObject
 
 
 class MentionEntity(MessageEntity):
@@ -360,11 +449,11 @@ class InputMedia(TelegramObject):
         self._attached_files = []
         media = self.get("media", None)
         if media and isinstance(media, InputFile):
-            self._attached_files.append((media.attach_key, media.file_tuple))
+            self._attached_files.append((media.attach_key, media))
             self["media"] = media.attach_str
         thumb = self.get("thumb", None)
         if thumb and isinstance(thumb, InputFile):
-            self._attached_files.append((thumb.attach_key, thumb.file_tuple))
+            self._attached_files.append((thumb.attach_key, thumb))
             self["thumb"] = thumb.attach_str
         self._media_data = {
             name: value
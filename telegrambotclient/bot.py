@@ -1,32 +1,67 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import asyncio
+import contextvars
+import glob
+import hashlib
 import logging
 import os
-from typing import Callable, Dict, Iterable, Optional, Tuple
-
-from telegrambotclient.api import TelegramBotAPI, TelegramBotAPICaller
+import threading
+import time
+from collections import OrderedDict
+from typing import (Awaitable, Callable, Dict, Iterable, Optional, Tuple,
+                    Union)
+
+from telegrambotclient.api import (TelegramBotAPI, TelegramBotAPICaller,
+                                   TelegramBotAPIException,
+                                   TelegramBotAsyncAPICaller,
+                                   TelegramRateLimiter, TelegramRetryPolicy)
 from telegrambotclient.base import (InputFile, Message, TelegramBotException,
                                     Update)
-from telegrambotclient.storage import (MemoryStorage, TelegramSession,
-                                       TelegramStorage)
+from telegrambotclient.broadcast import BroadcastReport, TelegramBroadcast
+from telegrambotclient.storage import (FileIdCache, MemoryStorage,
+                                       TelegramSession, TelegramStorage)
 from telegrambotclient.utils import (build_force_reply_data,
-                                     parse_force_reply_data, pretty_format)
+                                     parse_force_reply_data, payload_tracer,
+                                     pretty_format, update_to_dict)
 
 logger = logging.getLogger("telegram-bot-client")
+# write-back sessions of the update being dispatched, {(bot id, user id): session}
+_update_sessions = contextvars.ContextVar("update_sessions", default=None)
 
 
 class TelegramBot:
     _force_reply_key_format = "bot:force_reply:{0}"
+    _no_force_reply_cache_size = 65536
+    _polling_state_key_format = "bot:polling:{0}"
+    _polling_state_expires = 604800
+    _dead_updates_key_format = "bot:dead_updates:{0}"
+    _dead_updates_expires = 604800
+    # seconds before the first retry of a failed update, doubled for every next retry
+    _update_retry_delay = 0.5
+    # parameters whose uploaded files come back as file_ids in the sent message
+    _file_id_params = ("photo", "audio", "document", "video", "animation",
+                       "voice", "video_note", "sticker")
     __slots__ = (
         "_bot_id",
         "_token",
         "_router",
         "_bot_api",
+        "_async_bot_api",
         "_storage",
         "_i18n_source",
         "last_update_id",
         "_bot_me",
+        "_polling_stop",
+        "_update_class",
+        "_write_back_sessions",
+        "_no_force_reply",
+        "_no_force_reply_lock",
+        "_force_reply_cache_ttl",
+        "_file_id_cache",
+        "_done_update_ids",
+        "_durable",
+        "_max_update_retries",
     )
 
     def __init__(
@@ -36,7 +71,25 @@ class TelegramBot:
         storage: Optional[TelegramStorage] = None,
         i18n_source: Optional[Dict] = None,
         api_caller: Optional[TelegramBotAPICaller] = None,
+        async_api_caller: Optional[TelegramBotAsyncAPICaller] = None,
+        update_class: Optional[Callable] = None,
+        write_back_sessions: bool = False,
+        force_reply_cache_ttl: float = 0,
+        cache_file_ids: bool = False,
+        rate_limiter: Optional[TelegramRateLimiter] = None,
+        retry_policy: Optional[TelegramRetryPolicy] = None,
+        max_update_retries: int = 2,
     ):
+        """
+        Args:
+            force_reply_cache_ttl (float): remember users who have no pending force reply for
+                this number of seconds, so most messages skip a storage read. A force reply
+                joined by another process sharing the storage is missed until the cache
+                expires, so only turn it on with one process per bot or when such a delay is
+                fine. 0 disables the cache, every message reads the storage.
+            max_update_retries (int): how many times an update whose handler raised is
+                dispatched again before it is saved as a dead update and dropped, see handle_update
+        """
         try:
             self._bot_id = int(token.split(":")[0])
         except IndexError as error:
@@ -56,11 +109,43 @@ class TelegramBot:
             assert isinstance(api_caller, TelegramBotAPICaller), True
         else:
             api_caller = TelegramBotAPICaller()
-        self._bot_api = TelegramBotAPI(api_caller)
+        # sync and async calls of a bot share the same flood limits
+        self._bot_api = TelegramBotAPI(api_caller, rate_limiter, retry_policy)
+        if async_api_caller:
+            assert isinstance(async_api_caller, TelegramBotAsyncAPICaller), True
+        else:
+            async_api_caller = TelegramBotAsyncAPICaller()
+        self._async_bot_api = TelegramBotAPI(async_api_caller, rate_limiter,
+                                             retry_policy)
         self.last_update_id = 0
         self._bot_me = None
+        self._polling_stop = None
+        # telegrambotclient.models.Update is a compact alternative of the dict based Update
+        self._update_class = update_class or Update
+        # sessions are loaded once per update and flushed in one batch after it is routed
+        self._write_back_sessions = write_back_sessions
+        # users who have no pending force reply, {user_id: expires on the monotonic clock}.
+        # force replies joined by this process are seen at once, by other processes
+        # sharing the storage in force_reply_cache_ttl seconds.
+        # Sync handlers run in threads, the cache is only touched behind its lock
+        self._no_force_reply = OrderedDict()
+        self._no_force_reply_lock = threading.Lock()
+        self._force_reply_cache_ttl = force_reply_cache_ttl
+        # uploaded InputFiles are sent by their file_ids at the next time
+        self._file_id_cache = FileIdCache(
+            self._storage, self._bot_id) if cache_file_ids else None
+        # update ids done after last_update_id, a batch fetched again skips them
+        self._done_update_ids = set()
+        # whether the polling state is persisted in the storage
+        self._durable = False
+        self._max_update_retries = max(max_update_retries, 0)
 
     def __getattr__(self, api_name):
+        bot_api = self._bot_api
+        if api_name.startswith("async_"):
+            # async_xxx are awaitable versions of xxx, such as async_send_message
+            bot_api = self._async_bot_api
+            api_name = api_name[6:]
         if api_name.startswith("reply"):
 
             def reply_method(message: Message, **kwargs):
@@ -75,16 +160,89 @@ class TelegramBot:
                     "chat_id": message.chat.id,
                     "reply_to_message_id": message.message_id,
                 })
-                return getattr(self._bot_api, "send{0}".format(
-                    api_name.split("reply")[1]))(self.token, **kwargs)
+                return self.__call_api(
+                    bot_api, "send{0}".format(api_name.split("reply")[1]),
+                    kwargs)
 
             return reply_method
 
         def api_method(**kwargs):
-            return getattr(self._bot_api, api_name)(self.token, **kwargs)
+            return self.__call_api(bot_api, api_name, kwargs)
 
         return api_method
 
+    def __call_api(self, bot_api: TelegramBotAPI, api_name: str,
+                   kwargs: Dict):
+        if self._file_id_cache is None:
+            return getattr(bot_api, api_name)(self.token, **kwargs)
+        if bot_api is self._async_bot_api:
+            return self.__async_call_api_with_file_ids(bot_api, api_name,
+                                                       kwargs)
+        cached_kwargs, uploads = self.__look_up_file_ids(kwargs)
+        try:
+            result = getattr(bot_api, api_name)(self.token, **cached_kwargs)
+        except TelegramBotAPIException as error:
+            if not self.__forget_file_ids(error, kwargs, cached_kwargs):
+                raise
+            return self.__call_api(bot_api, api_name, kwargs)
+        self.__cache_file_ids(uploads, result)
+        return result
+
+    def __look_up_file_ids(self, kwargs: Dict) -> Tuple[Dict, Dict]:
+        """kwargs with cached file_ids in place of InputFiles, and InputFiles to upload"""
+        uploads = {}
+        cached_kwargs = dict(kwargs)
+        for name in self._file_id_params:
+            input_file = kwargs.get(name, None)
+            if isinstance(input_file, InputFile):
+                file_id = self._file_id_cache.get(name, input_file)
+                if file_id:
+                    cached_kwargs[name] = file_id
+                else:
+                    uploads[name] = input_file
+        return cached_kwargs, uploads
+
+    async def __async_call_api_with_file_ids(self, bot_api: TelegramBotAPI,
+                                             api_name: str, kwargs: Dict):
+        # contents are hashed and the storage is called in the default executor,
+        # hashing a large file would block every other update on the loop
+        loop = asyncio.get_running_loop()
+        cached_kwargs, uploads = await loop.run_in_executor(
+            None, self.__look_up_file_ids, kwargs)
+        try:
+            result = await getattr(bot_api, api_name)(self.token,
+                                                      **cached_kwargs)
+        except TelegramBotAPIException as error:
+            if not await loop.run_in_executor(None, self.__forget_file_ids,
+                                              error, kwargs, cached_kwargs):
+                raise
+            return await self.__call_api(bot_api, api_name, kwargs)
+        await loop.run_in_executor(None, self.__cache_file_ids, uploads,
+                                   result)
+        return result
+
+    def __forget_file_ids(self, error: TelegramBotAPIException, kwargs: Dict,
+                          cached_kwargs: Dict) -> bool:
+        """forget rejected file_ids, return whether there is any to upload again"""
+        if (error.error_code != 400 or "file" not in str(
+                error.description).lower() or cached_kwargs == kwargs):
+            return False
+        for name in self._file_id_params:
+            if cached_kwargs.get(name, None) is not kwargs.get(name, None):
+                self._file_id_cache.delete(name, kwargs[name])
+        return True
+
+    def __cache_file_ids(self, uploads: Dict, result):
+        if not uploads or not isinstance(result, dict):
+            return
+        for name, input_file in uploads.items():
+            sent_file = result.get(name, None)
+            if isinstance(sent_file, list):
+                # the largest photo size is the last one
+                sent_file = sent_file[-1] if sent_file else None
+            if isinstance(sent_file, dict) and sent_file.get("file_id", None):
+                self._file_id_cache.set(name, input_file, sent_file["file_id"])
+
     @property
     def token(self) -> str:
         return self._token
@@ -93,6 +251,30 @@ class TelegramBot:
     def router(self):
         return self._router
 
+    @property
+    def update_class(self) -> Callable:
+        return self._update_class
+
+    @property
+    def storage(self) -> TelegramStorage:
+        return self._storage
+
+    @property
+    def i18n_source(self) -> Optional[Dict]:
+        return self._i18n_source
+
+    @property
+    def rate_limiter(self) -> Optional[TelegramRateLimiter]:
+        return self._async_bot_api.rate_limiter
+
+    @property
+    def retry_policy(self) -> Optional[TelegramRetryPolicy]:
+        return self._async_bot_api.retry_policy
+
+    @property
+    def api_host(self) -> Optional[str]:
+        return self._bot_api.api_host
+
     @property
     def id(self) -> int:
         return self._bot_id
@@ -124,15 +306,72 @@ class TelegramBot:
         return self.router.stop_call
 
     async def dispatch(self, update: Update):
-        logger.debug(
-            """
------------------------ UPDATE BEGIN ---------------------------
-%s
------------------------ UPDATE  END  ---------------------------
-""",
-            pretty_format(update),
-        )
-        await self._router.route(self, update)
+        payload_tracer.trace("UPDATE", update)
+        if not self._write_back_sessions:
+            await self._router.route(self, update)
+            return
+        sessions_token = _update_sessions.set({})
+        try:
+            await self._router.route(self, update)
+        finally:
+            sessions = _update_sessions.get()
+            _update_sessions.reset(sessions_token)
+            self.__flush_sessions(sessions.values())
+
+    async def handle_update(self, update: Update) -> bool:
+        """dispatch an update with the failure policy of every way updates come in:
+        polling, webhook, shard workers and update queue workers.
+        An update whose handler raised is dispatched again max_update_retries times after a
+        backoff, then it is logged and saved as a dead update, see dead_updates, and it is done
+        like a handled one, so a bad update never holds back the updates after it.
+
+        Returns:
+            bool: whether the update has been handled
+        """
+        for attempt in range(self._max_update_retries + 1):
+            try:
+                await self.dispatch(update)
+                return True
+            except Exception as error:
+                if attempt < self._max_update_retries:
+                    logger.warning("failed to dispatch update %s: %r, retry",
+                                   update.update_id, error)
+                    await asyncio.sleep(self._update_retry_delay * 2**attempt)
+                    continue
+                logger.exception(
+                    "failed to dispatch update %s for %s times, drop it: %s",
+                    update.update_id, attempt + 1,
+                    pretty_format(update_to_dict(update)))
+                try:
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, self.__save_dead_update, update, error)
+                except Exception:
+                    logger.exception("failed to save dead update %s",
+                                     update.update_id)
+        return False
+
+    def __save_dead_update(self, update: Update, error: Exception):
+        self._storage.set_value(
+            self._dead_updates_key_format.format(self._bot_id),
+            str(update.update_id), {
+                "update": update_to_dict(update),
+                "error": repr(error)
+            }, self._dead_updates_expires)
+
+    def dead_updates(self) -> Dict:
+        """updates dropped by handle_update in the last week,
+        {update_id: {"update": raw update, "error": repr of the last error}}"""
+        return self._storage.dict(
+            self._dead_updates_key_format.format(self._bot_id),
+            self._dead_updates_expires)
+
+    @staticmethod
+    def __flush_sessions(sessions: Iterable[TelegramSession]):
+        for session in sessions:
+            try:
+                session.flush()
+            except Exception:
+                logger.exception("failed to flush session: %s", session.id)
 
     def join_force_reply(
         self,
@@ -149,6 +388,8 @@ class TelegramBot:
                     force_reply_callback_name))
         field = self._force_reply_key_format.format(user_id)
         session = self.get_session(user_id)
+        with self._no_force_reply_lock:
+            self._no_force_reply.pop(user_id, None)
         if not force_reply_args:
             session.set(field,
                         build_force_reply_data(force_reply_callback_name),
@@ -164,19 +405,44 @@ class TelegramBot:
     def force_reply_done(self, user_id: int):
         session = self.get_session(user_id)
         del session[self._force_reply_key_format.format(user_id)]
+        self.__remember_no_force_reply(user_id)
 
     def get_force_reply(self, user_id: int) -> Tuple:
+        with self._no_force_reply_lock:
+            expires = self._no_force_reply.get(user_id, None)
+            if expires is not None:
+                if expires > time.monotonic():
+                    return None, None
+                self._no_force_reply.pop(user_id, None)
         session = self.get_session(user_id)
         force_reply_data = session.get(
             self._force_reply_key_format.format(user_id), None)
         if not force_reply_data:
+            self.__remember_no_force_reply(user_id)
             return None, None
         return parse_force_reply_data(force_reply_data)
 
+    def __remember_no_force_reply(self, user_id: int):
+        if not self._force_reply_cache_ttl:
+            return
+        with self._no_force_reply_lock:
+            self._no_force_reply[user_id] = (time.monotonic() +
+                                             self._force_reply_cache_ttl)
+            self._no_force_reply.move_to_end(user_id)
+            while len(self._no_force_reply) > self._no_force_reply_cache_size:
+                self._no_force_reply.popitem(last=False)
+
     def get_session(self,
                     user_id: int,
                     expires: int = 1800) -> TelegramSession:
-        return TelegramSession(self.id, user_id, self._storage, expires)
+        sessions = _update_sessions.get()
+        if sessions is None:
+            return TelegramSession(self.id, user_id, self._storage, expires)
+        session = sessions.get((self.id, user_id), None)
+        if session is None:
+            session = sessions[(self.id, user_id)] = TelegramSession(
+                self.id, user_id, self._storage, expires, write_back=True)
+        return session
 
     def get_text(self, lang_code: str, text: str) -> str:
         if self._i18n_source:
@@ -219,46 +485,358 @@ class TelegramBot:
             )
         return True
 
-    def download_file(self, src_file_path: str, save_to_file: str):
-        """download_file.
+    @staticmethod
+    def __open_part_file(src_file_path: str, save_to_file: str,
+                         resume: bool):
+        file_path = os.path.dirname(save_to_file)
+        if file_path and not os.path.exists(file_path):
+            os.makedirs(file_path, exist_ok=True)
+        # a part file is named by its source, so a part of another file saved to the same
+        # path is never resumed, parts of other sources are removed
+        part_file = "{0}.{1}.part".format(
+            save_to_file,
+            hashlib.sha1(src_file_path.encode("utf-8")).hexdigest()[:16])
+        stale_part_files = glob.glob("{0}.*.part".format(
+            glob.escape(save_to_file))) + ["{0}.part".format(save_to_file)]
+        for stale_part_file in stale_part_files:
+            if stale_part_file != part_file and os.path.exists(
+                    stale_part_file):
+                os.remove(stale_part_file)
+        offset = os.path.getsize(part_file) if resume and os.path.exists(
+            part_file) else 0
+        return part_file, offset, open(part_file, "ab" if offset else "wb")
+
+    def download_file(self,
+                      src_file_path: str,
+                      save_to_file: str,
+                      chunk_size: int = 65536,
+                      resume: bool = True):
+        """download a file in chunks to a part file next to save_to_file, then rename it to
+        save_to_file. An unfinished part file of the same src_file_path is resumed with a
+        Range request.
 
         Args:
-            src_file_path (str): src_file_path
+            src_file_path (str): file_path of a File
             save_to_file (str): save_to_file
+            chunk_size (int): bytes of a chunk in memory
+            resume (bool): whether to resume an unfinished part file
         """
-        file_path = os.path.dirname(save_to_file)
-        if not os.path.exists(file_path):
-            os.makedirs(file_path)
-        file_bytes = self.get_file_bytes(file_path=src_file_path)
-        with open(save_to_file, "wb") as new_file:
-            new_file.write(file_bytes)
+        part_file, offset, new_file = self.__open_part_file(
+            src_file_path, save_to_file, resume)
+        with new_file:
+            for chunk in self._bot_api.iter_file_chunks(
+                    self.token, src_file_path, chunk_size, offset):
+                new_file.write(chunk)
+        os.replace(part_file, save_to_file)
+
+    async def async_download_file(self,
+                                  src_file_path: str,
+                                  save_to_file: str,
+                                  chunk_size: int = 65536,
+                                  resume: bool = True):
+        """the awaitable version of download_file"""
+        part_file, offset, new_file = self.__open_part_file(
+            src_file_path, save_to_file, resume)
+        with new_file:
+            async for chunk in self._async_bot_api.iter_file_chunks(
+                    self.token, src_file_path, chunk_size, offset):
+                new_file.write(chunk)
+        os.replace(part_file, save_to_file)
+
+    async def broadcast(self, broadcast_id: str,
+                        chat_ids: Iterable[Union[int, str]],
+                        message: Union[Dict, Callable], **kwargs
+                        ) -> BroadcastReport:
+        """send a message to many chats concurrently within flood limits.
+        Progress is checkpointed in the storage, run it again with the same broadcast_id
+        and chat_ids to resume it.
+
+        Args:
+            broadcast_id (str): an unique id of the broadcast
+            chat_ids (Iterable[Union[int, str]]): chat ids in a stable order
+            message (Union[Dict, Callable]): kwargs of the api method, or a callable returns them by a chat id
+            kwargs: api_name, concurrency, checkpoint_every, progress and max_flood_retries of TelegramBroadcast
+        """
+        return await TelegramBroadcast(self, broadcast_id, chat_ids, message,
+                                       **kwargs).run()
+
+    async def dispatch_updates(
+            self,
+            updates: Iterable[Update],
+            concurrency: int = 1,
+            dispatch: Optional[Callable[[str, Dict], Awaitable]] = None
+    ) -> bool:
+        """dispatch a batch of updates concurrently.
+        Updates from the same chat are dispatched one by one in their order,
+        and last_update_id only advances over updates which are done.
+        An update is done after handle_update, which drops it as a dead update if its handlers
+        keep failing, or after dispatch has returned. An update which dispatch failed to hand
+        off is held back: last_update_id stops before it and later updates of its chat are left
+        to the next fetch. Updates done after last_update_id are remembered, so a batch which is
+        fetched again only dispatches the updates which are not done.
+        In durable polling, the polling state is saved in the storage as updates are done,
+        by one write at a time in the default executor, the last write is finished before
+        it returns.
+
+        Args:
+            updates (Iterable[Update]): updates sorted by update_id
+            concurrency (int): the max number of chats dispatched at the same time
+            dispatch (Optional[Callable]): an awaitable callable with (token, update) which
+                dispatches updates instead of this bot, such as TelegramShards.dispatch
+
+        Returns:
+            bool: whether every update has been done
+        """
+        updates = tuple(updates)
+        durable = self._durable
+        # updates done before a failed hand-off or a restart are fetched again until
+        # they are confirmed
+        finished_update_ids = {
+            update.update_id
+            for update in updates if update.update_id <= self.last_update_id
+            or update.update_id in self._done_update_ids
+        }
+        in_flight_update_ids = {
+            update.update_id
+            for update in updates
+            if update.update_id not in finished_update_ids
+        }
+        chat_updates = {}
+        for update in updates:
+            if update.update_id in finished_update_ids:
+                continue
+            chat_id = self._router.parse_update_chat_id(update)
+            lane = ("update", update.update_id) if chat_id is None else chat_id
+            chat_updates.setdefault(lane, []).append(update)
+        semaphore = asyncio.Semaphore(max(concurrency, 1))
+        next_idx = 0
+        failed = False
+        # the running write of the polling state, and whether updates are done since it started
+        saving = None
+        save_again = False
+
+        def advance_last_update_id():
+            nonlocal next_idx
+            while (next_idx < len(updates) and
+                   updates[next_idx].update_id in finished_update_ids):
+                self.last_update_id = max(self.last_update_id,
+                                          updates[next_idx].update_id)
+                next_idx += 1
+
+        async def dispatch_chat_updates(updates_of_chat):
+            nonlocal failed
+            async with semaphore:
+                for update in updates_of_chat:
+                    if dispatch is None:
+                        await self.handle_update(update)
+                    else:
+                        try:
+                            await dispatch(self.token, update)
+                        except Exception:
+                            logger.exception("failed to hand off update: %s",
+                                             update.update_id)
+                            failed = True
+                            return
+                    finished_update_ids.add(update.update_id)
+                    self._done_update_ids.add(update.update_id)
+                    advance_last_update_id()
+                    if durable:
+                        in_flight_update_ids.discard(update.update_id)
+                        save_polling_state()
+
+        def save_polling_state():
+            nonlocal saving, save_again
+            if saving is None:
+                saving = asyncio.ensure_future(write_polling_state())
+            else:
+                save_again = True
+
+        async def write_polling_state():
+            nonlocal saving, save_again
+            loop = asyncio.get_running_loop()
+            try:
+                while True:
+                    save_again = False
+                    # the state is taken on the loop, written out of it
+                    await loop.run_in_executor(
+                        None, self.__write_polling_state,
+                        self.__polling_state(in_flight_update_ids))
+                    if not save_again:
+                        break
+            except Exception:
+                logger.exception("failed to save the polling state of bot %s",
+                                 self.id)
+            finally:
+                saving = None
+
+        advance_last_update_id()
+        if durable:
+            save_polling_state()
+        await asyncio.gather(*(dispatch_chat_updates(updates_of_chat)
+                               for updates_of_chat in chat_updates.values()))
+        if saving is not None:
+            await saving
+        self._done_update_ids = {
+            update_id
+            for update_id in self._done_update_ids
+            if update_id > self.last_update_id
+        }
+        return not failed
+
+    def load_polling_state(self):
+        """turn on durable polling: restore last_update_id and update ids done after it from the storage.
+        Then last_update_id and update ids done or in flight are saved in the storage as
+        updates are done, so a restarted bot skips updates which have been done and
+        dispatches the others again.
+        """
+        state = self._storage.dict(
+            self._polling_state_key_format.format(self._bot_id),
+            self._polling_state_expires)
+        self._durable = True
+        self.last_update_id = max(self.last_update_id, state.get("offset", 0))
+        self._done_update_ids = {
+            update_id
+            for update_id in state.get("done", ())
+            if update_id > self.last_update_id
+        }
+        if state.get("in_flight", None):
+            logger.info("bot %s dispatches %s updates in flight again",
+                        self.id, len(state["in_flight"]))
+
+    def __polling_state(self, in_flight_update_ids: Iterable[int]) -> Dict:
+        self._done_update_ids = {
+            update_id
+            for update_id in self._done_update_ids
+            if update_id > self.last_update_id
+        }
+        return {
+            "offset": self.last_update_id,
+            "done": sorted(self._done_update_ids),
+            "in_flight": sorted(in_flight_update_ids),
+        }
+
+    def __write_polling_state(self, state: Dict):
+        self._storage.set_many(
+            self._polling_state_key_format.format(self._bot_id), state,
+            self._polling_state_expires)
+
+    async def __wait_polling_stop(self, delay: float) -> bool:
+        try:
+            await asyncio.wait_for(asyncio.shield(self._polling_stop.wait()),
+                                   delay)
+        except asyncio.TimeoutError:
+            pass
+        return self._polling_stop.is_set()
+
+    async def polling(
+        self,
+        limit: Optional[int] = None,
+        timeout: Optional[int] = None,
+        allowed_updates: Optional[Iterable[str]] = None,
+        concurrency: int = 1,
+        min_backoff: float = 1,
+        max_backoff: float = 60,
+        dispatch: Optional[Callable[[str, Dict], Awaitable]] = None,
+        durable: bool = False,
+        **kwargs,
+    ):
+        """fetch updates in long loop model and dispatch them on the running event loop.
+        Failed fetches and updates which dispatch failed to hand off are retried with
+        an exponential backoff. After stop_polling
+        is called, the pending fetch is cancelled and the current batch is finished.
+
+        Args:
+            concurrency (int): the max number of chats dispatched at the same time
+            min_backoff (float): seconds to wait after the first failed fetch
+            max_backoff (float): the max seconds to wait between failed fetches
+            dispatch (Optional[Callable]): see dispatch_updates
+            durable (bool): persist the polling state in the storage, see load_polling_state.
+                An update is done when dispatch returns, so a dispatch must return after the
+                update is handled or stored, as TelegramShards.dispatch waits for the ack of
+                its worker and UpdateQueue.dispatch for the publish
+            kwargs: other kwargs of telegram bot api 'getUpdates'
+        """
+        self._polling_stop = asyncio.Event()
+        if durable:
+            self.load_polling_state()
+        backoff = 0
+        while not self._polling_stop.is_set():
+            fetching = asyncio.ensure_future(
+                self.__get_updates(limit, timeout, allowed_updates,
+                                          **kwargs))
+            stopping = asyncio.ensure_future(self._polling_stop.wait())
+            try:
+                await asyncio.wait((fetching, stopping),
+                                   return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                stopping.cancel()
+                if not fetching.done():
+                    fetching.cancel()
+            if not fetching.done() or fetching.cancelled():
+                break
+            try:
+                updates = fetching.result()
+            except Exception as error:
+                backoff = min(max(backoff * 2, min_backoff), max_backoff)
+                logger.warning(
+                    "failed to get updates for bot %s: %s, retry in %ss",
+                    self.id, error, backoff)
+                await self.__wait_polling_stop(backoff)
+                continue
+            if updates and not await self.dispatch_updates(
+                    updates, concurrency, dispatch):
+                # updates which failed to be handed off are fetched again
+                backoff = min(max(backoff * 2, min_backoff), max_backoff)
+                logger.warning(
+                    "failed to hand off updates for bot %s, retry in %ss",
+                    self.id, backoff)
+                await self.__wait_polling_stop(backoff)
+                continue
+            backoff = 0
+        try:
+            # confirm the dispatched updates to the Telegram Bot API server
+            await self.__get_updates(1, 0, allowed_updates)
+        except Exception as error:
+            logger.warning("failed to confirm updates for bot %s: %s",
+                           self.id, error)
+
+    def __get_updates(self, limit, timeout, allowed_updates, **kwargs):
+        return self._async_bot_api.get_updates(
+            self.token,
+            update_class=self._update_class,
+            offset=self.last_update_id + 1,
+            limit=limit,
+            timeout=timeout,
+            allowed_updates=allowed_updates,
+            **kwargs,
+        )
+
+    def stop_polling(self):
+        """stop a running polling gracefully, must be called in the polling's event loop"""
+        if self._polling_stop is not None:
+            self._polling_stop.set()
 
     def run_polling(
         self,
         limit: Optional[int] = None,
         timeout: Optional[int] = None,
         allowed_updates: Optional[Iterable[str]] = None,
+        concurrency: int = 1,
         **kwargs,
     ):
-        """run a bot in long loop model.
+        """run a bot in long loop model on one long-lived event loop.
 
         Args:
-            get_updates_kwargs: kwargs of telegram bot api 'getUpdates'
+            concurrency (int): the max number of chats dispatched at the same time
+            kwargs: other kwargs of telegram bot api 'getUpdates'
         """
         if not timeout:
             logger.warning(
                 "You are using 0 as timeout in seconds for long polling which should be used for testing purposes only."
             )
-        while True:
-            updates = self._bot_api.get_updates(
-                self.token,
-                offset=self.last_update_id + 1,
-                limit=limit,
-                timeout=timeout,
-                allowed_updates=allowed_updates,
-                **kwargs,
-            )
-            if updates:
-                self.last_update_id = updates[-1].update_id
-                for update in updates:
-                    asyncio.run(self.dispatch(update))
+        asyncio.run(
+            self.polling(limit=limit,
+                         timeout=timeout,
+                         allowed_updates=allowed_updates,
+                         concurrency=concurrency,
+                         **kwargs))
@@ -0,0 +1,224 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from telegrambotclient.api import TelegramBotAPIException, TelegramRateLimiter
+
+logger = logging.getLogger("telegram-bot-client")
+
+
+class BroadcastReport:
+    """
+    Progress of a broadcast, sent, failed and blocked include chats done by former runs
+    which are restored from the checkpoint.
+    Attributes:
+        sent: the number of chats the message is sent to
+        failed: the number of chats the message could not be sent to
+        blocked: chat ids which have blocked the bot or are deactivated (403)
+        skipped: the number of chats which had been done before the broadcast was resumed
+        done_in_run: the number of chats done in this run
+        started_at: when this run started on the monotonic clock
+        finished: whether all chats are done
+    """
+
+    __slots__ = ("sent", "failed", "blocked", "skipped", "done_in_run",
+                 "started_at", "finished")
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.blocked = []
+        self.skipped = 0
+        self.done_in_run = 0
+        self.started_at = time.monotonic()
+        self.finished = False
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed + len(self.blocked)
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    @property
+    def throughput(self) -> float:
+        """chats done per second in this run, restored chats are not counted"""
+        elapsed = self.elapsed
+        return self.done_in_run / elapsed if elapsed > 0 else 0.0
+
+    def __repr__(self) -> str:
+        return "BroadcastReport(sent={0}, failed={1}, blocked={2}, skipped={3}, throughput={4:.1f}/s)".format(
+            self.sent, self.failed, len(self.blocked), self.skipped,
+            self.throughput)
+
+
+class TelegramBroadcast:
+    """
+    Sends a message to many chats concurrently through a bot's async API.
+    Chats are taken from chat_ids in order, the position before which all chats are done and
+    the positions of chats done after it are checkpointed in the bot's storage, so a broadcast
+    which is run again with the same broadcast_id and chat_ids resumes from there. Chats in
+    flight when a broadcast stops are sent again. Blocked chats of every checkpoint are saved
+    in a field of their own, numbered by a checkpoint sequence which goes on when it resumes.
+    Attributes:
+        _bot: the TelegramBot
+        _chat_ids: an iterable of chat ids, it is only iterated once
+        _message: kwargs of the api method, or a callable returns them by a chat id
+        _api_name: the async api method to call, 'send_message' by default
+        _concurrency: the max number of in-flight calls
+        _checkpoint_every: chats done between two checkpoints
+        _progress: a callable with a BroadcastReport called at every checkpoint
+        _rate_limiter: shapes calls if the bot's API does not have a rate limiter
+        _max_flood_retries: how many times a call is repeated after a 429, 0 if the bot's API
+                            has a retry policy which repeats it already
+    """
+
+    __slots__ = ("_bot", "_checkpoint_key", "_chat_ids", "_message",
+                 "_api_name", "_concurrency", "_checkpoint_every", "_progress",
+                 "_rate_limiter", "_max_flood_retries")
+    _checkpoint_key_format = "bot:broadcast:{0}:{1}"
+    _checkpoint_expires = 604800
+
+    def __init__(self,
+                 bot,
+                 broadcast_id: str,
+                 chat_ids: Iterable[Union[int, str]],
+                 message: Union[Dict, Callable[[Union[int, str]], Dict]],
+                 api_name: str = "send_message",
+                 concurrency: int = 30,
+                 checkpoint_every: int = 100,
+                 progress: Optional[Callable[[BroadcastReport], None]] = None,
+                 max_flood_retries: int = 5):
+        self._bot = bot
+        self._checkpoint_key = self._checkpoint_key_format.format(
+            bot.id, broadcast_id)
+        self._chat_ids = chat_ids
+        self._message = message
+        self._api_name = api_name
+        self._concurrency = max(concurrency, 1)
+        self._checkpoint_every = max(checkpoint_every, 1)
+        self._progress = progress
+        self._rate_limiter = None if bot.rate_limiter else TelegramRateLimiter()
+        self._max_flood_retries = 0 if bot.retry_policy else max_flood_retries
+
+    def __load_checkpoint(self,
+                          report: BroadcastReport) -> Tuple[int, Set, int]:
+        """return done, done_after and the next checkpoint sequence"""
+        checkpoint = self._bot.storage.dict(self._checkpoint_key,
+                                            self._checkpoint_expires)
+        report.sent = checkpoint.get("sent", 0)
+        report.failed = checkpoint.get("failed", 0)
+        report.finished = checkpoint.get("finished", False)
+        sequence = 0
+        for field, blocked in checkpoint.items():
+            if field.startswith("blocked:"):
+                report.blocked.extend(blocked)
+                sequence = max(sequence, int(field[8:]) + 1)
+        done_after = set(checkpoint.get("done_after", ()))
+        report.skipped = checkpoint.get("done", 0) + len(done_after)
+        return checkpoint.get("done", 0), done_after, sequence
+
+    def __save_checkpoint(self, report: BroadcastReport, sequence: int,
+                          done: int, done_after: Set, new_blocked: List):
+        mapping = {
+            "done": done,
+            "done_after": sorted(done_after),
+            "sent": report.sent,
+            "failed": report.failed,
+            "finished": report.finished,
+        }
+        if new_blocked:
+            mapping["blocked:{0}".format(sequence)] = new_blocked
+        self._bot.storage.set_many(self._checkpoint_key, mapping,
+                                   self._checkpoint_expires)
+
+    async def __send(self, chat_id: Union[int, str]) -> Optional[bool]:
+        """True if it is sent, False if the chat has blocked the bot, None if it failed"""
+        kwargs = dict(
+            self._message(chat_id) if callable(self._message) else self.
+            _message)
+        kwargs["chat_id"] = chat_id
+        api_method = getattr(self._bot, "async_{0}".format(self._api_name))
+        for attempt in range(self._max_flood_retries + 1):
+            if self._rate_limiter is not None:
+                delay = self._rate_limiter.acquire(
+                    self._bot.token,
+                    self._api_name.replace("_", "").lower(), kwargs)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            try:
+                await api_method(**kwargs)
+                return True
+            except TelegramBotAPIException as error:
+                if error.error_code == 403:
+                    return False
+                if (error.error_code == 429 and error.retry_after
+                        and attempt < self._max_flood_retries):
+                    await asyncio.sleep(error.retry_after)
+                    continue
+                logger.warning("failed to broadcast to chat %s: %s", chat_id,
+                               error.description)
+                return None
+            except Exception as error:
+                logger.warning("failed to broadcast to chat %s: %r", chat_id,
+                               error)
+                return None
+        return None
+
+    async def run(self) -> BroadcastReport:
+        report = BroadcastReport()
+        done, done_after, sequence = self.__load_checkpoint(report)
+        if report.finished:
+            return report
+        chats = enumerate(self._chat_ids)
+        in_flight = set()
+        new_blocked = []
+        next_idx = done
+        since_checkpoint = 0
+
+        def checkpoint():
+            nonlocal done_after, sequence
+            # every chat before the smallest in-flight position is done,
+            # chats done after it are saved by their positions
+            watermark = min(in_flight) if in_flight else next_idx
+            done_after = {idx for idx in done_after if idx >= watermark}
+            self.__save_checkpoint(report, sequence, watermark, done_after,
+                                   list(new_blocked))
+            if new_blocked:
+                # the watermark may stall on a slow chat, blocked chats are never overwritten
+                sequence += 1
+                new_blocked.clear()
+            if self._progress is not None:
+                self._progress(report)
+
+        async def work():
+            nonlocal next_idx, since_checkpoint
+            for idx, chat_id in chats:
+                if idx < done or idx in done_after:
+                    continue
+                in_flight.add(idx)
+                next_idx = idx + 1
+                result = await self.__send(chat_id)
+                if result:
+                    report.sent += 1
+                elif result is None:
+                    report.failed += 1
+                else:
+                    report.blocked.append(chat_id)
+                    new_blocked.append(chat_id)
+                report.done_in_run += 1
+                in_flight.discard(idx)
+                done_after.add(idx)
+                since_checkpoint += 1
+                if since_checkpoint >= self._checkpoint_every:
+                    since_checkpoint = 0
+                    checkpoint()
+
+        try:
+            await asyncio.gather(*(work() for _ in range(self._concurrency)))
+            report.finished = True
+        finally:
+            checkpoint()
+        return report
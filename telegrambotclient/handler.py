@@ -1,13 +1,144 @@
 import asyncio
+import contextvars
+import importlib
+import multiprocessing
 import re
+from concurrent.futures import Executor, ProcessPoolExecutor
 from enum import Enum
-from typing import Callable, Iterable, Optional, Tuple, Union
+from functools import partial, update_wrapper
+from typing import Callable, Dict, Iterable, Optional, Tuple, Union
 
+from telegrambotclient.api import TelegramBotAPICaller
 from telegrambotclient.base import CallbackQuery, MessageField, UpdateType
+from telegrambotclient.bot import TelegramBot
+
+# bots of a worker process, by token
+_process_bots = {}
+_default_process_pool = None
+# sentinels of a router returned by a callback in a worker process
+_NEXT_CALL = "telegrambotclient.next_call"
+_STOP_CALL = "telegrambotclient.stop_call"
+
+
+class _ProcessRouter:
+    """
+    The router of a bot in a worker process, it has the sentinels and force reply callbacks
+    of the bot's router in the main process but routes nothing.
+    """
+
+    __slots__ = ("next_call", "stop_call", "_force_reply_callback_names")
+
+    def __init__(self, next_call, stop_call,
+                 force_reply_callback_names: Tuple[str]):
+        self.next_call = next_call
+        self.stop_call = stop_call
+        self._force_reply_callback_names = frozenset(
+            force_reply_callback_names)
+
+    def has_force_reply_callback(self, callback_name: str) -> bool:
+        return callback_name in self._force_reply_callback_names
+
+
+def _process_bot(bot_config: Dict) -> TelegramBot:
+    bot = _process_bots.get(bot_config["token"], None)
+    if bot is None:
+        storage_config = bot_config["storage_config"]
+        api_host = bot_config["api_host"]
+        bot = TelegramBot(
+            bot_config["token"],
+            _ProcessRouter(*bot_config["router_config"]),
+            storage=storage_config[0](*storage_config[1])
+            if storage_config else None,
+            i18n_source=bot_config["i18n_source"],
+            api_caller=TelegramBotAPICaller(api_host) if api_host else None)
+        _process_bots[bot_config["token"]] = bot
+    return bot
+
+
+def _call_in_process(module_name: str, qualname: str, bot_config: Dict, args,
+                     kwargs):
+    callback = importlib.import_module(module_name)
+    for name in qualname.split("."):
+        callback = getattr(callback, name)
+    if isinstance(callback, ProcessPoolCallback):
+        callback = callback.callback
+    bot = _process_bot(bot_config)
+    if asyncio.iscoroutinefunction(callback):
+        result = asyncio.run(callback(bot, *args, **kwargs))
+    else:
+        result = callback(bot, *args, **kwargs)
+    # sentinels are compared by identity, which does not survive pickling
+    if result is bot.next_call:
+        return _NEXT_CALL
+    if result is bot.stop_call:
+        return _STOP_CALL
+    return result
+
+
+def _new_process_pool() -> ProcessPoolExecutor:
+    # a forked worker would copy the locks and threads of a running bot
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods(
+    ) else "spawn"
+    return ProcessPoolExecutor(
+        mp_context=multiprocessing.get_context(start_method))
+
+
+class ProcessPoolCallback:
+    """
+    Wraps a module level callback to run in a process pool, for CPU-bound handlers.
+    The callback is found by its module and name in a worker process, the update data and
+    args are pickled to it and its return value is pickled back, next_call and stop_call
+    of the worker's bot are returned as the ones of the bot. It gets a bot of the worker process
+    which calls the API through its own connections and opens the bot's storage again by
+    TelegramStorage.process_config, a MemoryStorage can not be shared so the worker has one
+    of its own. The bot has the i18n source and force reply callbacks of the bot, its calls
+    are not shaped by the bot's rate limiter.
+    The default pool starts workers by forkserver or spawn, they import the callback's module.
+    Usage:
+        @router.message_handler(fields=MessageField.PHOTO)
+        @ProcessPoolCallback
+        def on_photo(bot, message):
+            ...
+    Attributes:
+        callback: the wrapped callback
+        _executor: a ProcessPoolExecutor, one with a worker per cpu is shared by default
+    """
+    def __init__(self,
+                 callback: Callable,
+                 executor: Optional[ProcessPoolExecutor] = None):
+        update_wrapper(self, callback)
+        self.callback = callback
+        self._executor = executor
+
+    async def __call__(self, bot, *args, **kwargs):
+        global _default_process_pool
+        executor = self._executor
+        if executor is None:
+            if _default_process_pool is None:
+                _default_process_pool = _new_process_pool()
+            executor = _default_process_pool
+        bot_config = {
+            "token": bot.token,
+            "api_host": bot.api_host,
+            "storage_config": bot.storage.process_config(),
+            "i18n_source": bot.i18n_source,
+            "router_config": (bot.next_call, bot.stop_call,
+                              bot.router.force_reply_callback_names),
+        }
+        result = await asyncio.get_running_loop().run_in_executor(
+            executor,
+            partial(_call_in_process, self.__module__, self.__qualname__,
+                    bot_config, args, kwargs))
+        if isinstance(result, str):
+            if result == _NEXT_CALL:
+                return bot.next_call
+            if result == _STOP_CALL:
+                return bot.stop_call
+        return result
 
 
 class UpdateHandler:
-    __slots__ = ("_update_types", "_callback")
+    __slots__ = ("_update_types", "_callback", "_is_async")
 
     def __init__(
         self,
@@ -15,6 +146,9 @@ class UpdateHandler:
         update_types: Optional[Iterable[Union[str, UpdateType]]] = None,
     ):
         self._callback = callback
+        self._is_async = asyncio.iscoroutinefunction(
+            callback) or asyncio.iscoroutinefunction(
+                getattr(callback, "__call__", None))
         if update_types is None:
             update_types = ("any", )
         self._update_types = tuple(
@@ -28,15 +162,27 @@ class UpdateHandler:
     def update_types(self):
         return self._update_types
 
+    @property
+    def is_async(self) -> bool:
+        return self._is_async
+
     def __repr__(self) -> str:
         return "{0}.{1}".format(self._callback.__module__,
                                 self._callback.__name__)
 
     async def __call__(self, *args, **kwargs):
-        if asyncio.iscoroutinefunction(self._callback):
+        if self._is_async:
             return await self._callback(*args, **kwargs)
         return self._callback(*args, **kwargs)
 
+    async def run_in_executor(self, executor: Executor, *args, **kwargs):
+        """run a sync callback in the executor within a copy of the current context"""
+        if self._is_async:
+            return await self._callback(*args, **kwargs)
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            executor, partial(context.run, self._callback, *args, **kwargs))
+
 
 class ErrorHandler(UpdateHandler):
     __slots__ = ("_errors", )
@@ -220,6 +366,10 @@ class CallbackQueryHandler(UpdateHandler):
     def callback_data_name(self):
         return self._callback_data_name
 
+    @property
+    def callback_data_patterns(self) -> Tuple:
+        return self._callback_data_patterns
+
     def callback_data_match(self, callback_query: CallbackQuery):
         for pattern in self._callback_data_patterns:
             result = pattern.match(callback_query.data)
@@ -268,3 +418,13 @@ class PollHandler(UpdateHandler):
 class PollAnswerHandler(UpdateHandler):
     def __init__(self, callback: Callable):
         super().__init__(callback, update_types=(UpdateType.POLL_ANSWER, ))
+
+
+class MyChatMemberHandler(UpdateHandler):
+    def __init__(self, callback: Callable):
+        super().__init__(callback, update_types=(UpdateType.MY_CHAT_MEMBER, ))
+
+
+class ChatMemberHandler(UpdateHandler):
+    def __init__(self, callback: Callable):
+        super().__init__(callback, update_types=(UpdateType.CHAT_MEMBER, ))
@@ -0,0 +1,273 @@
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+from typing import Any, Callable, Dict, Iterable, Tuple, Union
+
+from telegrambotclient.base import TelegramObject
+
+
+class TelegramModel:
+    """
+    A compact __slots__ based model for hot update types.
+    Frequently used fields are kept in slots, other fields go into a dict which is only
+    created when there is any. It keeps the read API of TelegramObject: attribute and item
+    access, missing fields are None, 'in', keys(), items() and get().
+    Attributes:
+        _keys: names of present fields in their order, shared by models with the same fields
+            if they are all slots, up to _shared_keys_size kinds of them
+        _extra: a dict of present fields which are not slots, None if there is no one
+    """
+
+    __slots__ = ("_keys", "_extra")
+    _fields = frozenset()
+    _decoders = {}
+    _shared_keys = {}
+    _shared_keys_size = 4096
+
+    def __init__(self, **kwargs):
+        set_slot = object.__setattr__
+        set_slot(self, "_extra", None)
+        fields = self._fields
+        decoders = self._decoders
+        extra = None
+        keys = []
+        for name, value in kwargs.items():
+            if name == "from":
+                name = "from_user"
+            keys.append(name)
+            decoder = decoders.get(name, None)
+            if decoder is not None and value is not None:
+                value = decoder(value)
+            elif isinstance(value, dict):
+                value = TelegramObject(**value)
+            elif isinstance(value, list):
+                value = _decode_object_list(value)
+            if name in fields:
+                set_slot(self, name, value)
+                continue
+            if extra is None:
+                extra = {}
+                set_slot(self, "_extra", extra)
+            extra[name] = value
+        keys = tuple(keys)
+        if extra is None:
+            # names of unknown fields come from the outside, they are not kept forever
+            shared_keys = self._shared_keys.get(keys, None)
+            if shared_keys is not None:
+                keys = shared_keys
+            elif len(self._shared_keys) < self._shared_keys_size:
+                self._shared_keys[keys] = keys
+        set_slot(self, "_keys", keys)
+
+    @classmethod
+    def from_json(cls, data: Union[str, bytes]) -> "TelegramModel":
+        return cls(**json.loads(data))
+
+    def __getattr__(self, name: str):
+        # only called for unset slots and non-slot fields
+        if name.startswith("__"):
+            raise AttributeError(name)
+        extra = self._extra
+        if extra is None:
+            return None
+        return extra.get(name, None)
+
+    def __setattr__(self, name: str, value: Any):
+        if name in self._fields:
+            object.__setattr__(self, name, value)
+        else:
+            if self._extra is None:
+                object.__setattr__(self, "_extra", {})
+            self._extra[name] = value
+        if name not in self._keys:
+            object.__setattr__(self, "_keys", self._keys + (name, ))
+
+    def __getitem__(self, name: str):
+        return getattr(self, name)
+
+    def __setitem__(self, name: str, value: Any):
+        setattr(self, name, value)
+
+    def get(self, name: str, default=None):
+        if name not in self._keys:
+            return default
+        return getattr(self, name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def keys(self) -> Tuple[str]:
+        return self._keys
+
+    def values(self) -> Tuple:
+        return tuple(getattr(self, name) for name in self._keys)
+
+    def items(self) -> Tuple[Tuple[str, Any]]:
+        return tuple((name, getattr(self, name)) for name in self._keys)
+
+    def to_dict(self) -> Dict:
+        return {
+            name: _to_primitive(getattr(self, name))
+            for name in self._keys
+        }
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state: Dict):
+        self.__init__(**state)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (TelegramModel, dict)):
+            return self.to_dict() == _to_primitive(other)
+        return NotImplemented
+
+    __hash__ = object.__hash__
+
+    def __repr__(self) -> str:
+        return "{0}({1})".format(
+            self.__class__.__name__, ", ".join(
+                "{0}={1!r}".format(name, getattr(self, name))
+                for name in self._keys))
+
+
+def _to_primitive(value) -> Any:
+    if isinstance(value, TelegramModel):
+        return value.to_dict()
+    if isinstance(value, dict):
+        return {name: _to_primitive(item) for name, item in value.items()}
+    if isinstance(value, list):
+        return [_to_primitive(item) for item in value]
+    return value
+
+
+def _decode_one(model: type) -> Callable:
+    return lambda value: model(**value)
+
+
+def _decode_list(model: type) -> Callable:
+    return lambda values: [model(**value) for value in values]
+
+
+def _decode_object_list(values: Iterable) -> Any:
+    return [
+        TelegramObject(**value) if isinstance(value, dict) else value
+        for value in values
+    ]
+
+
+# model name: (slot fields, {field: (model name, is_list)})
+_MODEL_SPECS = {
+    "Update": (
+        ("update_id", "message", "edited_message", "channel_post",
+         "callback_query", "inline_query"),
+        {
+            "message": ("Message", False),
+            "edited_message": ("Message", False),
+            "channel_post": ("Message", False),
+            "edited_channel_post": ("Message", False),
+            "callback_query": ("CallbackQuery", False),
+            "inline_query": ("InlineQuery", False),
+            "chosen_inline_result": ("ChosenInlineResult", False),
+        },
+    ),
+    "Message": (
+        ("message_id", "from_user", "sender_chat", "date", "chat",
+         "reply_to_message", "edit_date", "text", "entities", "caption",
+         "caption_entities", "photo", "document", "reply_markup"),
+        {
+            "from_user": ("User", False),
+            "sender_chat": ("Chat", False),
+            "chat": ("Chat", False),
+            "forward_from": ("User", False),
+            "forward_from_chat": ("Chat", False),
+            "reply_to_message": ("Message", False),
+            "via_bot": ("User", False),
+            "entities": ("MessageEntity", True),
+            "caption_entities": ("MessageEntity", True),
+            "photo": ("PhotoSize", True),
+            "new_chat_members": ("User", True),
+            "left_chat_member": ("User", False),
+            "new_chat_photo": ("PhotoSize", True),
+            "pinned_message": ("Message", False),
+        },
+    ),
+    "User": (
+        ("id", "is_bot", "first_name", "last_name", "username",
+         "language_code"),
+        {},
+    ),
+    "Chat": (
+        ("id", "type", "title", "username", "first_name", "last_name"),
+        {
+            "pinned_message": ("Message", False),
+        },
+    ),
+    "MessageEntity": (
+        ("type", "offset", "length", "url", "user", "language"),
+        {
+            "user": ("User", False),
+        },
+    ),
+    "PhotoSize": (
+        ("file_id", "file_unique_id", "width", "height", "file_size"),
+        {},
+    ),
+    "CallbackQuery": (
+        ("id", "from_user", "message", "inline_message_id", "chat_instance",
+         "data", "game_short_name"),
+        {
+            "from_user": ("User", False),
+            "message": ("Message", False),
+        },
+    ),
+    "InlineQuery": (
+        ("id", "from_user", "query", "offset", "chat_type"),
+        {
+            "from_user": ("User", False),
+        },
+    ),
+    "ChosenInlineResult": (
+        ("result_id", "from_user", "inline_message_id", "query"),
+        {
+            "from_user": ("User", False),
+        },
+    ),
+}
+
+
+def _generate_models(specs: Dict) -> Dict[str, type]:
+    models = {
+        name: type(name, (TelegramModel, ), {
+            "__slots__": fields,
+            "_fields": frozenset(fields),
+        })
+        for name, (fields, _) in specs.items()
+    }
+    for name, (_, nested) in specs.items():
+        decoders = {}
+        for field, (model_name, is_list) in nested.items():
+            decoders[field] = (_decode_list if is_list else _decode_one)(
+                models[model_name])
+        models[name]._decoders = decoders
+    return models
+
+
+_MODELS = _generate_models(_MODEL_SPECS)
+Update = _MODELS["Update"]
+Message = _MODELS["Message"]
+User = _MODELS["User"]
+Chat = _MODELS["Chat"]
+MessageEntity = _MODELS["MessageEntity"]
+PhotoSize = _MODELS["PhotoSize"]
+CallbackQuery = _MODELS["CallbackQuery"]
+InlineQuery = _MODELS["InlineQuery"]
+ChosenInlineResult = _MODELS["ChosenInlineResult"]
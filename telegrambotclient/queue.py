@@ -0,0 +1,530 @@
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+import asyncio
+import logging
+import math
+import os
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from telegrambotclient.base import TelegramObject, Update
+from telegrambotclient.router import TelegramRouter
+from telegrambotclient.utils import update_to_dict
+
+logger = logging.getLogger("telegram-bot-client")
+
+
+class UpdateQueue:
+    """
+    A partitioned queue of raw updates between the ingestion and worker nodes.
+    Updates of a chat always go to the same partition and a partition is read by one
+    consumer at a time, the one which holds its lease, so updates of a chat are read in order.
+    An update stays in the queue until it is acked, the next owner of a partition reads
+    the updates which were not acked by the former one again.
+    Attributes:
+        _partitions: the number of partitions
+    """
+
+    __slots__ = ("_partitions", )
+
+    def __init__(self, partitions: int = 16):
+        self._partitions = max(partitions, 1)
+
+    @property
+    def partitions(self) -> int:
+        return self._partitions
+
+    def partition_of(self, update: Dict) -> int:
+        if not isinstance(update, TelegramObject):
+            update = Update(**update)
+        chat_id = TelegramRouter.parse_update_chat_id(update)
+        if chat_id is None:
+            chat_id = update.update_id or 0
+        # crc32 is stable across processes and nodes, unlike hash of a str
+        return zlib.crc32(str(chat_id).encode("utf-8")) % self._partitions
+
+    async def dispatch(self, token: str, update: Dict):
+        """publish an update in the default executor, an awaitable callable with (token, update)
+        for TelegramBot.polling and TelegramWebhookServer, it raises if the update
+        is not published"""
+        update = update_to_dict(update)
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.publish, token, update, self.partition_of(update))
+
+    def publish(self, token: str, update: Dict, partition: int):
+        raise NotImplementedError()
+
+    def heartbeat(self, consumer: str, ttl: float) -> int:
+        """mark the consumer alive for ttl seconds and return the number of alive consumers"""
+        raise NotImplementedError()
+
+    def acquire(self, partition: int, consumer: str, ttl: float) -> bool:
+        """take or renew the lease of a partition for ttl seconds"""
+        raise NotImplementedError()
+
+    def release(self, partition: int, consumer: str):
+        raise NotImplementedError()
+
+    def read(self, partition: int, cursor: Any,
+             count: int) -> Tuple[List[Tuple[Any, str, Dict]], Any]:
+        """read (message id, token, update)s after the cursor and return them with the next cursor.
+        A cursor of None starts from the first update which is not acked."""
+        raise NotImplementedError()
+
+    def ack(self, partition: int, message_ids: Iterable):
+        raise NotImplementedError()
+
+
+class RedisStreamQueue(UpdateQueue):
+    """
+    A partition is a redis stream with a consumer group, read by the consumer name of the
+    partition, so its pending entries follow the lease instead of a node.
+    Leases are keys with a ttl and alive consumers are a sorted set of their heartbeats.
+    Acked updates are deleted from the stream.
+    """
+
+    __slots__ = ("_redis", "_prefix", "_group", "_maxlen", "_groups")
+    _acquire_script = """
+    local owner = redis.call('GET', KEYS[1])
+    if not owner then
+        redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+        return 1
+    end
+    if owner == ARGV[1] then
+        redis.call('PEXPIRE', KEYS[1], ARGV[2])
+        return 1
+    end
+    return 0
+    """
+    _release_script = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self,
+                 redis,
+                 partitions: int = 16,
+                 prefix: str = "bot:updates",
+                 group: str = "workers",
+                 maxlen: Optional[int] = None):
+        super().__init__(partitions)
+        self._redis = redis
+        self._prefix = prefix
+        self._group = group
+        self._maxlen = maxlen
+        self._groups = set()
+
+    @staticmethod
+    def __text(value) -> str:
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    def __stream_key(self, partition: int) -> str:
+        return "{0}:{1}".format(self._prefix, partition)
+
+    def __ensure_group(self, partition: int):
+        if partition in self._groups:
+            return
+        try:
+            self._redis.xgroup_create(self.__stream_key(partition),
+                                      self._group,
+                                      id="0",
+                                      mkstream=True)
+        except Exception as error:
+            if "BUSYGROUP" not in str(error):
+                raise
+        self._groups.add(partition)
+
+    def publish(self, token: str, update: Dict, partition: int):
+        self._redis.xadd(self.__stream_key(partition), {
+            "token": token,
+            "update": json.dumps(update_to_dict(update))
+        },
+                         maxlen=self._maxlen,
+                         approximate=True)
+
+    def heartbeat(self, consumer: str, ttl: float) -> int:
+        consumers_key = "{0}:consumers".format(self._prefix)
+        current_time = time.time()
+        with self._redis.pipeline() as pipe:
+            pipe.zadd(consumers_key, {consumer: current_time})
+            pipe.zremrangebyscore(consumers_key, "-inf", current_time - ttl)
+            pipe.zcard(consumers_key)
+            return pipe.execute()[-1]
+
+    def acquire(self, partition: int, consumer: str, ttl: float) -> bool:
+        acquired = self._redis.eval(
+            self._acquire_script, 1,
+            "{0}:lease:{1}".format(self._prefix, partition), consumer,
+            int(ttl * 1000))
+        if acquired:
+            self.__ensure_group(partition)
+        return bool(acquired)
+
+    def release(self, partition: int, consumer: str):
+        self._redis.eval(self._release_script, 1,
+                         "{0}:lease:{1}".format(self._prefix, partition),
+                         consumer)
+
+    def read(self, partition: int, cursor: Optional[str],
+             count: int) -> Tuple[List[Tuple[str, str, Dict]], str]:
+        # pending entries are read from "0" until there are none, then new ones from ">"
+        stream_key = self.__stream_key(partition)
+        streams = self._redis.xreadgroup(self._group,
+                                         "partition-{0}".format(partition),
+                                         {stream_key: cursor or "0"},
+                                         count=count)
+        entries = streams[0][1] if streams else []
+        messages = []
+        for message_id, fields in entries:
+            message_id = self.__text(message_id)
+            if not fields:
+                # deleted from the stream while pending
+                self.ack(partition, (message_id, ))
+                continue
+            fields = {
+                self.__text(name): self.__text(value)
+                for name, value in fields.items()
+            }
+            messages.append((message_id, fields["token"],
+                             json.loads(fields["update"])))
+        if cursor == ">":
+            return messages, cursor
+        return messages, self.__text(entries[-1][0]) if entries else ">"
+
+    def ack(self, partition: int, message_ids: Iterable[str]):
+        message_ids = tuple(message_ids)
+        if not message_ids:
+            return
+        stream_key = self.__stream_key(partition)
+        with self._redis.pipeline() as pipe:
+            pipe.xack(stream_key, self._group, *message_ids)
+            pipe.xdel(stream_key, *message_ids)
+            pipe.execute()
+
+
+class _LockedConnection:
+    """a connection in a transaction behind a lock"""
+    __slots__ = ("_db_conn", "_lock")
+
+    def __init__(self, db_conn: sqlite3.Connection, lock: threading.Lock):
+        self._db_conn = db_conn
+        self._lock = lock
+
+    def __enter__(self) -> sqlite3.Connection:
+        self._lock.acquire()
+        return self._db_conn.__enter__()
+
+    def __exit__(self, *exc_info):
+        try:
+            return self._db_conn.__exit__(*exc_info)
+        finally:
+            self._lock.release()
+
+
+class SQLiteQueue(UpdateQueue):
+    """
+    A stand-in of RedisStreamQueue on a sqlite db file for tests and single machine deployments.
+    Every process opens its own connection, so the queue can be shared by forked processes.
+    Acked updates are deleted.
+    Attributes:
+        _db_file: the db file
+        _db_conn: the connection of the current process
+        _pid: the process which opened _db_conn
+        _lock: the lock of _db_conn
+    """
+
+    __slots__ = ("_db_file", "_db_conn", "_pid", "_lock")
+
+    def __init__(self, db_file: str, partitions: int = 16):
+        super().__init__(partitions)
+        self._db_file = db_file
+        self._db_conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+        with self.__connection() as db_conn:
+            db_conn.executescript("""
+                CREATE TABLE IF NOT EXISTS `t_update_queue` (
+                    `id`         INTEGER PRIMARY KEY AUTOINCREMENT,
+                    `partition`  INTEGER NOT NULL,
+                    `token`      TEXT NOT NULL,
+                    `update`     TEXT NOT NULL
+                    );
+                CREATE INDEX IF NOT EXISTS `i_update_queue_partition`
+                    ON `t_update_queue` (`partition`, `id`);
+                CREATE TABLE IF NOT EXISTS `t_update_queue_lease` (
+                    `partition`  INTEGER NOT NULL,
+                    `consumer`   TEXT NOT NULL,
+                    `expires`    REAL NOT NULL,
+                    PRIMARY KEY(`partition`)
+                    );
+                CREATE TABLE IF NOT EXISTS `t_update_queue_consumer` (
+                    `consumer`   TEXT NOT NULL,
+                    `seen`       REAL NOT NULL,
+                    PRIMARY KEY(`consumer`)
+                    );
+                """)
+
+    def __connection(self):
+        if self._pid != os.getpid():
+            # a connection must not be used across a fork
+            self._db_conn = sqlite3.connect(self._db_file,
+                                            timeout=30,
+                                            check_same_thread=False,
+                                            isolation_level="IMMEDIATE")
+            self._db_conn.execute("PRAGMA journal_mode=WAL")
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+        return _LockedConnection(self._db_conn, self._lock)
+
+    def publish(self, token: str, update: Dict, partition: int):
+        with self.__connection() as db_conn:
+            db_conn.execute(
+                "INSERT INTO t_update_queue (partition, token, `update`) VALUES (?, ?, ?)",
+                (partition, token, json.dumps(update_to_dict(update))))
+
+    def heartbeat(self, consumer: str, ttl: float) -> int:
+        current_time = time.time()
+        with self.__connection() as db_conn:
+            db_conn.execute(
+                "INSERT OR REPLACE INTO t_update_queue_consumer (consumer, seen) VALUES (?, ?)",
+                (consumer, current_time))
+            db_conn.execute("DELETE FROM t_update_queue_consumer WHERE seen<?",
+                            (current_time - ttl, ))
+            return db_conn.execute(
+                "SELECT COUNT(*) FROM t_update_queue_consumer").fetchone()[0]
+
+    def acquire(self, partition: int, consumer: str, ttl: float) -> bool:
+        current_time = time.time()
+        with self.__connection() as db_conn:
+            return bool(
+                db_conn.execute(
+                    """
+                    INSERT INTO t_update_queue_lease (partition, consumer, expires) VALUES (?, ?, ?)
+                    ON CONFLICT(partition) DO UPDATE SET consumer=excluded.consumer, expires=excluded.expires
+                    WHERE t_update_queue_lease.consumer=excluded.consumer OR t_update_queue_lease.expires<?
+                    """, (partition, consumer, current_time + ttl,
+                          current_time)).rowcount)
+
+    def release(self, partition: int, consumer: str):
+        with self.__connection() as db_conn:
+            db_conn.execute(
+                "DELETE FROM t_update_queue_lease WHERE partition=? AND consumer=?",
+                (partition, consumer))
+
+    def read(self, partition: int, cursor: Optional[int],
+             count: int) -> Tuple[List[Tuple[int, str, Dict]], int]:
+        with self.__connection() as db_conn:
+            rows = db_conn.execute(
+                "SELECT id, token, `update` FROM t_update_queue WHERE partition=? AND id>? ORDER BY id LIMIT ?",
+                (partition, cursor or 0, count)).fetchall()
+        messages = [(message_id, token, json.loads(update))
+                    for message_id, token, update in rows]
+        return messages, rows[-1][0] if rows else cursor
+
+    def ack(self, partition: int, message_ids: Iterable[int]):
+        with self.__connection() as db_conn:
+            db_conn.executemany("DELETE FROM t_update_queue WHERE id=?",
+                                ((message_id, ) for message_id in message_ids))
+
+
+class UpdateQueueWorker:
+    """
+    Consumes an UpdateQueue and dispatches its updates to bots of a TelegramBotClient.
+    The worker keeps the leases of its fair share of partitions, the partitions divided by
+    alive consumers, and gives extra partitions back after their updates in flight are done.
+    Updates of a chat are dispatched one by one in their order by TelegramBot.handle_update,
+    the failure policy of polling: an update is acked after its handlers have finished or it has
+    been dropped as a dead update, so an update is dispatched at least once and a bad one
+    never holds back its partition. An update which failed out of its handlers, such as one
+    which can not be parsed, is logged and left unacked, the next owner of its partition
+    reads it again. A partition which is taken again is read from its first update which is
+    not acked, updates still in flight in this worker are skipped then.
+    Calls to the queue block, they are run in the default executor, and the leases and cursors
+    are only changed on the event loop, so a partition is checked to be still owned after
+    every call.
+    Attributes:
+        _bot_client: the TelegramBotClient which owns the bots
+        _queue: the UpdateQueue
+        _consumer: an unique name of this worker, '{hostname}:{pid}' by default
+        _concurrency: the max number of updates dispatched at the same time
+        _batch_size: the max number of updates read from a partition at a time
+        _lease_ttl: seconds a lease is kept without renewing, it is renewed every third of it
+        _poll_interval: seconds to wait after reading nothing
+        _stopped: an event which is set when the worker is stopping
+    """
+
+    __slots__ = ("_bot_client", "_queue", "_consumer", "_concurrency",
+                 "_batch_size", "_lease_ttl", "_poll_interval", "_stopped")
+
+    def __init__(self,
+                 bot_client,
+                 queue: UpdateQueue,
+                 consumer: Optional[str] = None,
+                 concurrency: int = 64,
+                 batch_size: int = 100,
+                 lease_ttl: float = 30,
+                 poll_interval: float = 0.1):
+        self._bot_client = bot_client
+        self._queue = queue
+        self._consumer = consumer or "{0}:{1}".format(socket.gethostname(),
+                                                      os.getpid())
+        self._concurrency = max(concurrency, 1)
+        self._batch_size = max(batch_size, 1)
+        self._lease_ttl = lease_ttl
+        self._poll_interval = poll_interval
+        self._stopped = None
+
+    @property
+    def consumer(self) -> str:
+        return self._consumer
+
+    def stop(self):
+        if self._stopped is not None:
+            self._stopped.set()
+
+    @staticmethod
+    async def __call(method, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            None, method, *args)
+
+    async def __rebalance(self, owned: Dict, draining: Set):
+        alive = max(
+            await self.__call(self._queue.heartbeat, self._consumer,
+                              self._lease_ttl), 1)
+        target = math.ceil(self._queue.partitions / alive)
+        for partition in tuple(owned):
+            if not await self.__call(self._queue.acquire, partition,
+                                     self._consumer, self._lease_ttl):
+                logger.warning("lost the lease of partition %s", partition)
+                owned.pop(partition, None)
+                draining.discard(partition)
+        for partition in tuple(owned)[:max(len(owned) - target, 0)]:
+            draining.add(partition)
+        for partition in range(self._queue.partitions):
+            if len(owned) >= target:
+                break
+            if partition not in owned and await self.__call(
+                    self._queue.acquire, partition, self._consumer,
+                    self._lease_ttl):
+                logger.info("%s took partition %s", self._consumer, partition)
+                owned[partition] = None
+
+    async def __keep_leases(self, owned: Dict, draining: Set):
+        while not self._stopped.is_set():
+            try:
+                await self.__rebalance(owned, draining)
+            except Exception:
+                logger.exception("failed to renew leases of %s",
+                                 self._consumer)
+            try:
+                await asyncio.wait_for(self._stopped.wait(),
+                                       self._lease_ttl / 3)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self):
+        self._stopped = asyncio.Event()
+        # partition -> cursor
+        owned = {}
+        draining = set()
+        # partition -> ids of messages in flight
+        in_flight = {
+            partition: set()
+            for partition in range(self._queue.partitions)
+        }
+        running = asyncio.Semaphore(self._concurrency)
+        pending = asyncio.Semaphore(
+            max(self._concurrency, self._batch_size) * 2)
+        # the last task of every chat, a task waits for the previous one of its chat
+        lanes = {}
+
+        async def dispatch(lane, previous, partition, message_id, bot,
+                           update):
+            try:
+                if previous is not None:
+                    await previous
+                async with running:
+                    # handled or dropped as a dead update, see handle_update
+                    await bot.handle_update(update)
+                await self.__call(self._queue.ack, partition, (message_id, ))
+            except Exception:
+                logger.exception(
+                    "failed to dispatch or ack update %s, leave it in the queue",
+                    update.update_id)
+            finally:
+                in_flight[partition].discard(message_id)
+                pending.release()
+                if lanes.get(lane, None) is asyncio.current_task():
+                    del lanes[lane]
+
+        keeping_leases = asyncio.ensure_future(
+            self.__keep_leases(owned, draining))
+        try:
+            while not self._stopped.is_set():
+                read_any = False
+                for partition in tuple(owned):
+                    if partition in draining:
+                        if not in_flight[partition]:
+                            await self.__call(self._queue.release, partition,
+                                              self._consumer)
+                            owned.pop(partition, None)
+                            draining.discard(partition)
+                        continue
+                    if partition not in owned:
+                        # the lease was lost while the last partition was read
+                        continue
+                    messages, cursor = await self.__call(
+                        self._queue.read, partition, owned[partition],
+                        self._batch_size)
+                    if partition not in owned:
+                        # the lease was lost while reading, the next owner reads them again
+                        continue
+                    owned[partition] = cursor
+                    for message_id, token, raw_update in messages:
+                        read_any = True
+                        if message_id in in_flight[partition]:
+                            # read again after the lease was lost and taken back
+                            continue
+                        bot = self._bot_client.bot(token)
+                        if bot is None:
+                            logger.warning("no bot found with token: '%s'",
+                                           token)
+                            await self.__call(self._queue.ack, partition,
+                                              (message_id, ))
+                            continue
+                        update = bot.update_class(**raw_update)
+                        chat_id = bot.router.parse_update_chat_id(update)
+                        lane = (partition, ("update", update.update_id)
+                                if chat_id is None else chat_id)
+                        await pending.acquire()
+                        if partition not in owned:
+                            # the lease was lost while waiting, leave the rest to the next owner
+                            pending.release()
+                            break
+                        in_flight[partition].add(message_id)
+                        lanes[lane] = asyncio.ensure_future(
+                            dispatch(lane, lanes.get(lane, None), partition,
+                                     message_id, bot, update))
+                if not read_any:
+                    try:
+                        await asyncio.wait_for(self._stopped.wait(),
+                                               self._poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            self._stopped.set()
+            if lanes:
+                await asyncio.gather(*tuple(lanes.values()))
+            await keeping_leases
+            for partition in tuple(owned):
+                await self.__call(self._queue.release, partition,
+                                  self._consumer)
@@ -1,23 +1,28 @@
+import asyncio
 import logging
+import re
 from collections import defaultdict
-from typing import Callable, Dict, Iterable, Optional, Tuple, Union
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import (Callable, Dict, Iterable, List, Optional, Pattern, Tuple,
+                    Union)
 
 try:
     import ujson as json
 except ImportError:
     import json
 
-from telegrambotclient.base import (CallbackQuery, ChosenInlineResult,
-                                    InlineQuery, Message, MessageField, Poll,
+from telegrambotclient.base import (CallbackQuery, ChatMemberUpdated,
+                                    ChosenInlineResult, InlineQuery, Message, MessageField, Poll,
                                     PollAnswer, PreCheckoutQuery,
                                     ShippingQuery, TelegramBotException,
                                     TelegramObject, Update, UpdateType)
 from telegrambotclient.bot import TelegramBot
 from telegrambotclient.handler import (
-    CallbackQueryHandler, ChannelPostHandler, ChosenInlineResultHandler,
-    CommandHandler, EditedChannelPostHandler, EditedMessageHandler,
-    ErrorHandler, ForceReplyHandler, InlineQueryHandler, Interceptor,
-    InterceptorType, MessageHandler, PollAnswerHandler, PollHandler,
+    CallbackQueryHandler, ChannelPostHandler, ChatMemberHandler,
+    ChosenInlineResultHandler, CommandHandler, EditedChannelPostHandler,
+    EditedMessageHandler, ErrorHandler, ForceReplyHandler, InlineQueryHandler,
+    Interceptor, InterceptorType, MessageHandler, MyChatMemberHandler,
+    PollAnswerHandler, PollHandler,
     PreCheckoutQueryHandler, ShippingQueryHandler, UpdateHandler,
     _MessageHandler)
 from telegrambotclient.utils import pretty_format
@@ -25,11 +30,162 @@ from telegrambotclient.utils import pretty_format
 logger = logging.getLogger("telegram-bot-client")
 
 
+class _CompiledMessageRoute:
+    """
+    A precomputed dispatch structure of a message-like route.
+    Every field has a bit, so matching a message is computing the bitmask of its fields
+    and looking up the handlers to call for the bitmask in a cache.
+    Attributes:
+        _field_bits: a dict of field -> bit
+        _and_group: a tuple of (fields mask, handler) which are called when all fields are present
+        _or_group: a tuple of (field bit, handlers) which are called when the field is present
+        _any_handler: a handler on any fields
+        _handlers_cache: a dict of message fields mask -> handlers to call in order
+    """
+
+    __slots__ = ("_field_bits", "_and_group", "_or_group", "_any_handler",
+                 "_handlers_cache")
+    _max_cache_size = 4096
+
+    def __init__(self, route: Dict):
+        self._field_bits = {}
+        self._and_group = tuple((self.__fields_mask(fields), handler)
+                                for fields, handler in route.get("and", ()))
+        self._or_group = tuple(
+            (self.__fields_mask((field, )), tuple(handlers))
+            for field, handlers in route.get("or", {}).items())
+        self._any_handler = route.get("any", None)
+        self._handlers_cache = {}
+
+    def __fields_mask(self, fields: Iterable) -> int:
+        mask = 0
+        for field in fields:
+            if field not in self._field_bits:
+                self._field_bits[field] = 1 << len(self._field_bits)
+            mask |= self._field_bits[field]
+        return mask
+
+    def match(self, message: Message) -> Tuple[UpdateHandler]:
+        field_bits = self._field_bits
+        mask = 0
+        for field in message.keys():
+            mask |= field_bits.get(field, 0)
+        handlers = self._handlers_cache.get(mask, None)
+        if handlers is None:
+            handlers = [
+                handler for fields_mask, handler in self._and_group
+                if fields_mask & mask == fields_mask
+            ]
+            for field_bit, or_handlers in self._or_group:
+                if field_bit & mask:
+                    handlers.extend(or_handlers)
+            if self._any_handler:
+                handlers.append(self._any_handler)
+            handlers = tuple(handlers)
+            if len(self._handlers_cache) >= self._max_cache_size:
+                self._handlers_cache.clear()
+            self._handlers_cache[mask] = handlers
+        return handlers
+
+
+def _literal_prefix(pattern: Pattern) -> str:
+    """the literal text which every match of a pattern must start with"""
+    regex = pattern.pattern
+    if (not isinstance(regex, str)
+            or pattern.flags & (re.IGNORECASE | re.VERBOSE)):
+        return ""
+    prefix = []
+    idx = 1 if regex.startswith("^") else 0
+    while idx < len(regex):
+        char = regex[idx]
+        if char == "\\":
+            escaped = regex[idx + 1:idx + 2]
+            if not escaped or escaped.isalnum():
+                break
+            prefix.append(escaped)
+            idx += 2
+            continue
+        if char in ".^$*+?{}[]|()":
+            break
+        prefix.append(char)
+        idx += 1
+    if prefix and regex[idx:idx + 1] in ("*", "?", "{"):
+        # the last literal is optional
+        prefix.pop()
+    # an alternation might start with something else
+    if re.search(r"(?<!\\)\|", regex):
+        return ""
+    return "".join(prefix)
+
+
+class _CompiledCallbackDataPatterns:
+    """
+    An index of callback_data_regex patterns by their literal prefixes, so a callback query
+    is only matched against the patterns which could match it. Handlers are still tried in
+    their registration order with their first matching pattern.
+    Attributes:
+        _prefix_lengths: distinct lengths of literal prefixes in ascending order
+        _patterns: a dict of literal prefix -> a list of (handler index, pattern index, pattern)
+        _handlers: handlers in their registration order
+    """
+
+    __slots__ = ("_prefix_lengths", "_patterns", "_handlers")
+
+    def __init__(self, handlers: Iterable[CallbackQueryHandler]):
+        self._handlers = tuple(handlers)
+        self._patterns = defaultdict(list)
+        for handler_idx, handler in enumerate(self._handlers):
+            for pattern_idx, pattern in enumerate(
+                    handler.callback_data_patterns):
+                self._patterns[_literal_prefix(pattern)].append(
+                    (handler_idx, pattern_idx, pattern))
+        self._patterns = dict(self._patterns)
+        self._prefix_lengths = tuple(
+            sorted({len(prefix)
+                    for prefix in self._patterns}))
+
+    def match(self, callback_data: Optional[str]) -> List[Tuple]:
+        if callback_data is None:
+            return []
+        candidates = []
+        for prefix_length in self._prefix_lengths:
+            if prefix_length > len(callback_data):
+                break
+            candidates.extend(
+                self._patterns.get(callback_data[:prefix_length], ()))
+        candidates.sort(key=lambda candidate: candidate[:2])
+        results = []
+        matched_handler_idx = None
+        for handler_idx, _, pattern in candidates:
+            if handler_idx == matched_handler_idx:
+                continue
+            result = pattern.match(callback_data)
+            if result:
+                matched_handler_idx = handler_idx
+                results.append((self._handlers[handler_idx], result))
+        return results
+
+
 class TelegramRouter:
-    __slots__ = ("_name", "_route_map", "_handler_callers")
+    """
+    Routes updates to handlers.
+    Attributes:
+        _executor: sync handlers are run in this executor instead of on the event loop,
+            a ThreadPoolExecutor of sync_handler_workers threads if it is not given
+        _max_sync_handlers_per_bot: the max number of sync handlers of a bot running
+            in the executor at the same time, so a busy bot does not take all of its threads
+        _bot_semaphores: a dict of bot token -> semaphore for the cap above
+    """
+
+    __slots__ = ("_name", "_route_map", "_handler_callers", "_compiled_routes",
+                 "_executor", "_max_sync_handlers_per_bot", "_bot_semaphores")
     next_call = True
     stop_call = False
     update_type_values = UpdateType.__members__.values()
+    _update_types = {
+        update_type.value: update_type
+        for update_type in UpdateType.__members__.values()
+    }
     before_interceptor_value = InterceptorType.BEFORE.value
     after_interceptor_value = InterceptorType.AFTER.value
 
@@ -37,9 +193,20 @@ class TelegramRouter:
         self,
         name: str,
         handlers: Optional[Iterable[UpdateHandler]] = None,
+        executor: Optional[Executor] = None,
+        sync_handler_workers: Optional[int] = None,
+        max_sync_handlers_per_bot: Optional[int] = None,
     ):
         self._name = name
         self._route_map = {}
+        self._compiled_routes = {}
+        if executor is None and sync_handler_workers:
+            executor = ThreadPoolExecutor(
+                max_workers=sync_handler_workers,
+                thread_name_prefix="router-{0}".format(name))
+        self._executor = executor
+        self._max_sync_handlers_per_bot = max_sync_handlers_per_bot
+        self._bot_semaphores = {}
         self._handler_callers = {
             UpdateType.MESSAGE: self.__call_message_handler,
             UpdateType.EDITED_MESSAGE: self.__call_edited_message_handler,
@@ -55,6 +222,8 @@ class TelegramRouter:
             self.__call_pre_checkout_query_handler,
             UpdateType.POLL: self.__call_poll_handler,
             UpdateType.POLL_ANSWER: self.__call_poll_answer_handler,
+            UpdateType.MY_CHAT_MEMBER: self.__call_chat_member_handler,
+            UpdateType.CHAT_MEMBER: self.__call_chat_member_handler,
         }
         self.register_handlers(handlers)
 
@@ -62,6 +231,10 @@ class TelegramRouter:
     def name(self):
         return self._name
 
+    @property
+    def executor(self) -> Optional[Executor]:
+        return self._executor
+
     def register_handlers(self, handlers):
         if not handlers:
             return
@@ -189,6 +362,8 @@ class TelegramRouter:
     def register_handler(self, handler: UpdateHandler):
         if not isinstance(handler, UpdateHandler):
             raise TelegramBotException("need a UpdateHandler")
+        # routes are compiled again on the next update
+        self._compiled_routes = {}
         for update_type in handler.update_types:
             logger.info("bind a %s Handler: '%s@%s'", update_type, handler,
                         self.name)
@@ -294,6 +469,12 @@ class TelegramRouter:
     def register_poll_answer_handler(self, callback: Callable):
         self.register_handler(PollAnswerHandler(callback=callback))
 
+    def register_my_chat_member_handler(self, callback: Callable):
+        self.register_handler(MyChatMemberHandler(callback=callback))
+
+    def register_chat_member_handler(self, callback: Callable):
+        self.register_handler(ChatMemberHandler(callback=callback))
+
     ###################################################################################
     #
     # register handlers with decorators
@@ -439,14 +620,26 @@ class TelegramRouter:
 
         return decorator
 
+    def my_chat_member_handler(self):
+        def decorator(callback):
+            self.register_my_chat_member_handler(callback)
+            return callback
+
+        return decorator
+
+    def chat_member_handler(self):
+        def decorator(callback):
+            self.register_chat_member_handler(callback)
+            return callback
+
+        return decorator
+
     ###################################################################################
     #
     # call handlers
     #
     ##################################################################################
     async def route(self, bot: TelegramBot, update: Update):
-        if update.update_id > bot.last_update_id:
-            bot.last_update_id = update.update_id
         update_type, data = self.parse_update_type_and_data(update)
         try:
             if update_type is None:
@@ -459,11 +652,25 @@ class TelegramRouter:
         finally:
             await self.__call_after_interceptor(update_type, bot, data)
 
-    @classmethod
-    async def __call_handler(cls, handler: UpdateHandler, *args,
-                             **kwargs) -> bool:
-        return cls.next_call if await handler(*args, **
-                                              kwargs) else cls.stop_call
+    async def __run_handler(self, handler: UpdateHandler, bot: TelegramBot,
+                            *args, **kwargs):
+        if handler.is_async or self._executor is None:
+            return await handler(bot, *args, **kwargs)
+        if not self._max_sync_handlers_per_bot:
+            return await handler.run_in_executor(self._executor, bot, *args,
+                                                 **kwargs)
+        semaphore = self._bot_semaphores.get(bot.token, None)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self._max_sync_handlers_per_bot)
+            self._bot_semaphores[bot.token] = semaphore
+        async with semaphore:
+            return await handler.run_in_executor(self._executor, bot, *args,
+                                                 **kwargs)
+
+    async def __call_handler(self, handler: UpdateHandler, bot: TelegramBot,
+                             *args, **kwargs) -> bool:
+        return self.next_call if await self.__run_handler(
+            handler, bot, *args, **kwargs) else self.stop_call
 
     async def __call_before_interceptor(self, update_type: UpdateType,
                                         bot: TelegramBot,
@@ -530,6 +737,9 @@ class TelegramRouter:
 
     async def __call_force_reply_handler(self, bot: TelegramBot,
                                          message: Message) -> bool:
+        if not self._route_map.get(UpdateType.FORCE_REPLY.value, None):
+            # nobody could be in a force reply flow without force reply handlers
+            return self.next_call
         force_reply_callback_name, force_reply_args = bot.get_force_reply(
             message.chat.id)
         if force_reply_callback_name is None:
@@ -544,33 +754,24 @@ class TelegramRouter:
                                              *force_reply_args)
         return await self.__call_handler(handler, bot, message)
 
+    def __compile_message_route(self,
+                                update_type: UpdateType) -> _CompiledMessageRoute:
+        compiled_route = self._compiled_routes.get(update_type.value, None)
+        if compiled_route is None:
+            compiled_route = _CompiledMessageRoute(
+                self._route_map.get(update_type.value, None) or {})
+            self._compiled_routes[update_type.value] = compiled_route
+        return compiled_route
+
     async def __call_message_like_handler(self, update_type: UpdateType,
                                           bot: TelegramBot, message: Message):
-        route = self._route_map.get(update_type.value, None)
-        if not route:
-            return self.next_call
-        # call 'and' handlers
-        and_group = route.get("and", None)
-        if and_group:
-            message_fields_as_set = set(message.keys())
-            for fields, handler in and_group:
-                if fields <= message_fields_as_set:
-                    if (await self.__call_handler(handler, bot, message) is
-                            self.stop_call):
-                        return self.stop_call
-        # call 'or' handlers
-        or_group = route.get("or", None)
-        if or_group:
-            for message_field, handlers in or_group.items():
-                if message_field in message:
-                    for handler in handlers:
-                        if (await self.__call_handler(handler, bot, message) is
-                                self.stop_call):
-                            return self.stop_call
-        # call the handler on any fields
-        handler = route.get("any", None)
-        if handler:
-            return await self.__call_handler(handler, bot, message)
+        # 'and' handlers, then 'or' handlers, then the handler on any fields
+        for handler in self.__compile_message_route(update_type).match(
+                message):
+            if (await self.__call_handler(handler, bot, message) is
+                    self.stop_call):
+                return self.stop_call
+        return self.next_call
 
     async def __call_message_handler(self, update_type: UpdateType,
                                      bot: TelegramBot, message: Message):
@@ -624,11 +825,18 @@ class TelegramRouter:
                     *json.loads(start_and_args[1])
                     if len(start_and_args) == 2 else None) is self.stop_call):
                 return
-        for handler in routes.get("callback_data_regex", ()):
-            result = handler.callback_data_match(callback_query)
-            if result and await handler(bot, callback_query,
-                                        result) is self.stop_call:
-                return
+        if "callback_data_regex" in routes:
+            compiled_patterns = self._compiled_routes.get(
+                "callback_data_regex", None)
+            if compiled_patterns is None:
+                compiled_patterns = _CompiledCallbackDataPatterns(
+                    routes["callback_data_regex"])
+                self._compiled_routes["callback_data_regex"] = compiled_patterns
+            for handler, result in compiled_patterns.match(
+                    callback_query.data):
+                if await self.__run_handler(handler, bot, callback_query,
+                                            result) is self.stop_call:
+                    return
         for handler in routes.get("callback_data_parse", ()):
             result = handler.callback_data_parse(callback_query)
             if result:
@@ -683,6 +891,11 @@ class TelegramRouter:
                                          poll_answer: PollAnswer):
         await self.__call_inline_query_handler(update_type, bot, poll_answer)
 
+    async def __call_chat_member_handler(self, update_type: UpdateType,
+                                         bot: TelegramBot,
+                                         chat_member: ChatMemberUpdated):
+        await self.__call_inline_query_handler(update_type, bot, chat_member)
+
     def get_force_reply_handler(self,
                                 callback_name: str) -> Optional[Callable]:
         force_reply_type_value = UpdateType.FORCE_REPLY.value
@@ -694,6 +907,11 @@ class TelegramRouter:
     def has_force_reply_callback(self, callback_name: str) -> bool:
         return self.get_force_reply_handler(callback_name) is not None
 
+    @property
+    def force_reply_callback_names(self) -> Tuple[str]:
+        return tuple(
+            self._route_map.get(UpdateType.FORCE_REPLY.value, None) or ())
+
     def has_callback_query_handler(self, callback: Callable) -> bool:
         if "callback_query" in self._route_map:
             callback_name = "{0}.{1}".format(callback.__module__,
@@ -726,7 +944,19 @@ class TelegramRouter:
         cls,
         update: Update,
     ) -> Tuple[Optional[UpdateType], Optional[TelegramObject]]:
-        for name, value in update.items():
-            if name in cls.update_type_values:
-                return UpdateType(name), value
+        for name in update.keys():
+            update_type = cls._update_types.get(name, None)
+            if update_type is not None:
+                return update_type, update[name]
         return None, None
+
+    @classmethod
+    def parse_update_chat_id(cls, update: Update) -> Optional[int]:
+        _, data = cls.parse_update_type_and_data(update)
+        if data is None:
+            return None
+        chat = data.chat or (data.message.chat if data.message else None)
+        if chat:
+            return chat.id
+        user = data.from_user or data.user
+        return user.id if user else None
@@ -0,0 +1,257 @@
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import threading
+from typing import Dict, List, Optional
+
+from telegrambotclient.base import (TelegramBotException, TelegramObject,
+                                    Update)
+from telegrambotclient.router import TelegramRouter
+from telegrambotclient.utils import update_to_dict
+
+logger = logging.getLogger("telegram-bot-client")
+
+# a frame is a 4 bytes big-endian length and a json of [sequence, token, update]
+_frame_header = struct.Struct(">I")
+# an ack is the sequence of a frame and whether its update has been dispatched
+_ack_frame = struct.Struct(">Q?")
+
+
+async def _serve_shard(bot_client, sock: socket.socket, concurrency: int,
+                       backlog: int):
+    reader, writer = await asyncio.open_connection(sock=sock)
+    running = asyncio.Semaphore(concurrency)
+    pending = asyncio.Semaphore(backlog)
+    # the last task of every chat, a task waits for the previous one of its chat
+    lanes = {}
+
+    def ack(sequence: int, dispatched: bool):
+        if not writer.is_closing():
+            writer.write(_ack_frame.pack(sequence, dispatched))
+
+    async def dispatch(lane, previous, sequence, bot, update):
+        # an update is acked as dispatched once it is handled or dropped as a dead update
+        # by handle_update, only a worker which can not take it acks False
+        dispatched = False
+        try:
+            if previous is not None:
+                await previous
+            async with running:
+                await bot.handle_update(update)
+            dispatched = True
+        except Exception:
+            logger.exception("failed to dispatch update: %s", update.update_id)
+        finally:
+            pending.release()
+            if lanes.get(lane, None) is asyncio.current_task():
+                del lanes[lane]
+            ack(sequence, dispatched)
+
+    while True:
+        try:
+            size, = _frame_header.unpack(
+                await reader.readexactly(_frame_header.size))
+            sequence, token, raw_update = json.loads(await
+                                                     reader.readexactly(size))
+        except asyncio.IncompleteReadError:
+            # the front process has closed the connection
+            break
+        bot = bot_client.bot(token)
+        if bot is None:
+            logger.warning("no bot found with token: '%s'", token)
+            ack(sequence, False)
+            continue
+        update = bot.update_class(**raw_update)
+        chat_id = bot.router.parse_update_chat_id(update)
+        lane = ("update", update.update_id) if chat_id is None else chat_id
+        await pending.acquire()
+        lanes[lane] = asyncio.ensure_future(
+            dispatch(lane, lanes.get(lane, None), sequence, bot, update))
+    if lanes:
+        await asyncio.gather(*lanes.values())
+    # acks are flushed before the process exits
+    writer.close()
+    await writer.wait_closed()
+
+
+def _run_shard(bot_client, sock: socket.socket, front_socks: List,
+               concurrency: int, backlog: int):
+    # the front process stops on SIGINT and closes the connection
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # front ends inherited by the fork would keep other workers from seeing EOF
+    for front_sock in front_socks:
+        front_sock.close()
+    asyncio.run(_serve_shard(bot_client, sock, concurrency, backlog))
+
+
+class TelegramShards:
+    """
+    Dispatches updates to forked worker processes partitioned by chat id.
+    Every update of a chat goes to the same worker, which dispatches it after the previous
+    updates of the chat, so a worker only needs the sessions of its own chats.
+    A worker acks every update after its handlers have finished, dispatch returns then and
+    raises if the update failed or the worker is gone, so polling only confirms updates which
+    have been dispatched and durable polling works with shards as without them.
+    Workers are forked from the current process with its bots and routers, so shards are only
+    supported where fork is, and they should be started before the front process starts
+    threads or connects to anything.
+    Attributes:
+        _bot_client: the TelegramBotClient which owns the bots
+        _workers_num: the number of worker processes, one per cpu by default
+        _concurrency: the max number of updates dispatched at the same time by a worker
+        _backlog: the max number of updates queued in a worker
+        _processes: worker processes
+        _socks: the front ends of socket pairs to workers
+        _writers: a future of stream writers of _socks on the running event loop
+        _sequence: sequences of frames
+        _acks: {sequence: (the worker of the frame, a future of its ack)}
+        _ack_readers: tasks reading acks of workers
+    """
+
+    __slots__ = ("_bot_client", "_workers_num", "_concurrency", "_backlog",
+                 "_processes", "_socks", "_writers", "_sequence", "_acks",
+                 "_ack_readers")
+
+    def __init__(self,
+                 bot_client,
+                 workers: Optional[int] = None,
+                 concurrency: int = 64,
+                 backlog: int = 1024):
+        self._bot_client = bot_client
+        self._workers_num = max(workers or os.cpu_count() or 1, 1)
+        self._concurrency = max(concurrency, 1)
+        self._backlog = max(backlog, 1)
+        self._processes = []
+        self._socks = []
+        self._writers = None
+        self._sequence = itertools.count()
+        self._acks = {}
+        self._ack_readers = []
+
+    @property
+    def workers(self) -> int:
+        return self._workers_num
+
+    @property
+    def concurrency(self) -> int:
+        """the max number of updates dispatched at the same time by all workers"""
+        return self._workers_num * self._concurrency
+
+    def start(self):
+        if "fork" not in multiprocessing.get_all_start_methods():
+            raise TelegramBotException(
+                "shard workers are forked with the bots of this process, fork is not supported on this platform"
+            )
+        if threading.active_count() > 1:
+            logger.warning(
+                "shard workers are forked from a process with %s threads, locks held by other threads are never released in workers",
+                threading.active_count())
+        context = multiprocessing.get_context("fork")
+        for _ in range(self._workers_num):
+            front_sock, worker_sock = socket.socketpair()
+            process = context.Process(
+                target=_run_shard,
+                args=(self._bot_client, worker_sock,
+                      self._socks + [front_sock], self._concurrency,
+                      self._backlog),
+                daemon=True)
+            process.start()
+            worker_sock.close()
+            self._processes.append(process)
+            self._socks.append(front_sock)
+        logger.info("started %s shard workers", self._workers_num)
+
+    def shard_of(self, update: Dict) -> int:
+        if not isinstance(update, TelegramObject):
+            update = Update(**update)
+        chat_id = TelegramRouter.parse_update_chat_id(update)
+        if chat_id is None:
+            chat_id = update.update_id or 0
+        return hash(chat_id) % self._workers_num
+
+    async def __read_acks(self, shard: int, reader: asyncio.StreamReader):
+        try:
+            while True:
+                sequence, dispatched = _ack_frame.unpack(
+                    await reader.readexactly(_ack_frame.size))
+                _, ack = self._acks.pop(sequence, (None, None))
+                if ack is not None and not ack.done():
+                    ack.set_result(dispatched)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        # updates sent to a worker which is gone are not dispatched
+        for sequence, (ack_shard, ack) in tuple(self._acks.items()):
+            if ack_shard == shard:
+                del self._acks[sequence]
+                if not ack.done():
+                    ack.set_exception(
+                        TelegramBotException("shard worker {0} exited".format(
+                            self._processes[shard].pid)))
+
+    async def __connect(self) -> List[asyncio.StreamWriter]:
+        writers = []
+        for shard, sock in enumerate(self._socks):
+            reader, writer = await asyncio.open_connection(sock=sock)
+            writers.append(writer)
+            self._ack_readers.append(
+                asyncio.ensure_future(self.__read_acks(shard, reader)))
+        return writers
+
+    async def __writers(self) -> List[asyncio.StreamWriter]:
+        if self._writers is None:
+            # the first updates may be dispatched concurrently
+            self._writers = asyncio.ensure_future(self.__connect())
+        return await asyncio.shield(self._writers)
+
+    async def dispatch(self, token: str, update: Dict):
+        """send an update to its worker and wait for its ack, an awaitable callable with
+        (token, update) for TelegramBot.polling and TelegramWebhookServer"""
+        shard = self.shard_of(update)
+        writer = (await self.__writers())[shard]
+        sequence = next(self._sequence)
+        frame = json.dumps(
+            (sequence, token, update_to_dict(update))).encode("utf-8")
+        ack = asyncio.get_running_loop().create_future()
+        self._acks[sequence] = (shard, ack)
+        try:
+            writer.write(_frame_header.pack(len(frame)) + frame)
+            await writer.drain()
+            dispatched = await ack
+        finally:
+            self._acks.pop(sequence, None)
+        if not dispatched:
+            raise TelegramBotException(
+                "failed to dispatch update {0} in shard worker {1}".format(
+                    update["update_id"] if isinstance(update, dict) else
+                    update.update_id, self._processes[shard].pid))
+
+    async def stop(self):
+        """close connections to workers and wait them to finish queued updates"""
+        writers = await self.__writers()
+        for writer in writers:
+            # workers see EOF and still ack queued updates
+            writer.write_eof()
+        if self._ack_readers:
+            await asyncio.gather(*self._ack_readers)
+        for writer in writers:
+            writer.close()
+        loop = asyncio.get_running_loop()
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join)
+            if process.exitcode:
+                logger.warning("shard worker %s exited with %s", process.pid,
+                               process.exitcode)
+        self._processes.clear()
+        self._socks.clear()
+        self._writers = None
+        self._ack_readers.clear()
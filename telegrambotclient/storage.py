@@ -3,13 +3,24 @@ try:
 except ImportError:
     import json
 
+import hashlib
+import heapq
+import itertools
+import logging
 import os
 import sqlite3
-from datetime import datetime
-from typing import Any, Dict, Optional
-
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Optional, Set, Tuple
+
+from telegrambotclient.base import InputFile
 from telegrambotclient.utils import pretty_format
 
+logger = logging.getLogger("telegram-bot-client")
+
 
 class TelegramStorage:
     def set_value(self, key: str, field: str, value, expires: int) -> bool:
@@ -27,229 +38,659 @@ class TelegramStorage:
     def dict(self, key: str, expires: int) -> Dict:
         raise NotImplementedError()
 
+    def get_many(self, key: str, fields: Iterable[str],
+                 expires: int) -> Dict:
+        """get values of fields in a batch, missing fields are not in the result"""
+        values = {}
+        for field in fields:
+            value = self.get_value(key, field, expires)
+            if value is not None:
+                values[field] = value
+        return values
+
+    def set_many(self, key: str, mapping: Dict, expires: int) -> bool:
+        """set values of fields in a batch, a field is deleted if its value is None"""
+        result = True
+        for field, value in mapping.items():
+            if value is None:
+                self.delete_field(key, field, expires)
+            else:
+                result = self.set_value(key, field, value, expires) and result
+        return result
+
+    def process_config(self) -> Optional[Tuple[Callable, Tuple]]:
+        """a picklable (factory, args) which opens this storage in another process,
+        None if it can not be shared"""
+        return None
+
 
 class MemoryStorage(TelegramStorage):
-    __slots__ = ("_data", )
+    """
+    An in-memory storage for one process, expired keys are swept from a heap of expiry times
+    on every write. Keys are evicted in LRU order when there are more than max_keys, which is
+    unbounded by default since bot internals like polling state and flood control keep their
+    state in the storage too.
+    Attributes:
+        _data: an OrderedDict of key -> [expires on the monotonic clock, fields] in LRU order
+        _expiry_heap: a heap of (expires, sequence, key, entry), an expires which is refreshed
+                      later is pushed again when it is popped
+        _max_keys: the max number of keys, None is unbounded
+        _lock: a lock for handlers running in threads
+    """
+
+    __slots__ = ("_data", "_expiry_heap", "_sequence", "_max_keys", "_lock",
+                 "_hits", "_misses", "_evictions", "_expirations")
+    _sweep_batch = 256
+
+    def __init__(self, max_keys: Optional[int] = None):
+        self._data = OrderedDict()
+        self._expiry_heap = []
+        self._sequence = itertools.count()
+        self._max_keys = max_keys
+        self._lock = threading.RLock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
 
-    def __init__(self):
-        self._data = {}
+    @property
+    def stats(self) -> Dict:
+        return {
+            "keys": len(self._data),
+            "hits": self._hits,
+            "misses": self._misses,
+            "evictions": self._evictions,
+            "expirations": self._expirations,
+        }
+
+    def __sweep(self, current_time: float):
+        heap = self._expiry_heap
+        for _ in range(self._sweep_batch):
+            if not heap or heap[0][0] >= current_time:
+                break
+            _, _, key, entry = heapq.heappop(heap)
+            if self._data.get(key, None) is not entry:
+                continue
+            if entry[0] < current_time:
+                del self._data[key]
+                self._expirations += 1
+            else:
+                heapq.heappush(heap,
+                               (entry[0], next(self._sequence), key, entry))
+        if len(heap) > 2 * len(self._data) + self._sweep_batch:
+            # drop entries of deleted and evicted keys
+            self._expiry_heap = [(entry[0], next(self._sequence), key, entry)
+                                 for key, entry in self._data.items()]
+            heapq.heapify(self._expiry_heap)
+
+    def __entry(self, key: str, expires: int, create: bool = False):
+        """get an alive entry and refresh its expires, a write creates the entry and sweeps"""
+        current_time = time.monotonic()
+        if create:
+            self.__sweep(current_time)
+        entry = self._data.get(key, None)
+        if entry is not None and entry[0] < current_time:
+            del self._data[key]
+            self._expirations += 1
+            entry = None
+        if entry is None:
+            if not create:
+                return None
+            entry = [current_time + expires, {}]
+            self._data[key] = entry
+            heapq.heappush(self._expiry_heap,
+                           (entry[0], next(self._sequence), key, entry))
+            if self._max_keys is not None:
+                while len(self._data) > self._max_keys:
+                    self._data.popitem(last=False)
+                    self._evictions += 1
+            return entry
+        entry[0] = current_time + expires
+        self._data.move_to_end(key)
+        return entry
 
     def set_value(self, key: str, field: str, value, expires: int) -> bool:
         if value is None:
             self.delete_field(key, field, expires)
             return True
-        current_time = int(datetime.now().timestamp())
-        if key not in self._data or self._data[key].get("expires",
-                                                        0) < current_time:
-            self._data[key] = {
-                "expires": current_time + expires,
-                "data": {
-                    field: value
-                },
-            }
-            return True
-        data = self._data[key]
-        data["expires"] = current_time + expires
-        data["data"][field] = value
+        with self._lock:
+            self.__entry(key, expires, create=True)[1][field] = value
         return True
 
     def get_value(self, key: str, field: str, expires: int) -> Any:
-        current_time = int(datetime.now().timestamp())
-        if key not in self._data or self._data[key].get("expires",
-                                                        0) < current_time:
-            self.delete_key(key)
-            return None
-        data = self._data[key]
-        data["expires"] = current_time + expires
-        return data["data"].get(field, None)
+        with self._lock:
+            entry = self.__entry(key, expires)
+            value = None if entry is None else entry[1].get(field, None)
+            if value is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+            return value
 
     def delete_field(self, key: str, field: str, expires: int) -> bool:
-        current_time = int(datetime.now().timestamp())
-        if key not in self._data or self._data[key].get("expires",
-                                                        0) < current_time:
-            self.delete_key(key)
-            return False
-        data = self._data[key]
-        data["expires"] = current_time + expires
-        if field in data["data"]:
-            del data["data"][field]
-            self._data[key] = data
-        return True
+        with self._lock:
+            self.__sweep(time.monotonic())
+            entry = self.__entry(key, expires)
+            if entry is None:
+                return False
+            entry[1].pop(field, None)
+            return True
 
     def delete_key(self, key: str) -> bool:
-        if key in self._data:
-            del self._data[key]
+        with self._lock:
+            self.__sweep(time.monotonic())
+            self._data.pop(key, None)
         return True
 
     def dict(self, key: str, expires: int) -> Dict:
-        current_time = int(datetime.now().timestamp())
-        if key not in self._data or self._data[key].get("expires",
-                                                        0) < current_time:
-            self.delete_key(key)
-            return {}
-        self._data[key]["expires"] = current_time + expires
-        return self._data[key]["data"]
+        with self._lock:
+            entry = self.__entry(key, expires)
+            if entry is None:
+                self._misses += 1
+                return {}
+            self._hits += 1
+            return dict(entry[1])
+
+    def set_many(self, key: str, mapping: Dict, expires: int) -> bool:
+        with self._lock:
+            fields = self.__entry(key, expires, create=True)[1]
+            for field, value in mapping.items():
+                if value is None:
+                    fields.pop(field, None)
+                else:
+                    fields[field] = value
+        return True
 
 
 class SQLiteStorage(TelegramStorage):
-    __slots__ = ("_db_conn", )
+    """
+    One row per (key, field) and one row per key with its expires, so a field is read or
+    written without touching other fields of the key. A db file is opened in WAL mode with a
+    connection per thread, an in-memory db has one connection behind a lock.
+    Expired keys are purged by a background thread every purge_interval seconds.
+    Attributes:
+        _db_file: the db file, None for an in-memory db
+        _local: thread local connections of a db file
+        _connections: opened connections, a connection is closed when its thread exits
+        _memory_conn: the connection of an in-memory db
+        _lock: the lock of opening connections and of the in-memory db
+        _stopped: an event which stops the purge thread
+    """
+
+    __slots__ = ("_db_file", "_local", "_connections", "_memory_conn",
+                 "_lock", "_stopped")
+    _touch_interval = 60
 
-    def __init__(self, db_file: Optional[str] = None):
+    def __init__(self,
+                 db_file: Optional[str] = None,
+                 purge_interval: Optional[int] = 60):
+        self._db_file = db_file
+        self._local = threading.local()
+        self._connections = set()
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
         if db_file is None:
-            self._db_conn = sqlite3.connect(
-                "file:memory?cache=shared&mode=memory", uri=True)
+            self._memory_conn = sqlite3.connect(":memory:",
+                                                check_same_thread=False)
         else:
             db_path = os.path.dirname(db_file)
-            if not os.path.exists(db_path):
+            if db_path and not os.path.exists(db_path):
                 os.mkdir(db_path)
-            self._db_conn = sqlite3.connect(db_file)
-        self._db_conn.row_factory = sqlite3.Row
-        with self._db_conn:
-            self._db_conn.execute("""
-                CREATE TABLE IF NOT EXISTS `t_storage` (
-                    `key`        TEXT NOT NULL UNIQUE,
-                    `data`       TEXT NOT NULL,
+            self._memory_conn = None
+        with self.__connection() as db_conn:
+            db_conn.executescript("""
+                CREATE TABLE IF NOT EXISTS `t_storage_key` (
+                    `key`        TEXT NOT NULL,
                     `expires`    INTEGER NOT NULL,
                     PRIMARY KEY(`key`)
-                    )
+                    );
+                CREATE INDEX IF NOT EXISTS `i_storage_key_expires`
+                    ON `t_storage_key` (`expires`);
+                CREATE TABLE IF NOT EXISTS `t_storage_field` (
+                    `key`        TEXT NOT NULL,
+                    `field`      TEXT NOT NULL,
+                    `value`      TEXT NOT NULL,
+                    PRIMARY KEY(`key`, `field`)
+                    ) WITHOUT ROWID;
                 """)
+            self.__migrate(db_conn)
+        if purge_interval:
+            threading.Thread(target=self._purge_periodically,
+                             args=(weakref.ref(self), self._stopped,
+                                   purge_interval),
+                             name="sqlite-storage-purge",
+                             daemon=True).start()
+
+    def process_config(self) -> Optional[Tuple[Callable, Tuple]]:
+        if self._db_file is None:
+            return None
+        # expired keys are purged by this process
+        return SQLiteStorage, (self._db_file, None)
+
+    @staticmethod
+    def __migrate(db_conn: sqlite3.Connection):
+        """move data of the former one-json-per-key table `t_storage`"""
+        if not db_conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name='t_storage'"
+        ).fetchone():
+            return
+        for key, data, expires in db_conn.execute(
+                "SELECT key, data, expires FROM t_storage").fetchall():
+            db_conn.execute(
+                "INSERT OR REPLACE INTO t_storage_key (key, expires) VALUES (?, ?)",
+                (key, expires))
+            db_conn.executemany(
+                "INSERT OR REPLACE INTO t_storage_field (key, field, value) VALUES (?, ?, ?)",
+                ((key, field, json.dumps(value))
+                 for field, value in json.loads(data).items()))
+        db_conn.execute("DROP TABLE t_storage")
+
+    def __open(self) -> sqlite3.Connection:
+        db_conn = sqlite3.connect(self._db_file,
+                                  timeout=30,
+                                  check_same_thread=False)
+        db_conn.execute("PRAGMA journal_mode=WAL")
+        db_conn.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            self._connections.add(db_conn)
+        # threads of a pool come and go, their connections must not be leaked
+        weakref.finalize(threading.current_thread(), self._close_connection,
+                         db_conn, self._connections, self._lock)
+        return db_conn
+
+    @staticmethod
+    def _close_connection(db_conn: sqlite3.Connection, connections: Set,
+                          lock: threading.RLock):
+        with lock:
+            connections.discard(db_conn)
+        db_conn.close()
+
+    @contextmanager
+    def __connection(self):
+        """a connection in a transaction"""
+        if self._memory_conn is not None:
+            with self._lock, self._memory_conn:
+                yield self._memory_conn
+            return
+        db_conn = getattr(self._local, "db_conn", None)
+        if db_conn is None:
+            db_conn = self._local.db_conn = self.__open()
+        with db_conn:
+            yield db_conn
+
+    @staticmethod
+    def _purge_periodically(storage_ref: weakref.ref,
+                            stopped: threading.Event, purge_interval: int):
+        while not stopped.wait(purge_interval):
+            storage = storage_ref()
+            if storage is None:
+                return
+            try:
+                storage.purge()
+            except sqlite3.Error:
+                logger.exception("failed to purge expired keys")
+            del storage
+
+    def purge(self) -> int:
+        """delete expired keys and return how many keys are deleted"""
+        current_time = int(time.time())
+        with self.__connection() as db_conn:
+            db_conn.execute(
+                """
+                DELETE FROM t_storage_field WHERE key IN (
+                    SELECT key FROM t_storage_key WHERE expires<?
+                )
+                """, (current_time, ))
+            return db_conn.execute(
+                "DELETE FROM t_storage_key WHERE expires<?",
+                (current_time, )).rowcount
+
+    def close(self):
+        self._stopped.set()
+        with self._lock:
+            for db_conn in tuple(self._connections):
+                db_conn.close()
+            self._connections.clear()
+            if self._memory_conn is not None:
+                self._memory_conn.close()
+        self._local = threading.local()
 
     def __del__(self):
-        self._db_conn.close()
-
-    def set_value(self, key: str, field: str, value: str,
-                  expires: int) -> bool:
-        with self._db_conn:
-            cur = self._db_conn.execute(
-                "SELECT data, expires from t_storage WHERE key=?", (key, ))
-            row_data = cur.fetchone()
-            current_time = int(datetime.now().timestamp())
-            if row_data and row_data["expires"] >= current_time:
-                data = json.loads(row_data["data"])
-                data[field] = value
-                cur = self._db_conn.execute(
-                    "UPDATE t_storage SET data=?, expires=? WHERE key=?",
-                    (json.dumps(data), current_time + expires, key),
-                )
-                return bool(cur.rowcount)
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    @classmethod
+    def __touch(cls, db_conn: sqlite3.Connection, key: str,
+                expires: int) -> bool:
+        """refresh an alive key's expires, return False if the key is absent or expired.
+        It is only written when the expires would move by _touch_interval seconds or by a tenth
+        of expires if that is less, so reads of a hot key do not take the write lock each time."""
+        current_time = int(time.time())
+        row_data = db_conn.execute(
+            "SELECT expires FROM t_storage_key WHERE key=?",
+            (key, )).fetchone()
+        if row_data is None or row_data[0] < current_time:
+            return False
+        if current_time + expires - row_data[0] >= min(
+                cls._touch_interval, expires // 10):
+            db_conn.execute("UPDATE t_storage_key SET expires=? WHERE key=?",
+                            (current_time + expires, key))
+        return True
 
-            cur = self._db_conn.execute(
-                """
-                INSERT OR REPLACE INTO t_storage (
-                    key,
-                    data,
-                    expires
-                ) VALUES (?, ?, ?)
-                """,
-                (key, json.dumps({field: value}), current_time + expires),
+    @staticmethod
+    def __upsert_key(db_conn: sqlite3.Connection, key: str, expires: int):
+        """create or refresh a key, fields of an expired key are dropped"""
+        current_time = int(time.time())
+        db_conn.execute(
+            """
+            DELETE FROM t_storage_field WHERE key=? AND EXISTS (
+                SELECT 1 FROM t_storage_key WHERE key=? AND expires<?
             )
-            return bool(cur.lastrowid)
+            """, (key, key, current_time))
+        db_conn.execute(
+            """
+            INSERT INTO t_storage_key (key, expires) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET expires=excluded.expires
+            """, (key, current_time + expires))
+
+    _upsert_field_sql = """
+        INSERT INTO t_storage_field (key, field, value) VALUES (?, ?, ?)
+        ON CONFLICT(key, field) DO UPDATE SET value=excluded.value
+        """
+
+    def set_value(self, key: str, field: str, value, expires: int) -> bool:
+        with self.__connection() as db_conn:
+            self.__upsert_key(db_conn, key, expires)
+            return bool(
+                db_conn.execute(self._upsert_field_sql,
+                                (key, field, json.dumps(value))).rowcount)
 
     def get_value(self, key: str, field: str, expires: int) -> Any:
-        with self._db_conn:
-            cur = self._db_conn.execute(
-                "SELECT data, expires from t_storage WHERE key=?", (key, ))
-            row_data = cur.fetchone()
-            current_time = int(datetime.now().timestamp())
-            if row_data and row_data["expires"] >= current_time:
-                self._db_conn.execute(
-                    "UPDATE t_storage SET expires=? WHERE key=?",
-                    (current_time + expires, key),
-                )
-                return json.loads(row_data["data"]).get(field, None)
-            return None
+        with self.__connection() as db_conn:
+            if not self.__touch(db_conn, key, expires):
+                return None
+            row_data = db_conn.execute(
+                "SELECT value FROM t_storage_field WHERE key=? AND field=?",
+                (key, field)).fetchone()
+            return json.loads(row_data[0]) if row_data else None
 
     def delete_field(self, key: str, field: str, expires: int) -> bool:
-        with self._db_conn:
-            cur = self._db_conn.execute(
-                "SELECT data, expires from t_storage WHERE key=?", (key, ))
-            row_data = cur.fetchone()
-            current_time = int(datetime.now().timestamp())
-            if row_data and row_data["expires"] >= current_time:
-                data = json.loads(row_data["data"])
-                if field in data:
-                    del data[field]
-                    cur = self._db_conn.execute(
-                        "UPDATE t_storage SET data=?, expires=? WHERE key=?",
-                        (json.dumps(data), current_time + expires, key),
-                    )
-                    return bool(cur.rowcount)
-            return False
+        with self.__connection() as db_conn:
+            if not self.__touch(db_conn, key, expires):
+                return False
+            return bool(
+                db_conn.execute(
+                    "DELETE FROM t_storage_field WHERE key=? AND field=?",
+                    (key, field)).rowcount)
 
-    def delete_key(self, key: str):
-        with self._db_conn:
-            self._db_conn.execute("DELETE from t_storage WHERE key=? ",
-                                  (key, ))
+    def delete_key(self, key: str) -> bool:
+        with self.__connection() as db_conn:
+            db_conn.execute("DELETE FROM t_storage_field WHERE key=?",
+                            (key, ))
+            return bool(
+                db_conn.execute("DELETE FROM t_storage_key WHERE key=?",
+                                (key, )).rowcount)
 
     def dict(self, key: str, expires: int) -> Dict:
-        with self._db_conn:
-            cur = self._db_conn.execute(
-                "SELECT data, expires from t_storage WHERE key=?", (key, ))
-            row_data = cur.fetchone()
-            current_time = int(datetime.now().timestamp())
-            if row_data and row_data["expires"] >= current_time:
-                self._db_conn.execute(
-                    "UPDATE t_storage SET expires=? WHERE key=?",
-                    (current_time + expires, key),
-                )
-                return json.loads(row_data["data"])
+        with self.__connection() as db_conn:
+            if not self.__touch(db_conn, key, expires):
+                return {}
+            return {
+                field: json.loads(value)
+                for field, value in db_conn.execute(
+                    "SELECT field, value FROM t_storage_field WHERE key=?",
+                    (key, ))
+            }
+
+    def get_many(self, key: str, fields: Iterable[str],
+                 expires: int) -> Dict:
+        fields = tuple(fields)
+        if not fields:
             return {}
+        with self.__connection() as db_conn:
+            if not self.__touch(db_conn, key, expires):
+                return {}
+            return {
+                field: json.loads(value)
+                for field, value in db_conn.execute(
+                    "SELECT field, value FROM t_storage_field WHERE key=? AND field IN ({0})"
+                    .format(", ".join("?" * len(fields))), (key, ) + fields)
+            }
+
+    def set_many(self, key: str, mapping: Dict, expires: int) -> bool:
+        with self.__connection() as db_conn:
+            self.__upsert_key(db_conn, key, expires)
+            db_conn.executemany(
+                self._upsert_field_sql,
+                ((key, field, json.dumps(value))
+                 for field, value in mapping.items() if value is not None))
+            db_conn.executemany(
+                "DELETE FROM t_storage_field WHERE key=? AND field=?",
+                ((key, field)
+                 for field, value in mapping.items() if value is None))
+        return True
+
+
+def _open_redis_storage(connection_class, connection_kwargs: Dict):
+    import redis
+    return RedisStorage(
+        redis.Redis(connection_pool=redis.ConnectionPool(
+            connection_class=connection_class, **connection_kwargs)))
 
 
 class RedisStorage(TelegramStorage):
+    """every operation and its expire are sent in one MULTI/EXEC pipeline"""
     __slots__ = ("_redis", )
+    # connection kwargs which connect another process to the same redis, objects like a
+    # credential provider or a retry can not be pickled
+    _process_connection_kwargs = ("host", "port", "path", "db", "username",
+                                  "password", "socket_timeout",
+                                  "socket_connect_timeout", "client_name",
+                                  "ssl_keyfile", "ssl_certfile",
+                                  "ssl_cert_reqs", "ssl_ca_certs",
+                                  "ssl_check_hostname")
 
     def __init__(self, redis):
         self._redis = redis
 
     def set_value(self, key: str, field: str, value, expires: int) -> bool:
-        self._redis.expire(key, expires)
-        if value:
-            return bool(self._redis.hset(key, field, json.dumps((value, ))))
-        return bool(self._redis.hdel(key, field))
+        with self._redis.pipeline() as pipe:
+            if value is not None:
+                pipe.hset(key, field, json.dumps((value, )))
+            else:
+                pipe.hdel(key, field)
+            pipe.expire(key, expires)
+            return bool(pipe.execute()[0])
 
     def get_value(self, key: str, field: str, expires: int) -> Any:
-        self._redis.expire(key, expires)
-        value = self._redis.hget(key, field)
+        with self._redis.pipeline() as pipe:
+            pipe.hget(key, field)
+            pipe.expire(key, expires)
+            value = pipe.execute()[0]
         if value:
             return json.loads(value)[0]
         return None
 
     def delete_field(self, key: str, field: str, expires: int) -> bool:
-        self._redis.expire(key, expires)
-        return bool(self._redis.hdel(key, field))
+        with self._redis.pipeline() as pipe:
+            pipe.hdel(key, field)
+            pipe.expire(key, expires)
+            return bool(pipe.execute()[0])
 
     def delete_key(self, key: str) -> bool:
         return bool(self._redis.delete(key))
 
+    def process_config(self) -> Optional[Tuple[Callable, Tuple]]:
+        connection_pool = getattr(self._redis, "connection_pool", None)
+        if connection_pool is None:
+            return None
+        connection_kwargs = {
+            name: value
+            for name, value in connection_pool.connection_kwargs.items()
+            if name in self._process_connection_kwargs
+        }
+        return _open_redis_storage, (connection_pool.connection_class,
+                                     connection_kwargs)
+
     def dict(self, key: str, expires: int) -> Dict:
-        self._redis.expire(key, expires)
+        with self._redis.pipeline() as pipe:
+            pipe.hgetall(key)
+            pipe.expire(key, expires)
+            values = pipe.execute()[0]
+        # field names are str like other storages, without decode_responses as well
+        return {
+            field.decode("utf-8") if isinstance(field, bytes) else field:
+            json.loads(value)[0]
+            for field, value in values.items()
+        }
+
+    def get_many(self, key: str, fields: Iterable[str],
+                 expires: int) -> Dict:
+        fields = tuple(fields)
+        if not fields:
+            return {}
+        with self._redis.pipeline() as pipe:
+            pipe.hmget(key, fields)
+            pipe.expire(key, expires)
+            values = pipe.execute()[0]
         return {
             field: json.loads(value)[0]
-            for field, value in self._redis.hgetall(key).items()
+            for field, value in zip(fields, values) if value
         }
 
+    def set_many(self, key: str, mapping: Dict, expires: int) -> bool:
+        values = {
+            field: json.dumps((value, ))
+            for field, value in mapping.items() if value is not None
+        }
+        deleted_fields = tuple(field for field, value in mapping.items()
+                               if value is None)
+        if not values and not deleted_fields:
+            return True
+        with self._redis.pipeline() as pipe:
+            if values:
+                pipe.hset(key, mapping=values)
+            if deleted_fields:
+                pipe.hdel(key, *deleted_fields)
+            pipe.expire(key, expires)
+            pipe.execute()
+        return True
+
+
+class FileIdCache:
+    """
+    file_ids of uploaded InputFiles, so the same content is uploaded once and sent by its
+    file_id later. file_ids are keyed by the send parameter and the content's sha256 digest,
+    the digest of a file path is also cached by its path, mtime and size to not hash it again.
+    A stream which can not seek is not cached, it could not be uploaded after it is hashed.
+    Attributes:
+        _storage: the storage where file_ids are persisted
+        _cache_key: the storage key of a bot's file_ids
+        _expires: seconds to keep file_ids since they are used at the last time
+    """
+
+    __slots__ = ("_storage", "_cache_key", "_expires")
+    _cache_key_format = "bot:file_id:{0}"
+
+    def __init__(self,
+                 storage: TelegramStorage,
+                 bot_id: int,
+                 expires: int = 2592000):
+        self._storage = storage
+        self._cache_key = self._cache_key_format.format(bot_id)
+        self._expires = expires
+
+    def __digest(self, input_file: InputFile) -> str:
+        file = input_file.file
+        path_field = None
+        if isinstance(file, str):
+            stat = os.stat(file)
+            path_field = "path:{0}:{1}:{2}".format(os.path.abspath(file),
+                                                   stat.st_mtime_ns,
+                                                   stat.st_size)
+            digest = self._storage.get_value(self._cache_key, path_field,
+                                             self._expires)
+            if digest:
+                return digest
+        sha256 = hashlib.sha256()
+        for chunk in input_file.iter_chunks():
+            sha256.update(chunk)
+        digest = sha256.hexdigest()
+        if path_field is not None:
+            self._storage.set_value(self._cache_key, path_field, digest,
+                                    self._expires)
+        return digest
+
+    def __field(self, param_name: str, input_file: InputFile) -> str:
+        return "{0}:{1}".format(param_name, self.__digest(input_file))
+
+    def get(self, param_name: str, input_file: InputFile) -> Optional[str]:
+        """the cached file_id of an InputFile sent as param_name, such as 'photo'"""
+        if not input_file.repeatable:
+            return None
+        return self._storage.get_value(self._cache_key,
+                                       self.__field(param_name, input_file),
+                                       self._expires)
+
+    def set(self, param_name: str, input_file: InputFile, file_id: str):
+        if not input_file.repeatable:
+            return
+        self._storage.set_value(self._cache_key,
+                                self.__field(param_name, input_file), file_id,
+                                self._expires)
+
+    def delete(self, param_name: str, input_file: InputFile):
+        if not input_file.repeatable:
+            return
+        self._storage.delete_field(self._cache_key,
+                                   self.__field(param_name, input_file),
+                                   self._expires)
+
 
 class TelegramSession:
+    """
+    A user's session data of a bot. By default every change is written to the storage at
+    once. In write-back mode changes are only kept in the session, then flush() writes them
+    in one batch, the bot does it when an update has been routed.
+    Attributes:
+        _local_data: values which are read or set
+        _write_back: whether changes wait for flush()
+        _dirty: changed fields to flush, a deleted field is None
+        _cleared: whether the stored session is to be cleared by flush()
+        _flush_expires: the expires to flush changes with
+    """
+
     __slots__ = ("_user_id", "_storage", "_session_id", "_expires",
-                 "_local_data")
+                 "_local_data", "_write_back", "_dirty", "_cleared",
+                 "_flush_expires")
     _session_key_format = "bot:session:{0}:{1}"
 
     def __init__(self,
                  bot_id: int,
                  user_id: int,
                  storage: TelegramStorage,
-                 expires: int = 1800) -> None:
+                 expires: int = 1800,
+                 write_back: bool = False) -> None:
         self._user_id = user_id
         self._storage = storage
         self._session_id = self._session_key_format.format(bot_id, user_id)
         self._expires = expires
         self._local_data = {}
+        self._write_back = write_back
+        self._dirty = {}
+        self._cleared = False
+        self._flush_expires = expires
 
     @property
     def id(self):
         return self._session_id
 
+    @property
+    def dirty(self) -> bool:
+        return bool(self._dirty) or self._cleared
+
     def get(self, field: str, default=None) -> Any:
         try:
             return self.__getitem__(field)
@@ -259,14 +700,52 @@ class TelegramSession:
     def __getitem__(self, field: str) -> Any:
         if field in self._local_data:
             return self._local_data[field]
+        if field in self._dirty or self._cleared:
+            raise KeyError("'{0}' is not found".format(field))
         value = self._storage.get_value(self._session_id, field, self._expires)
         if value:
             self._local_data[field] = value
             return value
         raise KeyError("'{0}' is not found".format(field))
 
+    def get_many(self, fields: Iterable[str]) -> Dict:
+        """get values of fields in one storage call, missing fields are not in the result"""
+        fields = tuple(fields)
+        values = {
+            field: self._local_data[field]
+            for field in fields if field in self._local_data
+        }
+        missing_fields = tuple(
+            field for field in fields
+            if field not in values and field not in self._dirty)
+        if missing_fields and not self._cleared:
+            stored_values = self._storage.get_many(self._session_id,
+                                                   missing_fields,
+                                                   self._expires)
+            self._local_data.update(stored_values)
+            values.update(stored_values)
+        return values
+
+    def set_many(self, mapping: Dict) -> bool:
+        """set values of fields in one storage call, a field is deleted if its value is None"""
+        for field, value in mapping.items():
+            if value is None:
+                self._local_data.pop(field, None)
+            else:
+                self._local_data[field] = value
+        if self._write_back:
+            self._dirty.update(mapping)
+            self._flush_expires = self._expires
+            return True
+        return self._storage.set_many(self._session_id, mapping,
+                                      self._expires)
+
     def set(self, field: str, value, expires: int = 1800) -> bool:
         self._local_data[field] = value
+        if self._write_back:
+            self._dirty[field] = value
+            self._flush_expires = expires
+            return True
         return self._storage.set_value(self._session_id, field, value, expires)
 
     def __setitem__(self, field: str, value):
@@ -275,6 +754,9 @@ class TelegramSession:
     def delete(self, field: str) -> bool:
         if field in self._local_data:
             del self._local_data[field]
+        if self._write_back:
+            self._dirty[field] = None
+            return True
         return self._storage.delete_field(self._session_id, field,
                                           self._expires)
 
@@ -291,13 +773,46 @@ class TelegramSession:
 
     def clear(self) -> bool:
         self._local_data = {}
+        if self._write_back:
+            self._dirty = {}
+            self._cleared = True
+            return True
         return self._storage.delete_key(self._session_id)
 
     @property
     def data(self) -> Dict:
-        self._local_data = self._storage.dict(self._session_id, self._expires)
+        if not self._write_back:
+            self._local_data = self._storage.dict(self._session_id,
+                                                  self._expires)
+            return self._local_data
+        data = {} if self._cleared else self._storage.dict(
+            self._session_id, self._expires)
+        for field, value in self._dirty.items():
+            if value is None:
+                data.pop(field, None)
+            else:
+                data[field] = value
+        self._local_data = data
         return self._local_data
 
+    def flush(self) -> bool:
+        """write changes of a write-back session in one batch"""
+        if not self.dirty:
+            return True
+        dirty, cleared = self._dirty, self._cleared
+        self._dirty = {}
+        self._cleared = False
+        if cleared:
+            self._storage.delete_key(self._session_id)
+            dirty = {
+                field: value
+                for field, value in dirty.items() if value is not None
+            }
+            if not dirty:
+                return True
+        return self._storage.set_many(self._session_id, dirty,
+                                      self._flush_expires)
+
     def __str__(self):
         return "Session(id={0}, data={1})".format(self._session_id,
                                                   pretty_format(self.data))
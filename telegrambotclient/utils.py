@@ -1,7 +1,10 @@
+import logging
 import pprint
+import random
+import re
 from functools import wraps
 from io import StringIO
-from typing import Dict, Iterable, Pattern, Tuple
+from typing import Any, Dict, Iterable, Optional, Pattern, Tuple
 
 try:
     import ujson as json
@@ -24,6 +27,91 @@ def pretty_format(data: Dict) -> str:
     return _pp.pformat(data)
 
 
+class _LazyPayload:
+    __slots__ = ("_payload", "_redact_fields")
+
+    def __init__(self, payload: Any, redact_fields: frozenset):
+        self._payload = payload
+        self._redact_fields = redact_fields
+
+    def __str__(self) -> str:
+        return pretty_format(redact(self._payload, self._redact_fields))
+
+
+_token_pattern = re.compile(r"\d{5,}:[\w-]{30,}")
+
+
+def redact(payload: Any, redact_fields: Iterable[str]) -> Any:
+    """return a copy of payload whose values of redact_fields and bot tokens are masked"""
+    if hasattr(payload, "items"):
+        return {
+            name: "***" if name in redact_fields else redact(
+                value, redact_fields)
+            for name, value in payload.items()
+        }
+    if isinstance(payload, (list, tuple)):
+        return [redact(item, redact_fields) for item in payload]
+    if isinstance(payload, str):
+        return _token_pattern.sub("***", payload)
+    return payload
+
+
+class PayloadTracer:
+    """
+    Log payloads such as updates and API responses. A payload is only formatted
+    when the logger is enabled for the level and the payload is sampled.
+    Attributes:
+        _logger: the logger to write into
+        _level: the logging level of payloads
+        _sample_rate: the ratio of payloads to log, from 0 to 1
+        _redact_fields: names of fields whose values are masked
+    """
+
+    __slots__ = ("_logger", "_level", "_sample_rate", "_redact_fields")
+
+    def __init__(self,
+                 logger: logging.Logger,
+                 level: int = logging.DEBUG,
+                 sample_rate: float = 1.0,
+                 redact_fields: Iterable[str] = ("phone_number",
+                                                 "provider_token")):
+        self._logger = logger
+        self._level = level
+        self._sample_rate = sample_rate
+        self._redact_fields = frozenset(redact_fields)
+
+    def configure(self,
+                  level: Optional[int] = None,
+                  sample_rate: Optional[float] = None,
+                  redact_fields: Optional[Iterable[str]] = None):
+        if level is not None:
+            self._level = level
+        if sample_rate is not None:
+            self._sample_rate = sample_rate
+        if redact_fields is not None:
+            self._redact_fields = frozenset(redact_fields)
+
+    def trace(self, title: str, payload: Any):
+        if not self._logger.isEnabledFor(self._level):
+            return
+        if self._sample_rate < 1 and random.random() >= self._sample_rate:
+            return
+        self._logger.log(
+            self._level,
+            """
+----------------------- %s BEGIN ---------------------------
+%s
+----------------------- %s  END  ---------------------------
+""",
+            title,
+            _LazyPayload(payload, self._redact_fields),
+            title,
+        )
+
+
+payload_tracer = PayloadTracer(logging.getLogger("telegram-bot-client"))
+
+
 def regex_match(regex_patterns: Iterable[Pattern]):
     def decorate(method):
         @wraps(method)
@@ -54,6 +142,13 @@ def i18n():
     return decorate
 
 
+def update_to_dict(update) -> Dict:
+    """a json serializable dict of an update, telegrambotclient.models.Update has slots"""
+    if isinstance(update, dict):
+        return update
+    return update.to_dict()
+
+
 def build_callback_data(name: str, *args) -> str:
     return "{0}|{1}".format(name, json.dumps(args))
 
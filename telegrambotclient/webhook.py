@@ -0,0 +1,246 @@
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+import asyncio
+import logging
+import signal
+import ssl
+from typing import Awaitable, Callable, Dict, Optional
+
+from telegrambotclient.base import Update
+from telegrambotclient.router import TelegramRouter
+
+logger = logging.getLogger("telegram-bot-client")
+
+
+class TelegramWebhookServer:
+    """
+    A stdlib asyncio HTTP server receiving updates on '{path_prefix}{token}'.
+    Updates are answered with 200 as soon as they are queued, then dispatched by workers.
+    An update always goes to the same worker as other updates of its chat, so they keep their order.
+    Attributes:
+        _bot_client: the TelegramBotClient which owns the bots
+        _dispatch: an awaitable callable with (token, raw_update), bot_client.dispatch by default
+        _host: the host to listen on
+        _port: the port to listen on
+        _path_prefix: the path prefix before a bot token
+        _secret_token: the value of header 'X-Telegram-Bot-Api-Secret-Token' if it is set
+        _ssl_context: a ssl context if the server is not behind a https proxy
+        _max_body_size: the max size in bytes of a request body
+        _read_timeout: seconds to wait for every read of a request, an idle or slow
+            connection is closed after it
+        _workers_num: the number of workers
+        _backlog: the max number of queued updates
+        _queues: bounded queues of workers
+        _workers: worker tasks
+        _server: the asyncio server
+        _stopped: an event which is set when the server is stopping
+    """
+
+    __slots__ = ("_bot_client", "_dispatch", "_host", "_port", "_path_prefix",
+                 "_secret_token", "_ssl_context", "_max_body_size",
+                 "_read_timeout",
+                 "_workers_num", "_backlog", "_queues", "_workers", "_server",
+                 "_stopped")
+    _status_lines = {
+        200: b"HTTP/1.1 200 OK",
+        400: b"HTTP/1.1 400 Bad Request",
+        403: b"HTTP/1.1 403 Forbidden",
+        404: b"HTTP/1.1 404 Not Found",
+        405: b"HTTP/1.1 405 Method Not Allowed",
+        411: b"HTTP/1.1 411 Length Required",
+        413: b"HTTP/1.1 413 Payload Too Large",
+        500: b"HTTP/1.1 500 Internal Server Error",
+        503: b"HTTP/1.1 503 Service Unavailable",
+    }
+
+    def __init__(self,
+                 bot_client,
+                 host: str = "0.0.0.0",
+                 port: int = 8000,
+                 path_prefix: str = "/bot/",
+                 secret_token: Optional[str] = None,
+                 workers: int = 8,
+                 backlog: int = 1024,
+                 ssl_context: Optional[ssl.SSLContext] = None,
+                 max_body_size: int = 1048576,
+                 read_timeout: Optional[float] = 30,
+                 dispatch: Optional[Callable[[str, Dict],
+                                             Awaitable]] = None):
+        self._bot_client = bot_client
+        self._dispatch = dispatch or bot_client.dispatch
+        self._host = host
+        self._port = port
+        self._path_prefix = path_prefix
+        self._secret_token = secret_token
+        self._ssl_context = ssl_context
+        self._max_body_size = max_body_size
+        self._read_timeout = read_timeout
+        self._workers_num = max(workers, 1)
+        self._backlog = backlog
+        self._queues = ()
+        self._workers = ()
+        self._server = None
+        self._stopped = None
+
+    async def start(self):
+        self._stopped = asyncio.Event()
+        self._queues = tuple(
+            asyncio.Queue(maxsize=max(self._backlog // self._workers_num, 1))
+            for _ in range(self._workers_num))
+        self._workers = tuple(
+            asyncio.ensure_future(self.__work(queue)) for queue in self._queues)
+        self._server = await asyncio.start_server(self.__handle_connection,
+                                                  self._host,
+                                                  self._port,
+                                                  ssl=self._ssl_context)
+        logger.info("webhook server is listening on %s:%s", self._host,
+                    self._port)
+
+    async def stop(self, timeout: float = 10):
+        """stop accepting updates, then wait queued updates to be dispatched in timeout seconds"""
+        if self._server is None:
+            return
+        self._server.close()
+        await self._server.wait_closed()
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(queue.join() for queue in self._queues)),
+                timeout)
+        except asyncio.TimeoutError:
+            logger.warning("webhook server stopped with undispatched updates")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._server = None
+        self._stopped.set()
+
+    async def serve_forever(self):
+        """serve until SIGINT or SIGTERM"""
+        await self.start()
+        loop = asyncio.get_event_loop()
+        stop_signals = []
+        for stop_signal in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(
+                    stop_signal,
+                    lambda: asyncio.ensure_future(self.stop()))
+                stop_signals.append(stop_signal)
+            except (NotImplementedError, RuntimeError):
+                pass
+        try:
+            await self._stopped.wait()
+        finally:
+            for stop_signal in stop_signals:
+                loop.remove_signal_handler(stop_signal)
+
+    async def __work(self, queue: asyncio.Queue):
+        while True:
+            token, raw_update = await queue.get()
+            try:
+                await self._dispatch(token, raw_update)
+            except Exception:
+                logger.exception("failed to dispatch update: %s",
+                                 raw_update.get("update_id", None))
+            finally:
+                queue.task_done()
+
+    def __enqueue(self, token: str, raw_update: Dict) -> bool:
+        try:
+            chat_id = TelegramRouter.parse_update_chat_id(
+                Update(**raw_update))
+        except (AttributeError, TypeError, ValueError) as error:
+            # a body which is not shaped like an update
+            raise ValueError(error) from error
+        lane = raw_update.get("update_id", 0) if chat_id is None else chat_id
+        queue = self._queues[hash(lane) % len(self._queues)]
+        try:
+            queue.put_nowait((token, raw_update))
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    def __process(self, method: str, path: str, headers: Dict,
+                  body: bytes) -> int:
+        if not path.startswith(self._path_prefix):
+            return 404
+        token = path[len(self._path_prefix):].split("?", 1)[0].rstrip("/")
+        if self._bot_client.bot(token) is None:
+            return 404
+        if method != "POST":
+            return 405
+        if (self._secret_token is not None and headers.get(
+                "x-telegram-bot-api-secret-token") != self._secret_token):
+            return 403
+        try:
+            raw_update = json.loads(body)
+            if not isinstance(raw_update, dict):
+                return 400
+            # Telegram retries the update later when it gets a non-2xx status
+            return 200 if self.__enqueue(token, raw_update) else 503
+        except ValueError:
+            # a token is a secret, only the bot id is logged
+            logger.warning("bad update for bot %s: %r",
+                           token.split(":", 1)[0], body[:256])
+            return 400
+        except Exception:
+            logger.exception("failed to queue update for bot %s",
+                             token.split(":", 1)[0])
+            return 500
+
+    async def __read(self, awaitable):
+        if self._read_timeout is None:
+            return await awaitable
+        return await asyncio.wait_for(awaitable, self._read_timeout)
+
+    async def __handle_connection(self, reader: asyncio.StreamReader,
+                                  writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await self.__read(reader.readline())
+                if not request_line:
+                    return
+                method, path, version = (request_line.decode("latin-1").split(
+                    " ", 2) + ["", ""])[:3]
+                headers = {}
+                while True:
+                    line = await self.__read(reader.readline())
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = (version.strip() == "HTTP/1.1"
+                              and headers.get("connection", "").lower() !=
+                              "close")
+                content_length = headers.get("content-length", None)
+                if content_length is None:
+                    status_code = 411 if method == "POST" else self.__process(
+                        method, path, headers, b"")
+                    keep_alive = keep_alive and method != "POST"
+                elif not content_length.isdigit():
+                    # the body can not be skipped without its length
+                    status_code = 400
+                    keep_alive = False
+                elif int(content_length) > self._max_body_size:
+                    status_code = 413
+                    keep_alive = False
+                else:
+                    body = await self.__read(
+                        reader.readexactly(int(content_length)))
+                    status_code = self.__process(method, path, headers, body)
+                writer.write(b"".join((
+                    self._status_lines[status_code],
+                    b"\r\ncontent-length: 0\r\nconnection: ",
+                    b"keep-alive" if keep_alive else b"close",
+                    b"\r\n\r\n",
+                )))
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.TimeoutError, ValueError):
+            return
+        finally:
+            writer.close()
@@ -0,0 +1,311 @@
+import asyncio
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+
+import pytest
+
+from telegrambotclient.api import (TelegramBotAPI, TelegramBotAPICaller,
+                                   TelegramBotAsyncAPICaller,
+                                   TelegramRateLimiter, TelegramRetryPolicy)
+from telegrambotclient.base import InputFile
+
+
+@pytest.mark.parametrize("chat_id, parsed", (
+    (123, (123, False)),
+    ("123", (123, False)),
+    (-100123, (-100123, True)),
+    ("-100123", (-100123, True)),
+    ("@channel", ("@channel", True)),
+))
+def test_parse_chat_id(chat_id, parsed):
+    assert TelegramRateLimiter.parse_chat_id(chat_id) == parsed
+
+
+def test_numeric_str_chat_id_shares_private_chat_bucket():
+    limiter = TelegramRateLimiter(global_rate=1000, chat_burst=1)
+    assert limiter.acquire("token", "sendmessage", {"chat_id": 123}) == 0
+    # the private chat rate is 1 per second, not the group rate of 20 per minute
+    assert 0 < limiter.acquire("token", "sendmessage",
+                               {"chat_id": "123"}) <= 1
+
+
+class _Response:
+    def __init__(self, status, data):
+        self.status = status
+        self.data = data
+
+
+class _FloodCaller(TelegramBotAPICaller):
+    """answers 429 once, then ok"""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def call(self, api_url, data=None, files=None):
+        self.calls += 1
+        if self.calls == 1:
+            return _Response(
+                429,
+                b'{"ok": false, "error_code": 429, "description": "Too Many Requests",'
+                b' "parameters": {"retry_after": 0}}')
+        return _Response(200, b'{"ok": true, "result": true}')
+
+
+class _CountingLimiter(TelegramRateLimiter):
+    def __init__(self):
+        super().__init__()
+        self.acquired = 0
+
+    def acquire(self, token, api_name, data):
+        self.acquired += 1
+        return super().acquire(token, api_name, data)
+
+
+def test_retry_acquires_rate_limiter_again():
+    caller = _FloodCaller()
+    limiter = _CountingLimiter()
+    bot_api = TelegramBotAPI(caller, limiter, TelegramRetryPolicy())
+    assert bot_api.send_message("token", chat_id=1, text="hi") is True
+    assert caller.calls == 2
+    assert limiter.acquired == 2
+
+
+@pytest.fixture(scope="module")
+def tls_files(tmp_path_factory):
+    """a self-signed certificate of localhost"""
+    if shutil.which("openssl") is None:
+        pytest.skip("openssl is not found")
+    path = tmp_path_factory.mktemp("tls")
+    cert_file, key_file = str(path / "cert.pem"), str(path / "key.pem")
+    subprocess.run(("openssl", "req", "-x509", "-newkey", "rsa:2048",
+                    "-nodes", "-days", "1", "-subj", "/CN=localhost",
+                    "-addext", "subjectAltName=DNS:localhost", "-keyout",
+                    key_file, "-out", cert_file),
+                   check=True,
+                   capture_output=True)
+    return cert_file, key_file
+
+
+class _LocalServer:
+    """a https server on localhost, respond(connection, request) returns a response,
+    None to close the connection without answering or b"" to never answer"""
+
+    def __init__(self, tls_files, respond):
+        self._tls_files = tls_files
+        self._respond = respond
+        self.connections = 0
+        self.requests = []
+        self.bodies = []
+        self._server = None
+
+    async def __handle(self, reader, writer):
+        self.connections += 1
+        connection = self.connections
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                if headers.get("transfer-encoding", "") == "chunked":
+                    body = b""
+                    while True:
+                        size = int(await reader.readline(), 16)
+                        chunk = await reader.readexactly(size + 2)
+                        if not size:
+                            break
+                        body += chunk[:-2]
+                else:
+                    body = await reader.readexactly(
+                        int(headers.get("content-length", 0)))
+                self.bodies.append(body)
+                method = request_line.split(b" ", 1)[0].decode("ascii")
+                self.requests.append((connection, method))
+                response = self._respond(connection, len(self.requests))
+                if response is None:
+                    return
+                if not response:
+                    # until the client gives up
+                    await reader.read()
+                    return
+                writer.write(response)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            return
+        finally:
+            writer.close()
+
+    async def start(self) -> TelegramBotAsyncAPICaller:
+        server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        server_context.load_cert_chain(*self._tls_files)
+        self._server = await asyncio.start_server(self.__handle,
+                                                  "localhost",
+                                                  0,
+                                                  ssl=server_context)
+        port = self._server.sockets[0].getsockname()[1]
+        return TelegramBotAsyncAPICaller(
+            "https://localhost:{0}".format(port),
+            timeout=0.5,
+            ssl_context=ssl.create_default_context(
+                cafile=self._tls_files[0]))
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+
+def _ok(body=b"ok"):
+    return b"HTTP/1.1 200 OK\r\ncontent-length: %d\r\n\r\n%s" % (len(body),
+                                                                  body)
+
+
+def test_async_caller_has_a_finite_timeout_by_default():
+    assert TelegramBotAsyncAPICaller()._timeout == 90
+
+
+def test_async_caller_decodes_chunked_bodies(tls_files):
+    chunked = (b"HTTP/1.1 200 OK\r\ntransfer-encoding: chunked\r\n\r\n"
+               b"5;ext=1\r\nhello\r\n1\r\n \r\n5\r\nworld\r\n0\r\n"
+               b"trailer: 1\r\n\r\n")
+    server = _LocalServer(tls_files, lambda connection, request: chunked)
+
+    async def request():
+        caller = await server.start()
+        try:
+            first = await caller.request("GET", "/file")
+            # the trailers are consumed, the connection is reused
+            second = await caller.request("GET", "/file")
+        finally:
+            await caller.close()
+            await server.stop()
+        return first, second
+
+    first, second = asyncio.run(request())
+    assert first.data == second.data == b"hello world"
+    assert server.connections == 1
+
+
+def test_async_caller_reuses_keep_alive_connections(tls_files):
+    server = _LocalServer(tls_files, lambda connection, request: _ok())
+
+    async def request():
+        caller = await server.start()
+        try:
+            for _ in range(3):
+                assert (await caller.call("/bot1:token/getMe")).data == b"ok"
+        finally:
+            await caller.close()
+            await server.stop()
+
+    asyncio.run(request())
+    assert server.requests == [(1, "POST")] * 3
+
+
+def test_async_caller_resends_only_idempotent_requests_on_a_stale_connection(
+        tls_files):
+    # the first connection is closed after its first request without an answer to the next
+    server = _LocalServer(
+        tls_files, lambda connection, request: None
+        if connection == 1 and request > 1 else _ok())
+
+    async def request(method):
+        caller = await server.start()
+        try:
+            await caller.request(method, "/")
+            return await caller.request(method, "/")
+        finally:
+            await caller.close()
+            await server.stop()
+
+    assert asyncio.run(request("GET")).data == b"ok"
+    assert server.requests == [(1, "GET"), (1, "GET"), (2, "GET")]
+    server = _LocalServer(
+        tls_files, lambda connection, request: None
+        if connection == 1 and request > 1 else _ok())
+    # the server might have handled a POST, it is not sent twice
+    with pytest.raises(ConnectionError):
+        asyncio.run(request("POST"))
+    assert server.requests == [(1, "POST"), (1, "POST")]
+
+
+def test_async_caller_times_out(tls_files):
+    server = _LocalServer(tls_files, lambda connection, request: b"")
+
+    async def request():
+        caller = await server.start()
+        try:
+            await caller.request("GET", "/")
+        finally:
+            await caller.close()
+            await server.stop()
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(request())
+
+
+@pytest.mark.parametrize("error", (
+    OSError(101, "Network is unreachable"),
+    socket.gaierror(-3, "Temporary failure in name resolution"),
+    ssl.SSLError("record layer failure"),
+))
+def test_network_errors_are_transient(error):
+    retry_policy = TelegramRetryPolicy(min_backoff=0.01)
+    assert retry_policy.retry_delay("token", "getMe", 0, error) is not None
+    # a call which may have been performed is not repeated
+    assert retry_policy.retry_delay("token", "sendMessage", 0, error) is None
+
+
+def test_async_call_acquires_rate_limiter_when_awaited():
+    class _AsyncCaller(TelegramBotAsyncAPICaller):
+        __slots__ = ()
+
+        async def call(self, api_url, data=None, files=None):
+            return _Response(200, b'{"ok": true, "result": true}')
+
+    limiter = _CountingLimiter()
+    bot_api = TelegramBotAPI(_AsyncCaller(), limiter)
+    calling = bot_api.send_message("token", chat_id=1, text="hi")
+    assert limiter.acquired == 0
+    assert asyncio.run(calling) is True
+    assert limiter.acquired == 1
+    # a call which is never awaited does not take a slot
+    bot_api.send_message("token", chat_id=1, text="hi").close()
+    assert limiter.acquired == 1
+
+
+def test_async_caller_uploads_streams_of_unknown_size_in_chunks(tls_files):
+    server = _LocalServer(
+        tls_files, lambda connection, request: _ok(
+            b'{"ok": true, "result": true}'))
+
+    async def upload():
+        caller = await server.start()
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, b"streamed content")
+        os.close(write_fd)
+        try:
+            with os.fdopen(read_fd, "rb") as pipe:
+                return await TelegramBotAPI(caller).send_document(
+                    "1:token",
+                    chat_id=1,
+                    document=InputFile("file.txt", pipe))
+        finally:
+            await caller.close()
+            await server.stop()
+
+    assert asyncio.run(upload()) is True
+    body = server.bodies[0]
+    assert b'name="chat_id"\r\n\r\n1\r\n' in body
+    assert b'filename="file.txt"' in body
+    assert b"\r\n\r\nstreamed content\r\n" in body
+    assert body.endswith(b"--\r\n")
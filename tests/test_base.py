@@ -0,0 +1,99 @@
+import io
+import os
+
+from telegrambotclient.base import InputFile, TelegramObject
+
+
+def test_input_file_of_bytes_and_path(tmp_path):
+    content = bytes(range(256)) * 10
+    path = tmp_path / "file.bin"
+    path.write_bytes(content)
+    for input_file in (InputFile("file.bin", content),
+                       InputFile("file.bin", str(path))):
+        assert input_file.size == len(content)
+        assert input_file.repeatable
+        chunks = [bytes(chunk) for chunk in input_file.iter_chunks(1000)]
+        assert [len(chunk) for chunk in chunks] == [1000, 1000, 560]
+        # it is read from its start every time
+        assert b"".join(chunks) == b"".join(input_file.iter_chunks(1000))
+        assert input_file.file_data == content
+
+
+def test_input_file_of_a_file_object_starts_where_it_was():
+    file_obj = io.BytesIO(b"headerbody")
+    file_obj.read(6)
+    input_file = InputFile("file.bin", file_obj)
+    assert input_file.size == 4
+    assert b"".join(input_file.iter_chunks(3)) == b"body"
+    assert b"".join(input_file.iter_chunks(3)) == b"body"
+
+
+def test_input_file_of_a_stream_which_can_not_seek():
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b"streamed")
+    os.close(write_fd)
+    with os.fdopen(read_fd, "rb") as pipe:
+        input_file = InputFile("file.bin", pipe)
+        assert input_file.size is None
+        assert not input_file.repeatable
+        assert b"".join(input_file.iter_chunks(3)) == b"streamed"
+
+    class _Stream:
+        """a file-like object which only reads"""
+
+        def __init__(self):
+            self._content = io.BytesIO(b"streamed")
+
+        def read(self, size=-1):
+            return self._content.read(size)
+
+    input_file = InputFile("file.bin", _Stream())
+    assert input_file.size is None
+    assert b"".join(input_file.iter_chunks(3)) == b"streamed"
+
+
+def test_telegram_object_wraps_nested_values_on_first_access():
+    raw_message = {
+        "message_id": 1,
+        "from": {
+            "id": 7,
+            "first_name": "user"
+        },
+        "chat": {
+            "id": 7,
+            "type": "private"
+        },
+        "entities": [{
+            "type": "bold",
+            "offset": 0,
+            "length": 2
+        }],
+    }
+    message = TelegramObject(**raw_message)
+    # nothing is wrapped until it is read
+    assert type(dict.__getitem__(message, "chat")) is dict
+    assert type(dict.__getitem__(message, "entities")) is list
+    chat = message.chat
+    assert isinstance(chat, TelegramObject) and chat.type == "private"
+    # it is wrapped once
+    assert message.chat is chat and message["chat"] is chat
+    assert message.get("chat") is chat
+    assert message.entities[0].type == "bold"
+    assert message.from_user.first_name == "user"
+    assert message.get("missing", 0) == 0 and message.missing is None
+
+
+def test_telegram_object_items_and_values_are_wrapped_views():
+    message = TelegramObject(message_id=1, chat={"id": 7}, photo=[{"a": 1}])
+    items = message.items()
+    values = message.values()
+    assert len(items) == len(values) == 3
+    assert ("message_id", 1) in items
+    assert all(isinstance(value, TelegramObject) for name, value in items
+               if name == "chat")
+    assert [type(value).__name__ for value in values
+            ] == ["int", "TelegramObject", "_TelegramObjectList"]
+    # views follow changes of the object like the ones of a dict
+    message.text = "hi"
+    assert len(items) == 4 and "hi" in values
+    assert dict(items)["chat"] is message.chat
@@ -0,0 +1,568 @@
+import asyncio
+import json
+import os
+import signal
+import threading
+import time
+from collections import OrderedDict
+
+import pytest
+
+from telegrambotclient import TelegramBotClient
+from telegrambotclient.api import (TelegramBotAPICaller,
+                                   TelegramBotAsyncAPICaller)
+from telegrambotclient.base import InputFile
+from telegrambotclient.bot import TelegramBot
+from telegrambotclient.models import Update
+from telegrambotclient.router import TelegramRouter
+from telegrambotclient.storage import MemoryStorage
+
+TOKEN = "1:token"
+
+
+def _update(update_id, chat_id):
+    return Update(
+        **{
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": 0,
+                "chat": {
+                    "id": chat_id,
+                    "type": "private"
+                },
+                "text": str(update_id),
+            },
+        })
+
+
+def test_durable_polling_does_not_skip_updates_failed_to_hand_off():
+    router = TelegramRouter("durable")
+    dispatched = []
+    failing = {2}
+
+    async def hand_off(token, update):
+        if update.update_id in failing:
+            raise ValueError("failed")
+        dispatched.append(update.update_id)
+
+    storage = MemoryStorage()
+    bot = TelegramBot(TOKEN, router, storage=storage)
+    bot.load_polling_state()
+    updates = (_update(1, 7), _update(2, 8), _update(3, 9), _update(4, 8))
+    assert not asyncio.run(
+        bot.dispatch_updates(updates, concurrency=4, dispatch=hand_off))
+    assert dispatched == [1, 3]
+    assert bot.last_update_id == 1
+    state = storage.dict("bot:polling:1", 60)
+    assert state["offset"] == 1
+    assert state["done"] == [3]
+    assert state["in_flight"] == [2, 4]
+
+    # a restarted bot hands off the failed update and the next ones of its chat again
+    failing.clear()
+    bot = TelegramBot(TOKEN, router, storage=storage)
+    bot.load_polling_state()
+    assert asyncio.run(
+        bot.dispatch_updates(updates[1:], concurrency=4, dispatch=hand_off))
+    assert dispatched == [1, 3, 2, 4]
+    assert bot.last_update_id == 4
+
+
+def test_failed_handler_is_retried_then_dropped_as_dead_update(monkeypatch):
+    router = TelegramRouter("dead-updates")
+    calls = []
+
+    async def on_message(bot, message):
+        calls.append(message.message_id)
+        if message.message_id == 2:
+            raise ValueError("failed")
+
+    router.register_message_handler(on_message)
+    storage = MemoryStorage()
+    monkeypatch.setattr(TelegramBot, "_update_retry_delay", 0)
+    bot = TelegramBot(TOKEN, router, storage=storage, max_update_retries=2)
+    updates = (_update(1, 7), _update(2, 8), _update(3, 9), _update(4, 8))
+    assert asyncio.run(bot.dispatch_updates(updates, concurrency=4))
+    # the failed update is dispatched 3 times, the other chats only once
+    assert sorted(calls) == [1, 2, 2, 2, 3, 4]
+    # later updates of its chat are not held back
+    assert calls.index(4) > max(i for i, c in enumerate(calls) if c == 2)
+    assert bot.last_update_id == 4
+    dead_updates = bot.dead_updates()
+    assert list(dead_updates) == ["2"]
+    assert dead_updates["2"]["update"]["update_id"] == 2
+    assert "ValueError" in dead_updates["2"]["error"]
+
+    # a batch fetched again does not dispatch the done updates
+    assert asyncio.run(bot.dispatch_updates(updates, concurrency=4))
+    assert len(calls) == 6
+
+
+def test_failed_hand_off_does_not_dispatch_done_updates_again():
+    router = TelegramRouter("hand-off")
+    handed_off = []
+    failing = {2}
+
+    async def hand_off(token, update):
+        if update.update_id in failing:
+            raise ValueError("failed")
+        handed_off.append(update.update_id)
+
+    bot = TelegramBot(TOKEN, router)
+    updates = (_update(1, 7), _update(2, 8), _update(3, 9))
+    assert not asyncio.run(
+        bot.dispatch_updates(updates, concurrency=4, dispatch=hand_off))
+    assert bot.last_update_id == 1
+    failing.clear()
+    assert asyncio.run(
+        bot.dispatch_updates(updates[1:], concurrency=4, dispatch=hand_off))
+    assert handed_off == [1, 3, 2]
+    assert bot.last_update_id == 3
+
+
+def test_chat_member_updates_are_routed():
+    router = TelegramRouter("chat-member")
+    routed = []
+
+    async def on_my_chat_member(bot, chat_member_updated):
+        routed.append(chat_member_updated.new_chat_member.status)
+
+    router.register_my_chat_member_handler(on_my_chat_member)
+    bot = TelegramBot(TOKEN, router)
+    chat_member_updated = {
+        "chat": {
+            "id": 7,
+            "type": "private"
+        },
+        "from": {
+            "id": 7,
+            "is_bot": False,
+            "first_name": "a"
+        },
+        "date": 0,
+        "old_chat_member": {
+            "status": "member",
+            "user": {
+                "id": 1,
+                "is_bot": True,
+                "first_name": "b"
+            }
+        },
+        "new_chat_member": {
+            "status": "kicked",
+            "user": {
+                "id": 1,
+                "is_bot": True,
+                "first_name": "b"
+            }
+        },
+    }
+    updates = (
+        Update(update_id=1, my_chat_member=chat_member_updated),
+        # no handler registered for chat_member
+        Update(update_id=2, chat_member=chat_member_updated),
+    )
+    assert asyncio.run(bot.dispatch_updates(updates, concurrency=2))
+    assert routed == ["kicked"]
+    assert bot.last_update_id == 2
+    assert not bot.dead_updates()
+
+
+def test_updates_of_a_chat_keep_their_order_and_chats_run_concurrently():
+    router = TelegramRouter("ordering")
+    events = []
+
+    async def on_message(bot, message):
+        events.append(("start", message.chat.id, message.message_id))
+        # earlier updates take longer, they would finish last without lanes
+        await asyncio.sleep(0.05 / message.message_id)
+        events.append(("end", message.chat.id, message.message_id))
+
+    router.register_message_handler(on_message)
+    bot = TelegramBot(TOKEN, router)
+    updates = (_update(1, 7), _update(2, 8), _update(3, 7), _update(4, 8),
+               _update(5, 7))
+    assert asyncio.run(bot.dispatch_updates(updates, concurrency=4))
+    for chat_id, message_ids in ((7, [1, 3, 5]), (8, [2, 4])):
+        assert [
+            message_id for event, chat, message_id in events
+            if event == "start" and chat == chat_id
+        ] == message_ids
+        assert [
+            message_id for event, chat, message_id in events
+            if event == "end" and chat == chat_id
+        ] == message_ids
+    # both chats had started before the first update had finished
+    assert events.index(("start", 8, 2)) < events.index(("end", 7, 1))
+
+
+def test_last_update_id_advances_once_handlers_have_finished():
+    router = TelegramRouter("offset")
+    seen_offsets = {}
+
+    async def on_message(bot, message):
+        await asyncio.sleep(0.01)
+        seen_offsets[message.message_id] = bot.last_update_id
+
+    router.register_message_handler(on_message)
+    bot = TelegramBot(TOKEN, router)
+    updates = (_update(1, 7), _update(2, 7), _update(3, 8))
+    assert asyncio.run(bot.dispatch_updates(updates, concurrency=2))
+    # an update never sees the offset at or past itself while its handler runs
+    assert all(offset < message_id
+               for message_id, offset in seen_offsets.items())
+    assert seen_offsets[2] == 1
+    assert bot.last_update_id == 3
+
+
+def test_client_dispatch_advances_last_update_id(monkeypatch):
+    monkeypatch.setattr(TelegramBot, "_update_retry_delay", 0)
+    bot_client = TelegramBotClient("client-dispatch")
+    router = bot_client.router("client-dispatch")
+
+    async def on_message(bot, message):
+        if message.message_id == 5:
+            raise ValueError("failed")
+
+    router.register_message_handler(on_message)
+    bot = bot_client.create_bot(TOKEN, router=router, max_update_retries=0)
+    raw_update = _update(3, 7).to_dict()
+
+    async def dispatch():
+        await bot_client.dispatch(TOKEN, raw_update)
+        assert bot.last_update_id == 3
+        # a webhook may dispatch an older update later
+        await bot_client.dispatch(TOKEN, _update(2, 8).to_dict())
+        assert bot.last_update_id == 3
+        # an update whose handler raised is done as a dead update
+        await bot_client.dispatch(TOKEN, _update(5, 8).to_dict())
+        assert bot.last_update_id == 5
+
+    asyncio.run(dispatch())
+    assert list(bot.dead_updates()) == ["5"]
+
+
+class _Response:
+    def __init__(self, status, data):
+        self.status = status
+        self.data = json.dumps(data).encode("utf-8")
+
+
+class _PhotoCaller(TelegramBotAsyncAPICaller):
+    """answers sendPhoto, an uploaded photo gets file_id 'uploaded-{n}'"""
+
+    __slots__ = ("uploads", "calls", "rejected", "threads")
+
+    def __init__(self):
+        super().__init__()
+        self.uploads = 0
+        self.calls = []
+        self.rejected = set()
+        self.threads = set()
+
+    async def call(self, api_url, data=None, files=None):
+        self.threads.add(threading.current_thread())
+        if files:
+            self.uploads += 1
+            file_id = "uploaded-{0}".format(self.uploads)
+        else:
+            file_id = data["photo"]
+        self.calls.append(file_id)
+        if file_id in self.rejected:
+            return _Response(
+                400, {
+                    "ok": False,
+                    "error_code": 400,
+                    "description": "Bad Request: wrong file identifier"
+                })
+        return _Response(200, {
+            "ok": True,
+            "result": {
+                "message_id": 1,
+                "photo": [{
+                    "file_id": "thumb"
+                }, {
+                    "file_id": file_id
+                }]
+            }
+        })
+
+
+class _HashingStorage(MemoryStorage):
+    """records the threads which call the file_id cache"""
+
+    def __init__(self):
+        super().__init__()
+        self.threads = set()
+
+    def get_value(self, key, field, expires):
+        self.threads.add(threading.current_thread())
+        return super().get_value(key, field, expires)
+
+
+def test_file_ids_are_cached_by_content_off_the_event_loop():
+    caller = _PhotoCaller()
+    storage = _HashingStorage()
+    bot = TelegramBot(TOKEN,
+                      TelegramRouter("file-ids"),
+                      storage=storage,
+                      async_api_caller=caller,
+                      cache_file_ids=True)
+
+    async def send(content):
+        return await bot.async_send_photo(chat_id=1,
+                                          photo=InputFile("a.png", content))
+
+    async def run():
+        # a miss uploads the content
+        await send(b"photo")
+        # a hit sends the cached file_id of the same content
+        await send(b"photo")
+        # other content is a miss
+        await send(b"another photo")
+        # a rejected file_id is forgotten and the content is uploaded again
+        caller.rejected.add("uploaded-1")
+        await send(b"photo")
+        await send(b"photo")
+        return threading.current_thread()
+
+    loop_thread = asyncio.run(run())
+    assert caller.calls == [
+        "uploaded-1", "uploaded-1", "uploaded-2", "uploaded-1", "uploaded-3",
+        "uploaded-3"
+    ]
+    assert caller.threads == {loop_thread}
+    # the cache is looked up in the executor, not on the event loop
+    assert storage.threads and loop_thread not in storage.threads
+
+
+class _FileCaller(TelegramBotAPICaller):
+    """serves files by their url, it fails once after failing_after bytes"""
+
+    def __init__(self, files):
+        super().__init__()
+        self.files = files
+        self.offsets = []
+        self.failing_after = None
+
+    def stream_file(self, file_url, chunk_size=65536, offset=0):
+        self.offsets.append(offset)
+        content = self.files[file_url.rsplit("/", 1)[1]][offset:]
+        for start in range(0, len(content), chunk_size):
+            if (self.failing_after is not None
+                    and offset + start >= self.failing_after):
+                self.failing_after = None
+                raise ConnectionError("lost")
+            yield content[start:start + chunk_size]
+
+
+def test_download_file_resumes_its_own_part_file(tmp_path):
+    caller = _FileCaller({"a.jpg": b"a" * 10, "b.jpg": b"b" * 10})
+    bot = TelegramBot(TOKEN, TelegramRouter("download"), api_caller=caller)
+    save_to_file = str(tmp_path / "photo.jpg")
+    caller.failing_after = 4
+    with pytest.raises(ConnectionError):
+        bot.download_file("photos/a.jpg", save_to_file, chunk_size=2)
+    # it is renamed only when it is complete
+    assert not os.path.exists(save_to_file)
+    bot.download_file("photos/a.jpg", save_to_file, chunk_size=2)
+    assert caller.offsets == [0, 4]
+    with open(save_to_file, "rb") as downloaded_file:
+        assert downloaded_file.read() == b"a" * 10
+    assert os.listdir(str(tmp_path)) == ["photo.jpg"]
+
+    # a part of another file saved to the same path is not resumed
+    caller.failing_after = 4
+    with pytest.raises(ConnectionError):
+        bot.download_file("photos/a.jpg", save_to_file, chunk_size=2)
+    bot.download_file("photos/b.jpg", save_to_file, chunk_size=2)
+    assert caller.offsets[-1] == 0
+    with open(save_to_file, "rb") as downloaded_file:
+        assert downloaded_file.read() == b"b" * 10
+    assert os.listdir(str(tmp_path)) == ["photo.jpg"]
+
+
+def _on_force_reply(bot, message, *force_reply_args):
+    pass
+
+
+class _CountingStorage(MemoryStorage):
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+
+    def get_value(self, key, field, expires):
+        self.reads += 1
+        return super().get_value(key, field, expires)
+
+
+def test_users_without_force_reply_are_cached():
+    router = TelegramRouter("force-reply-cache")
+    router.register_force_reply_handler(_on_force_reply)
+    storage = _CountingStorage()
+    bot = TelegramBot(TOKEN, router, storage=storage, force_reply_cache_ttl=60)
+    assert bot.get_force_reply(7) == (None, None)
+    reads = storage.reads
+    assert bot.get_force_reply(7) == (None, None)
+    assert storage.reads == reads
+    # a force reply joined by this process is seen at once
+    bot.join_force_reply(7, _on_force_reply, "arg")
+    assert bot.get_force_reply(7) == ("test_bot._on_force_reply", ("arg", ))
+    bot.force_reply_done(7)
+    reads = storage.reads
+    assert bot.get_force_reply(7) == (None, None)
+    assert storage.reads == reads
+
+
+def test_force_reply_cache_is_safe_for_sync_handlers_in_threads(monkeypatch):
+    monkeypatch.setattr(TelegramBot, "_no_force_reply_cache_size", 8)
+    router = TelegramRouter("force-reply-threads")
+    router.register_force_reply_handler(_on_force_reply)
+    bot = TelegramBot(TOKEN, router, force_reply_cache_ttl=60)
+    errors = []
+
+    def work(offset):
+        try:
+            for i in range(300):
+                user_id = (offset + i) % 32
+                if i % 3 == 0:
+                    bot.join_force_reply(user_id, _on_force_reply)
+                elif i % 3 == 1:
+                    bot.get_force_reply(user_id)
+                else:
+                    bot.force_reply_done(user_id)
+        except Exception as error:
+            errors.append(error)
+
+    class _SwitchingDict(OrderedDict):
+        """gives other threads a chance between a change and the next one"""
+
+        def __setitem__(self, key, value):
+            super().__setitem__(key, value)
+            time.sleep(0.0001)
+
+    bot._no_force_reply = _SwitchingDict()
+    threads = [
+        threading.Thread(target=work, args=(offset, ))
+        for offset in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(bot._no_force_reply) <= 8
+
+
+class _WriteCountingStorage(MemoryStorage):
+    def __init__(self):
+        super().__init__()
+        self.writes = []
+
+    def set_value(self, key, field, value, expires):
+        self.writes.append(("set_value", key))
+        return super().set_value(key, field, value, expires)
+
+    def set_many(self, key, mapping, expires):
+        self.writes.append(("set_many", key))
+        return super().set_many(key, mapping, expires)
+
+    def delete_field(self, key, field, expires):
+        self.writes.append(("delete_field", key))
+        return super().delete_field(key, field, expires)
+
+
+def test_write_back_sessions_are_flushed_once_per_update():
+    router = TelegramRouter("write-back")
+
+    def on_message(bot, message):
+        session = bot.get_session(message.chat.id)
+        session["count"] = (session.get("count", 0) or 0) + 1
+        session["text"] = message.text
+        del session["gone"]
+        # the same session is given within an update
+        assert bot.get_session(message.chat.id) is session
+        bot.get_session(message.chat.id)["last"] = message.message_id
+        if message.text == "fail":
+            raise ValueError("failed")
+
+    router.register_message_handler(on_message)
+    storage = _WriteCountingStorage()
+    bot = TelegramBot(TOKEN, router, storage=storage, write_back_sessions=True)
+    asyncio.run(bot.dispatch(_update(1, 7)))
+    assert len(storage.writes) == 1
+    assert storage.writes[0][0] == "set_many"
+    assert bot.get_session(7).data == {"count": 1, "text": "1", "last": 1}
+
+    # changes made before a handler raised are flushed as well
+    update = _update(2, 7)
+    update.message.text = "fail"
+    with pytest.raises(ValueError):
+        asyncio.run(bot.dispatch(update))
+    assert len(storage.writes) == 2
+    assert bot.get_session(7).data == {"count": 2, "text": "fail", "last": 2}
+    # out of an update a session writes at once
+    bot.get_session(7)["text"] = "now"
+    assert len(storage.writes) == 3
+
+
+class _PollingCaller(TelegramBotAsyncAPICaller):
+    """answers getUpdates with updates once then nothing, or fails every time"""
+
+    __slots__ = ("failing", "updates", "fetches")
+
+    def __init__(self, failing=False, updates=()):
+        super().__init__()
+        self.failing = failing
+        self.updates = list(updates)
+        self.fetches = []
+
+    async def call(self, api_url, data=None, files=None):
+        assert api_url.endswith("/getupdates")
+        self.fetches.append((time.monotonic(), data.get("offset", None)))
+        if self.failing:
+            raise ConnectionError("unreachable")
+        await asyncio.sleep(0.01)
+        updates, self.updates = self.updates, []
+        return _Response(200, {"ok": True, "result": updates})
+
+
+def test_polling_all_backs_off_per_bot_and_stops_on_signal():
+    bot_client = TelegramBotClient("polling-all")
+    router = bot_client.router("polling-all")
+    dispatched = []
+
+    async def on_message(bot, message):
+        dispatched.append(message.message_id)
+
+    router.register_message_handler(on_message)
+    failing_caller = _PollingCaller(failing=True)
+    working_caller = _PollingCaller(updates=(_update(5, 7).to_dict(), ))
+    for token, caller in (("1:failing", failing_caller), ("2:working",
+                                                          working_caller)):
+        bot_client.create_bot(token, router=router)
+        bot_client.bot(token)._async_bot_api._api_caller = caller
+
+    async def poll():
+        asyncio.get_running_loop().call_later(0.5, os.kill, os.getpid(),
+                                              signal.SIGTERM)
+        await bot_client.polling_all(timeout=0,
+                                     min_backoff=0.05,
+                                     max_backoff=0.2)
+
+    started_at = time.monotonic()
+    asyncio.run(poll())
+    # stopped by the signal, not by the end of the test
+    assert time.monotonic() - started_at < 2
+    assert dispatched == [5]
+    # the failing bot waited longer and longer, up to max_backoff
+    fetched_at = [fetched_at for fetched_at, _ in failing_caller.fetches]
+    waits = [
+        later - earlier for earlier, later in zip(fetched_at, fetched_at[1:])
+    ]
+    assert 3 <= len(fetched_at) <= 8
+    assert waits[0] < waits[1] < waits[2] <= 0.2 + 0.05
+    # the other bot kept polling meanwhile and confirmed its update when it stopped
+    assert len(working_caller.fetches) > 2 * len(fetched_at)
+    assert working_caller.fetches[-1][1] == 6
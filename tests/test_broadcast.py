@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+from telegrambotclient.api import (TelegramBotAPIException,
+                                   TelegramRateLimiter, TelegramRetryPolicy)
+from telegrambotclient.broadcast import TelegramBroadcast
+from telegrambotclient.storage import MemoryStorage
+
+
+def _api_error(error_code, parameters=None):
+    return TelegramBotAPIException(status_code=error_code,
+                                   ok=False,
+                                   error_code=error_code,
+                                   description="error",
+                                   parameters=parameters)
+
+
+class _Bot:
+    """chat 0 is slow so the watermark stalls, other odd chats have blocked the bot"""
+
+    def __init__(self, retry_policy=None):
+        self.id = 1
+        self.token = "1:token"
+        self.storage = MemoryStorage()
+        self.rate_limiter = TelegramRateLimiter(global_rate=100000,
+                                                chat_burst=100)
+        self.retry_policy = retry_policy
+        self.calls = 0
+
+    async def async_send_message(self, chat_id, **kwargs):
+        self.calls += 1
+        if chat_id == 0:
+            await asyncio.sleep(0.1)
+        elif chat_id == -1:
+            raise _api_error(429, {"retry_after": 0.01})
+        elif chat_id % 2:
+            raise _api_error(403)
+
+
+def test_blocked_chats_are_kept_while_watermark_stalls():
+    bot = _Bot()
+    report = asyncio.run(
+        TelegramBroadcast(bot, "news", range(30), {
+            "text": "hi"
+        },
+                          concurrency=4,
+                          checkpoint_every=1).run())
+    assert len(report.blocked) == 15
+    resumed = asyncio.run(
+        TelegramBroadcast(bot, "news", range(30), {
+            "text": "hi"
+        }).run())
+    assert resumed.finished
+    assert sorted(resumed.blocked) == list(range(1, 30, 2))
+
+
+def test_flood_is_not_retried_twice_with_retry_policy():
+    bot = _Bot(TelegramRetryPolicy())
+    report = asyncio.run(
+        TelegramBroadcast(bot, "flood", [-1], {
+            "text": "hi"
+        }).run())
+    # the retry policy of the bot's API has repeated it already
+    assert bot.calls == 1
+    assert report.failed == 1
+
+
+def test_throughput_only_counts_chats_done_in_this_run():
+    bot = _Bot()
+    asyncio.run(
+        TelegramBroadcast(bot, "resume", range(2, 12), {
+            "text": "hi"
+        }).run())
+    # a finished broadcast is not run again, mark it unfinished to extend its chats
+    bot.storage.set_value("bot:broadcast:1:resume", "finished", False, 60)
+    resumed = asyncio.run(
+        TelegramBroadcast(bot, "resume", range(2, 16), {
+            "text": "hi"
+        }).run())
+    assert resumed.skipped == 10
+    assert resumed.done == 14
+    assert resumed.done_in_run == 4
+    resumed.started_at = time.monotonic() - 2
+    assert 1.9 < resumed.throughput <= 2
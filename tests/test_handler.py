@@ -0,0 +1,32 @@
+import asyncio
+
+from telegrambotclient.bot import TelegramBot
+from telegrambotclient.handler import ProcessPoolCallback
+from telegrambotclient.router import TelegramRouter
+from telegrambotclient.storage import SQLiteStorage
+
+
+def _on_reply(bot, message, *args):
+    return None
+
+
+def _in_process(bot, user_id):
+    bot.join_force_reply(user_id, _on_reply)
+    bot.get_session(user_id)["greeting"] = bot.get_text("en", "hi")
+    return bot.stop_call
+
+
+def test_process_pool_callback_shares_bot_state(tmp_path):
+    router = TelegramRouter("process-pool")
+    router.register_force_reply_handler(_on_reply)
+    bot = TelegramBot("1:token",
+                      router,
+                      storage=SQLiteStorage(str(tmp_path / "storage.db"),
+                                            purge_interval=None),
+                      i18n_source={"en": {
+                          "hi": "hello"
+                      }})
+    result = asyncio.run(ProcessPoolCallback(_in_process)(bot, 7))
+    assert result is bot.stop_call
+    assert bot.get_session(7)["greeting"] == "hello"
+    assert bot.get_force_reply(7)[0] == "{0}._on_reply".format(__name__)
@@ -0,0 +1,75 @@
+import pickle
+
+from telegrambotclient.base import TelegramObject
+from telegrambotclient.models import Message, TelegramModel, Update
+
+
+def _raw_update(update_id, **message_fields):
+    message = {
+        "message_id": update_id,
+        "from": {
+            "id": 7,
+            "is_bot": False,
+            "first_name": "user"
+        },
+        "date": 0,
+        "chat": {
+            "id": 7,
+            "type": "private"
+        },
+        "text": "hi",
+    }
+    message.update(message_fields)
+    return {"update_id": update_id, "message": message}
+
+
+def test_slotted_models_keep_the_read_api_of_telegram_object():
+    raw_update = _raw_update(1,
+                             entities=[{
+                                 "type": "bold",
+                                 "offset": 0,
+                                 "length": 2
+                             }],
+                             dice={"value": 6})
+    update = Update(**raw_update)
+    message = update.message
+    assert isinstance(message, Message)
+    assert not hasattr(message, "__dict__")
+    assert message.from_user.first_name == "user"
+    assert message["chat"].type == "private"
+    assert message.entities[0].length == 2
+    # a field without a slot is kept in the extra dict as a TelegramObject
+    assert isinstance(message.dice, TelegramObject) and message.dice.value == 6
+    assert message.caption is None and message.get("caption", 0) == 0
+    assert "text" in message and "caption" not in message
+    assert tuple(message.keys())[:3] == ("message_id", "from_user", "date")
+    assert dict(message.items())["text"] == "hi"
+    message.caption = "set"
+    assert "caption" in message and message.caption == "set"
+    assert update == pickle.loads(pickle.dumps(update))
+    assert update.to_dict()["message"]["from_user"]["id"] == 7
+
+
+def test_key_tuples_are_shared_by_models_with_the_same_slot_fields():
+    first = Update(**_raw_update(1))
+    second = Update(**_raw_update(2))
+    assert first.message._keys is second.message._keys
+    assert first._keys is second._keys
+
+
+def test_unknown_field_names_are_not_interned(monkeypatch):
+    monkeypatch.setattr(TelegramModel, "_shared_keys", {})
+    for i in range(100):
+        Update(**_raw_update(i, **{"field_{0}".format(i): i}))
+    # only the key tuples of update, user and chat, which are all slots
+    assert len(TelegramModel._shared_keys) == 3
+
+
+def test_interned_key_tuples_are_bounded(monkeypatch):
+    monkeypatch.setattr(TelegramModel, "_shared_keys", {})
+    monkeypatch.setattr(TelegramModel, "_shared_keys_size", 2)
+    fields = ("text", "caption", "edit_date", "document")
+    for i in range(len(fields)):
+        Update(**_raw_update(1, **{fields[i]: "x"}))
+    assert len(TelegramModel._shared_keys) == 2
+    assert Update(**_raw_update(1, caption="x")).message.caption == "x"
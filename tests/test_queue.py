@@ -0,0 +1,207 @@
+import asyncio
+import time
+
+import pytest
+
+from telegrambotclient import TelegramBotClient
+from telegrambotclient.bot import TelegramBot
+from telegrambotclient.models import Update
+from telegrambotclient.queue import (RedisStreamQueue, SQLiteQueue,
+                                     UpdateQueueWorker)
+from telegrambotclient.router import TelegramRouter
+
+TOKEN = "1:token"
+
+
+def _raw_update(update_id, chat_id=7):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {
+                "id": chat_id,
+                "type": "private"
+            },
+            "text": "hi",
+        },
+    }
+
+
+def _read(update_queue, cursor=None):
+    """read until there is nothing new, as a worker does"""
+    messages = []
+    for _ in range(3):
+        read_messages, cursor = update_queue.read(0, cursor, 10)
+        messages.extend(read_messages)
+    return messages
+
+
+@pytest.fixture
+def redis():
+    fakeredis = pytest.importorskip("fakeredis")
+    return fakeredis.FakeStrictRedis()
+
+
+@pytest.fixture(params=("redis", "sqlite"))
+def update_queue(request, tmp_path):
+    if request.param == "redis":
+        return RedisStreamQueue(request.getfixturevalue("redis"), partitions=1)
+    return SQLiteQueue(str(tmp_path / "queue.db"), partitions=1)
+
+
+def test_publish_read_ack(update_queue):
+    # a models.Update has slots, it is published as a dict
+    asyncio.run(update_queue.dispatch(TOKEN, Update(**_raw_update(1))))
+    asyncio.run(update_queue.dispatch(TOKEN, _raw_update(2)))
+    assert update_queue.acquire(0, "a", 30)
+    messages = _read(update_queue)
+    assert [(token, update["update_id"])
+            for _, token, update in messages] == [(TOKEN, 1), (TOKEN, 2)]
+    update_queue.ack(0, (messages[0][0], ))
+    # the next owner reads the update which is not acked
+    assert not update_queue.acquire(0, "b", 30)
+    update_queue.release(0, "a")
+    assert update_queue.acquire(0, "b", 30)
+    messages = _read(update_queue)
+    assert [update["update_id"] for _, _, update in messages] == [2]
+    update_queue.ack(0, (messages[0][0], ))
+    assert _read(update_queue) == []
+
+
+def test_publish_failure_stops_the_offset():
+    class _BrokenQueue(SQLiteQueue):
+        def publish(self, token, update, partition):
+            raise ConnectionError("queue is down")
+
+    bot = TelegramBot(TOKEN, TelegramRouter("broken-queue"))
+    updates = (Update(**_raw_update(1)), )
+
+    async def dispatch_updates(update_queue):
+        return await bot.dispatch_updates(updates,
+                                          dispatch=update_queue.dispatch)
+
+    assert not asyncio.run(
+        dispatch_updates(_BrokenQueue(":memory:", partitions=1)))
+    assert bot.last_update_id == 0
+
+
+def test_worker_skips_updates_in_flight_after_taking_lease_back(redis):
+    update_queue = RedisStreamQueue(redis, partitions=1)
+    bot_client = TelegramBotClient("queue")
+    router = bot_client.router("queue")
+    calls = []
+
+    async def on_message(bot, message):
+        calls.append(message.message_id)
+        await release.wait()
+
+    router.register_message_handler(on_message)
+    bot_client.create_bot(TOKEN, router=router)
+    worker = UpdateQueueWorker(bot_client,
+                               update_queue,
+                               consumer="a",
+                               lease_ttl=0.3,
+                               poll_interval=0.01)
+    lease_key = "bot:updates:lease:0"
+
+    async def run():
+        nonlocal release
+        release = asyncio.Event()
+        running = asyncio.ensure_future(worker.run())
+        await update_queue.dispatch(TOKEN, _raw_update(1))
+        while not calls:
+            await asyncio.sleep(0.01)
+        # another consumer takes the lease, then it expires and the worker takes it back
+        redis.set(lease_key, "b")
+        await asyncio.sleep(0.25)
+        redis.delete(lease_key)
+        await asyncio.sleep(0.25)
+        release.set()
+        await asyncio.sleep(0.05)
+        worker.stop()
+        await running
+
+    release = None
+    asyncio.run(run())
+    assert calls == [1]
+    assert _read(update_queue) == []
+
+
+def test_worker_drops_a_read_batch_when_the_lease_is_lost_while_reading(
+        tmp_path):
+    class _SlowQueue(SQLiteQueue):
+        __slots__ = ()
+
+        def read(self, partition, cursor, count):
+            messages, cursor = super().read(partition, cursor, count)
+            if messages:
+                # another consumer takes the lease while this read is in flight
+                self.release(partition, "a")
+                assert self.acquire(partition, "b", 30)
+                time.sleep(0.3)
+            return messages, cursor
+
+    update_queue = _SlowQueue(str(tmp_path / "queue.db"), partitions=1)
+    bot_client = TelegramBotClient("slow-queue")
+    router = bot_client.router("slow-queue")
+    calls = []
+
+    async def on_message(bot, message):
+        calls.append(message.message_id)
+
+    router.register_message_handler(on_message)
+    bot_client.create_bot(TOKEN, router=router)
+    worker = UpdateQueueWorker(bot_client,
+                               update_queue,
+                               consumer="a",
+                               lease_ttl=0.3,
+                               poll_interval=0.01)
+
+    async def run():
+        await update_queue.dispatch(TOKEN, _raw_update(1))
+        running = asyncio.ensure_future(worker.run())
+        await asyncio.sleep(0.5)
+        worker.stop()
+        await running
+
+    asyncio.run(run())
+    # the lease was renewed on the loop during the read and found lost
+    assert calls == []
+    assert [update["update_id"]
+            for _, _, update in _read(update_queue)] == [1]
+
+
+def test_worker_acks_updates_dropped_as_dead(redis, monkeypatch):
+    monkeypatch.setattr(TelegramBot, "_update_retry_delay", 0)
+    update_queue = RedisStreamQueue(redis, partitions=1)
+    bot_client = TelegramBotClient("dead-queue")
+    router = bot_client.router("dead-queue")
+    calls = []
+
+    async def on_message(bot, message):
+        calls.append(message.message_id)
+        if message.message_id == 1:
+            raise ValueError("failed")
+
+    router.register_message_handler(on_message)
+    bot = bot_client.create_bot(TOKEN, router=router, max_update_retries=1)
+    worker = UpdateQueueWorker(bot_client,
+                               update_queue,
+                               consumer="a",
+                               poll_interval=0.01)
+
+    async def run():
+        await update_queue.dispatch(TOKEN, _raw_update(1))
+        await update_queue.dispatch(TOKEN, _raw_update(2))
+        running = asyncio.ensure_future(worker.run())
+        while 2 not in calls:
+            await asyncio.sleep(0.01)
+        worker.stop()
+        await running
+
+    asyncio.run(run())
+    # the failed update does not hold back the next one of its chat
+    assert calls == [1, 1, 2]
+    assert list(bot.dead_updates()) == ["1"]
+    assert _read(update_queue) == []
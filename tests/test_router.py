@@ -0,0 +1,241 @@
+import asyncio
+import itertools
+import threading
+import time
+
+from telegrambotclient.base import CallbackQuery, Message, Update
+from telegrambotclient.bot import TelegramBot
+from telegrambotclient.handler import CallbackQueryHandler, MessageHandler
+from telegrambotclient.router import (TelegramRouter,
+                                      _CompiledCallbackDataPatterns,
+                                      _CompiledMessageRoute)
+
+PATTERNS = (
+    (r"^page:(\d+)$", r"^item:\w+"),
+    (r"(?i)PAGE:\d+", ),
+    (r"^pag?e:", r"^pa"),
+    (r"^(page|item):", ),
+    (r"^item:a|^page:1", ),
+    (r"^it\.em", r"^item:x*"),
+    (r"z*", ),
+    (r".*", ),
+    (r"^item:ab{0,2}", r"^\d+"),
+    (r"^[pi]", ),
+)
+CALLBACK_DATA = ("", "page:1", "PAGE:12", "pae:", "pa", "item:", "item:abb",
+                 "item:xx", "it.em", "itxem", "zzz", "42", "Item:a", "p",
+                 "page:1|2")
+
+
+def _noop(bot, callback_query, *args):
+    return None
+
+
+def _linear_match(handlers, callback_data):
+    results = []
+    for handler in handlers:
+        result = handler.callback_data_match(CallbackQuery(data=callback_data))
+        if result:
+            results.append((handler, result))
+    return results
+
+
+def _assert_same_as_linear(handlers):
+    compiled = _CompiledCallbackDataPatterns(handlers)
+    for callback_data in CALLBACK_DATA:
+        expected = [(handler, result.group(0), result.re.pattern)
+                    for handler, result in _linear_match(
+                        handlers, callback_data)]
+        actual = [(handler, result.group(0), result.re.pattern)
+                  for handler, result in compiled.match(callback_data)]
+        assert actual == expected, callback_data
+
+
+def test_indexed_match_is_the_linear_scan():
+    handlers = [
+        CallbackQueryHandler(_noop, callback_data_regex=patterns)
+        for patterns in PATTERNS
+    ]
+    _assert_same_as_linear(handlers)
+
+
+def test_indexed_match_keeps_registration_order():
+    for order in itertools.islice(itertools.permutations(PATTERNS), 0, 720,
+                                  37):
+        _assert_same_as_linear([
+            CallbackQueryHandler(_noop, callback_data_regex=patterns)
+            for patterns in order
+        ])
+
+
+def test_empty_callback_data_is_routed():
+    called = []
+    router = TelegramRouter("test_empty_callback_data")
+
+    @router.callback_query_handler(callback_data_regex=(r"z*", ))
+    def on_empty(bot, callback_query, result):
+        called.append(result.group(0))
+
+    asyncio.run(
+        router.route(
+            None, Update(update_id=1, callback_query={
+                "id": "1",
+                "data": ""
+            })))
+    assert called == [""]
+
+
+FIELDS = ("text", "photo", "caption", "contact", "location")
+
+
+def _old_order(route, message):
+    """the handlers which the router called before routes were compiled"""
+    handlers = []
+    message_fields = set(message.keys())
+    for fields, handler in route.get("and", ()):
+        if fields <= message_fields:
+            handlers.append(handler)
+    for message_field, or_handlers in route.get("or", {}).items():
+        if message_field in message:
+            handlers.extend(or_handlers)
+    if route.get("any", None):
+        handlers.append(route["any"])
+    return handlers
+
+
+def test_compiled_message_route_is_the_old_order():
+    router = TelegramRouter("test_compiled_message_route")
+    for handler in (
+            MessageHandler(_noop, fields={"text", "photo"}),
+            MessageHandler(_noop, fields=("text", )),
+            MessageHandler(_noop, fields=("photo", "caption")),
+            MessageHandler(_noop, fields={"caption", "contact"}),
+            MessageHandler(_noop, fields=("text", )),
+            MessageHandler(_noop, fields=None),
+            MessageHandler(_noop, fields=("location", )),
+    ):
+        router.register_handler(handler)
+    route = router._route_map["message"]
+    compiled = _CompiledMessageRoute(route)
+    for size in range(len(FIELDS) + 1):
+        for fields in itertools.combinations(FIELDS, size):
+            message = Message(message_id=1, **{field: 1 for field in fields})
+            expected = _old_order(route, message)
+            assert list(compiled.match(message)) == expected, fields
+            # a second match is answered from the cache
+            assert list(compiled.match(message)) == expected, fields
+    assert compiled.match(Message(message_id=1, poll=1)) == (route["any"], )
+
+
+def test_compiled_message_route_is_invalidated_on_register():
+    called = []
+    router = TelegramRouter("test_compiled_message_route_invalidation")
+
+    @router.message_handler(fields=("text", ))
+    def on_text(bot, message):
+        called.append("text")
+        return router.next_call
+
+    update = Update(update_id=1,
+                    message={
+                        "message_id": 1,
+                        "chat": {
+                            "id": 7,
+                            "type": "private"
+                        },
+                        "text": "hi",
+                    })
+    asyncio.run(router.route(None, update))
+    assert called == ["text"]
+
+    @router.message_handler(fields={"text", "chat"})
+    def on_text_in_chat(bot, message):
+        called.append("text and chat")
+        return router.next_call
+
+    @router.message_handler()
+    def on_any(bot, message):
+        called.append("any")
+        return router.next_call
+
+    asyncio.run(router.route(None, update))
+    assert called == ["text", "text and chat", "text", "any"]
+
+
+def _photo_update(update_id):
+    return Update(update_id=update_id,
+                  message={
+                      "message_id": update_id,
+                      "chat": {
+                          "id": 7,
+                          "type": "private"
+                      },
+                      "photo": [],
+                  })
+
+
+def test_sync_handlers_run_in_the_thread_pool():
+    router = TelegramRouter("test_sync_handler_workers",
+                            sync_handler_workers=2)
+    bot = TelegramBot("1:token", router)
+    threads = []
+
+    @router.message_handler(fields=("photo", ))
+    def on_photo(bot, message):
+        threads.append(threading.current_thread().name)
+        # a blocking handler, the event loop keeps running meanwhile
+        time.sleep(0.1)
+        return router.next_call
+
+    async def route():
+        ticks = 0
+        routing = asyncio.ensure_future(router.route(bot, _photo_update(1)))
+        while not routing.done():
+            ticks += 1
+            await asyncio.sleep(0.01)
+        await routing
+        return ticks
+
+    try:
+        assert asyncio.run(route()) > 3
+    finally:
+        router.executor.shutdown()
+    assert threads[0].startswith("router-test_sync_handler_workers")
+
+
+def test_sync_handlers_of_a_bot_are_capped():
+    router = TelegramRouter("test_max_sync_handlers_per_bot",
+                            sync_handler_workers=4,
+                            max_sync_handlers_per_bot=1)
+    busy_bot = TelegramBot("1:token", router)
+    other_bot = TelegramBot("2:token", router)
+    running = {busy_bot.token: 0, other_bot.token: 0}
+    max_running = {busy_bot.token: 0, other_bot.token: 0}
+    overlapped = []
+    lock = threading.Lock()
+
+    @router.message_handler(fields=("photo", ))
+    def on_photo(bot, message):
+        with lock:
+            running[bot.token] += 1
+            max_running[bot.token] = max(max_running[bot.token],
+                                         running[bot.token])
+            overlapped.append(sum(running.values()))
+        time.sleep(0.05)
+        with lock:
+            running[bot.token] -= 1
+        return router.next_call
+
+    async def route():
+        await asyncio.gather(
+            *(router.route(busy_bot, _photo_update(update_id))
+              for update_id in range(1, 4)),
+            router.route(other_bot, _photo_update(4)))
+
+    try:
+        asyncio.run(route())
+    finally:
+        router.executor.shutdown()
+    assert max_running == {busy_bot.token: 1, other_bot.token: 1}
+    # the other bot is not held back by the busy one
+    assert max(overlapped) == 2
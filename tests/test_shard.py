@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+from telegrambotclient import TelegramBotClient
+from telegrambotclient.base import TelegramBotException
+from telegrambotclient.bot import TelegramBot
+from telegrambotclient.models import Update
+from telegrambotclient.shard import TelegramShards
+from telegrambotclient.storage import SQLiteStorage
+
+TOKEN = "1:token"
+
+
+def _raw_update(update_id, chat_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {
+                "id": chat_id,
+                "type": "private"
+            },
+            "from": {
+                "id": chat_id,
+                "is_bot": False,
+                "first_name": "user"
+            },
+            "text": text,
+        },
+    }
+
+
+def _on_message(bot, message):
+    if message.text == "fail":
+        raise ValueError("failed")
+    bot.get_session(message.chat.id)["text"] = message.text
+
+
+def test_shards_ack_dispatched_updates(tmp_path, monkeypatch):
+    monkeypatch.setattr(TelegramBot, "_update_retry_delay", 0)
+    bot_client = TelegramBotClient("shards")
+    router = bot_client.router("shards")
+    router.register_message_handler(_on_message)
+    bot = bot_client.create_bot(TOKEN,
+                                router=router,
+                                storage=SQLiteStorage(str(tmp_path /
+                                                          "storage.db"),
+                                                      purge_interval=None),
+                                update_class=Update)
+    shards = TelegramShards(bot_client, workers=2)
+    shards.start()
+
+    async def dispatch():
+        try:
+            # a models.Update has slots, it is sent as a dict
+            await shards.dispatch(TOKEN, Update(**_raw_update(1, 7, "hi")))
+            # the update has been dispatched when dispatch returns
+            assert bot.get_session(7)["text"] == "hi"
+            # an update whose handler keeps failing is dropped as a dead update and acked
+            await shards.dispatch(TOKEN, _raw_update(2, 8, "fail"))
+            assert "2" in bot.dead_updates()
+            with pytest.raises(TelegramBotException):
+                await shards.dispatch("2:token", _raw_update(3, 8, "hi"))
+        finally:
+            await shards.stop()
+
+    asyncio.run(dispatch())
@@ -0,0 +1,131 @@
+import gc
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from telegrambotclient.base import InputFile
+from telegrambotclient.storage import (FileIdCache, MemoryStorage,
+                                       RedisStorage, SQLiteStorage)
+
+
+def _redis_storage():
+    fakeredis = pytest.importorskip("fakeredis")
+    return RedisStorage(fakeredis.FakeStrictRedis())
+
+
+@pytest.fixture(params=("memory", "sqlite", "redis"))
+def storage(request):
+    if request.param == "memory":
+        return MemoryStorage()
+    if request.param == "sqlite":
+        return SQLiteStorage(purge_interval=None)
+    return _redis_storage()
+
+
+def test_set_many_keeps_falsy_values(storage):
+    storage.set_many("key", {
+        "zero": 0,
+        "false": False,
+        "empty_str": "",
+        "empty_list": [],
+        "one": 1,
+    }, 60)
+    assert storage.get_many(
+        "key", ("zero", "false", "empty_str", "empty_list", "one"), 60) == {
+            "zero": 0,
+            "false": False,
+            "empty_str": "",
+            "empty_list": [],
+            "one": 1,
+        }
+
+
+@pytest.mark.parametrize("value", (0, False, "", []))
+def test_set_value_keeps_falsy_values(storage, value):
+    storage.set_value("key", "field", value, 60)
+    assert storage.get_value("key", "field", 60) == value
+    assert storage.get_many("key", ("field", ), 60) == {"field": value}
+    assert storage.dict("key", 60) == {"field": value}
+    storage.set_value("key", "field", None, 60)
+    assert storage.get_value("key", "field", 60) is None
+
+
+def test_set_many_deletes_none(storage):
+    storage.set_many("key", {"a": 1, "b": 2}, 60)
+    storage.set_many("key", {"a": None}, 60)
+    assert storage.get_many("key", ("a", "b"), 60) == {"b": 2}
+
+
+def test_sqlite_closes_connections_of_exited_threads(tmp_path):
+    storage = SQLiteStorage(str(tmp_path / "storage.db"), purge_interval=None)
+    connections_num = len(storage._connections)
+    threads = [
+        threading.Thread(target=storage.set_value,
+                         args=("key", str(i), i, 60)) for i in range(20)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    del threads, thread
+    gc.collect()
+    assert len(storage._connections) == connections_num
+    assert storage.get_value("key", "3", 60) == 3
+    storage.close()
+    assert len(storage._connections) == 0
+
+
+def test_memory_storage_sweeps_expired_keys_on_writes():
+    storage = MemoryStorage()
+    storage.set_value("alive", "field", 1, 60)
+    storage.set_value("expired", "field", 1, 0.05)
+    time.sleep(0.1)
+    # a write to an existing key sweeps too
+    storage.set_value("alive", "field", 2, 60)
+    assert storage.stats["keys"] == 1
+    assert storage.stats["expirations"] == 1
+
+
+def test_file_id_cache_misses_a_changed_file(tmp_path):
+    path = tmp_path / "photo.png"
+    path.write_bytes(b"photo")
+    cache = FileIdCache(MemoryStorage(), 1)
+    cache.set("photo", InputFile("photo.png", str(path)), "file-id")
+    assert cache.get("photo", InputFile("photo.png", str(path))) == "file-id"
+    # the same content from bytes hits as well
+    assert cache.get("photo", InputFile("photo.png", b"photo")) == "file-id"
+    assert cache.get("document", InputFile("photo.png", b"photo")) is None
+    path.write_bytes(b"another photo")
+    assert cache.get("photo", InputFile("photo.png", str(path))) is None
+    cache.delete("photo", InputFile("photo.png", b"photo"))
+    assert cache.get("photo", InputFile("photo.png", b"photo")) is None
+
+
+def test_sqlite_reads_refresh_expires_at_intervals(tmp_path, monkeypatch):
+    db_file = str(tmp_path / "storage.db")
+    storage = SQLiteStorage(db_file, purge_interval=None)
+    current_time = [1000]
+    monkeypatch.setattr(time, "time", lambda: current_time[0])
+
+    def stored_expires():
+        db_conn = sqlite3.connect(db_file)
+        try:
+            return db_conn.execute(
+                "SELECT expires FROM t_storage_key WHERE key='key'").fetchone(
+                )[0]
+        finally:
+            db_conn.close()
+
+    storage.set_value("key", "field", 1, 100)
+    assert stored_expires() == 1100
+    # a read within a tenth of expires does not write
+    current_time[0] = 1005
+    assert storage.get_value("key", "field", 100) == 1
+    assert stored_expires() == 1100
+    current_time[0] = 1020
+    assert storage.dict("key", 100) == {"field": 1}
+    assert stored_expires() == 1120
+    current_time[0] = 1121
+    assert storage.get_value("key", "field", 100) is None
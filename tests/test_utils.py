@@ -0,0 +1,98 @@
+import itertools
+import logging
+import random
+
+from telegrambotclient.models import Update
+from telegrambotclient.utils import PayloadTracer, redact
+
+TOKEN = "123456:ABCdefGHIjklMNOpqrSTUvwxYZ0123456789"
+
+
+class _Payload(dict):
+    """remembers whether it has been formatted"""
+
+    formatted = False
+
+    def items(self):
+        self.formatted = True
+        return super().items()
+
+
+def _tracer(sample_rate=1.0):
+    logger = logging.getLogger("test-payload-tracer")
+    logger.setLevel(logging.DEBUG)
+    return logger, PayloadTracer(logger, sample_rate=sample_rate)
+
+
+def test_redact_masks_fields_and_tokens_everywhere():
+    payload = {
+        "contact": {
+            "phone_number": "+100",
+            "first_name": "user"
+        },
+        "results": [{
+            "provider_token": "secret"
+        }, "https://api.telegram.org/bot{0}/getMe".format(TOKEN)],
+        "count": 1,
+    }
+    assert redact(payload, ("phone_number", "provider_token")) == {
+        "contact": {
+            "phone_number": "***",
+            "first_name": "user"
+        },
+        "results": [{
+            "provider_token": "***"
+        }, "https://api.telegram.org/bot***/getMe"],
+        "count": 1,
+    }
+    # slotted models are redacted like dicts
+    update = Update(update_id=1,
+                    message={
+                        "message_id": 1,
+                        "contact": {
+                            "phone_number": "+100"
+                        }
+                    })
+    assert redact(update, ("phone_number", ))["message"]["contact"] == {
+        "phone_number": "***"
+    }
+
+
+def test_payloads_are_redacted_when_they_are_logged(caplog):
+    logger, tracer = _tracer()
+    with caplog.at_level(logging.DEBUG, logger=logger.name):
+        tracer.trace("UPDATE", {"phone_number": "+100", "text": TOKEN})
+    assert len(caplog.records) == 1
+    message = caplog.records[0].getMessage()
+    assert "UPDATE" in message and "+100" not in message
+    assert TOKEN not in message
+
+
+def test_payloads_are_only_formatted_when_logged_and_sampled(
+        caplog, monkeypatch):
+    logger, tracer = _tracer()
+    # a disabled level formats nothing
+    payload = _Payload(text="hi")
+    with caplog.at_level(logging.INFO, logger=logger.name):
+        tracer.trace("UPDATE", payload)
+    assert caplog.records == [] and not payload.formatted
+
+    tracer.configure(sample_rate=0.25)
+    samples = itertools.cycle((0.1, 0.3, 0.2, 0.9))
+    monkeypatch.setattr(random, "random", lambda: next(samples))
+    payloads = [_Payload(text=str(number)) for number in range(4)]
+    with caplog.at_level(logging.DEBUG, logger=logger.name):
+        for payload in payloads:
+            tracer.trace("UPDATE", payload)
+    assert len(caplog.records) == 2
+    assert "'0'" in caplog.records[0].getMessage()
+    assert "'2'" in caplog.records[1].getMessage()
+    # payloads which are not sampled are never formatted
+    assert [payload.formatted
+            for payload in payloads] == [True, False, True, False]
+
+    caplog.clear()
+    tracer.configure(sample_rate=0)
+    with caplog.at_level(logging.DEBUG, logger=logger.name):
+        tracer.trace("UPDATE", _Payload(text="hi"))
+    assert caplog.records == []
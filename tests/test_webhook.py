@@ -0,0 +1,148 @@
+import asyncio
+import json
+
+from telegrambotclient import TelegramBotClient
+from telegrambotclient.webhook import TelegramWebhookServer
+
+TOKEN = "1:token"
+
+
+def _raw_update(update_id, chat_id):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {
+                "id": chat_id,
+                "type": "private"
+            },
+            "text": "hi",
+        },
+    }
+
+
+async def _serve(**kwargs) -> TelegramWebhookServer:
+    bot_client = TelegramBotClient("webhook")
+    bot_client.create_bot(TOKEN, router=bot_client.router("webhook"))
+    server = TelegramWebhookServer(bot_client,
+                                   host="127.0.0.1",
+                                   port=0,
+                                   **kwargs)
+    await server.start()
+    return server
+
+
+async def _post(server, body, headers=None) -> int:
+    port = server._server.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    if not isinstance(body, bytes):
+        body = json.dumps(body).encode("utf-8")
+    head = ["POST /bot/{0} HTTP/1.1".format(TOKEN), "host: localhost",
+            "connection: close", "content-length: {0}".format(len(body))]
+    for name, value in (headers or {}).items():
+        head.append("{0}: {1}".format(name, value))
+    writer.write("\r\n".join(head).encode("latin-1") + b"\r\n\r\n" + body)
+    await writer.drain()
+    status_line = await reader.readline()
+    writer.close()
+    return int(status_line.split(b" ", 2)[1])
+
+
+def test_secret_token_is_checked():
+    async def post():
+        server = await _serve(secret_token="secret",
+                              dispatch=lambda *args: asyncio.sleep(0))
+        try:
+            return (await _post(server, _raw_update(1, 7)), await _post(
+                server, _raw_update(2, 7),
+                {"X-Telegram-Bot-Api-Secret-Token": "wrong"}), await _post(
+                    server, _raw_update(3, 7),
+                    {"X-Telegram-Bot-Api-Secret-Token": "secret"}))
+        finally:
+            await server.stop()
+
+    assert asyncio.run(post()) == (403, 403, 200)
+
+
+def test_bad_updates_are_answered_with_400():
+    async def post():
+        server = await _serve(dispatch=lambda *args: asyncio.sleep(0))
+        try:
+            return [
+                await _post(server, body)
+                for body in (b"{not json", [1], {
+                    "update_id": 1,
+                    "message": "x"
+                }, _raw_update(2, 7))
+            ]
+        finally:
+            await server.stop()
+
+    assert asyncio.run(post()) == [400, 400, 400, 200]
+
+
+def test_full_backlog_is_answered_with_503():
+    async def post():
+        release = asyncio.Event()
+
+        async def dispatch(token, raw_update):
+            await release.wait()
+
+        server = await _serve(workers=1, backlog=1, dispatch=dispatch)
+        try:
+            statuses = [await _post(server, _raw_update(1, 7))]
+            # the worker has taken the first update, the second one fills its queue
+            await asyncio.sleep(0.01)
+            statuses.append(await _post(server, _raw_update(2, 7)))
+            statuses.append(await _post(server, _raw_update(3, 7)))
+            release.set()
+        finally:
+            await server.stop()
+        return statuses
+
+    assert asyncio.run(post()) == [200, 200, 503]
+
+
+def test_updates_of_a_chat_go_to_one_worker_in_order():
+    async def post():
+        dispatched = []
+
+        async def dispatch(token, raw_update):
+            # earlier updates take longer, they would finish last on other workers
+            await asyncio.sleep(0.05 / raw_update["update_id"])
+            dispatched.append((raw_update["message"]["chat"]["id"],
+                               raw_update["update_id"]))
+
+        server = await _serve(workers=4, dispatch=dispatch)
+        try:
+            for update_id, chat_id in enumerate((7, 8, 7, 9, 7, 8), 1):
+                assert await _post(server, _raw_update(update_id,
+                                                       chat_id)) == 200
+        finally:
+            await server.stop()
+        return dispatched
+
+    dispatched = asyncio.run(post())
+    for chat_id, update_ids in ((7, [1, 3, 5]), (8, [2, 6]), (9, [4])):
+        assert [
+            update_id for chat, update_id in dispatched if chat == chat_id
+        ] == update_ids
+
+
+def test_idle_connections_are_closed_after_read_timeout():
+    async def connect():
+        server = await _serve(read_timeout=0.1)
+        port = server._server.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            # a slow client which never finishes its request line
+            writer.write(b"POST /bot/")
+            await writer.drain()
+            closed = await asyncio.wait_for(reader.read(), 1)
+            writer.close()
+            return closed
+        finally:
+            await server.stop()
+
+    assert asyncio.run(connect()) == b""